@@ -1,529 +1,127 @@
 import streamlit as st
-import pandas as pd
-import io
-import zipfile
 import json
-import re
 import os
-import copy
-import smtplib
-from collections import Counter
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
-from email.header import Header
+import time
+import hashlib
+import functools
 from datetime import datetime, timedelta
-from docx import Document
-from docx.text.paragraph import Paragraph
-from docx.shared import Pt
+from engine import (
+    TEMPLATE_DIR, estimate_group, format_seconds_to_jp_label, calculate_next_day_morning,
+    get_template_cache, warm_render_pool, SpooledArchive, RosterCache, RosterSource, format_roster_issues,
+    ROSTER_OPTIONAL_COLUMN, default_column_map, DEFAULT_CONTEST_NAME, DEFAULT_CONTEST_DETAILS,
+    DEFAULT_GROUP, DEFAULT_JUDGES, RESULT_METHOD_OPTIONS, ContestSettings, build_assignment_plan, format_plan_issues,
+    list_template_files, default_template_files, write_contest_archive, new_run_metrics, template_issue_lines,
+    partition_groups, DEFAULT_ENTRY_SECONDS, SHEET_FORMAT_OPTIONS, DEFAULT_SHEET_FORMAT, get_artifact_store,
+)
+from mailer import MailSettings, MailJob, MailQueue
 
 # ---------------------------------------------------------
-# 1. ユーティリティ
+# 1. 名簿読み込み
 # ---------------------------------------------------------
 
-def parse_jp_time_to_seconds(time_str):
-    if not time_str:
-        return 0
-    s = str(time_str)
-    minutes = re.search(r'(\d+)\s*[分m]', s)
-    seconds = re.search(r'(\d+)\s*[秒s]', s)
-    
-    total_sec = 0
-    if minutes:
-        total_sec += int(minutes.group(1)) * 60
-    if seconds:
-        total_sec += int(seconds.group(1))
-    return total_sec
-
-def format_seconds_to_jp_label(total_seconds):
-    if total_seconds <= 0:
-        return "0分"
-    
-    minutes = total_seconds // 60
-    remainder_seconds = total_seconds % 60
-    
-    if remainder_seconds >= 30:
-        minutes += 1
-        
-    h = minutes // 60
-    m = minutes % 60
-    
-    if h > 0:
-        return f"{h}時間{m}分"
-    else:
-        return f"{m}分"
-
-def format_time_label(text):
-    if not text:
-        return ""
-    matches = re.findall(r'(\d{1,2})[:：](\d{2})', str(text))
-    if len(matches) >= 2:
-        start_time = f"{matches[0][0]}時{matches[0][1]}分"
-        end_time = f"{matches[1][0]}時{matches[1][1]}分"
-        return f"{start_time}～{end_time}"
-    else:
-        return text
-
-def format_single_time_label(text):
-    if not text:
-        return ""
-    match = re.search(r'(\d{1,2})[:：](\d{2})', str(text))
-    if match:
-        return f"{match.group(1)}時{match.group(2)}分"
-    return text
-
-def calculate_next_day_morning(date_str):
-    if not date_str:
-        return ""
-    match = re.search(r'(\d{4})[^\d](\d{1,2})[^\d](\d{1,2})', str(date_str))
-    if match:
-        try:
-            year, month, day = map(int, match.groups())
-            dt = datetime(year, month, day)
-            next_day = dt + timedelta(days=1)
-            return next_day.strftime(f"%Y年%m月%d日10時00分")
-        except:
-            return ""
-    return ""
-
-def resolve_participants_from_string(input_str, all_data_list):
-    if not input_str:
-        return []
-
-    id_map = {str(item['no']): i for i, item in enumerate(all_data_list)}
-    resolved_members = []
-    
-    parts = [p.strip() for p in input_str.replace('、', ',').split(',')]
-    
-    for part in parts:
-        if not part:
-            continue
-        if '-' in part:
-            range_parts = part.split('-')
-            if len(range_parts) == 2:
-                start_id = range_parts[0].strip()
-                end_id = range_parts[1].strip()
-                if start_id in id_map and end_id in id_map:
-                    s_idx = id_map[start_id]
-                    e_idx = id_map[end_id]
-                    if s_idx > e_idx:
-                        s_idx, e_idx = e_idx, s_idx
-                    for i in range(s_idx, e_idx + 1):
-                        resolved_members.append(all_data_list[i])
-        else:
-            if part in id_map:
-                idx = id_map[part]
-                resolved_members.append(all_data_list[idx])
-    return resolved_members
-
-# --- Word操作系 ---
+@st.cache_resource
+def get_roster_cache():
+    return RosterCache()
 
-def replace_text_smart(paragraph, replacements):
-    full_text = paragraph.text
-    if not any(key in full_text for key in replacements):
-        return
-
-    if paragraph.runs:
-        for run in paragraph.runs:
-            for key, val in replacements.items():
-                if key in run.text:
-                    run.text = run.text.replace(key, str(val))
-
-    full_text_new = paragraph.text
-    remaining_keys = [k for k in replacements if k in full_text_new]
-
-    if remaining_keys:
-        current_text = full_text_new
-        for k in remaining_keys:
-            current_text = current_text.replace(k, str(replacements[k]))
-        
-        for run in paragraph.runs:
-            run.text = ""
-        
-        if paragraph.runs:
-            paragraph.runs[0].text = current_text
-        else:
-            paragraph.add_run(current_text)
-
-def fill_row_data(row, data_dict):
-    for cell in row.cells:
-        for paragraph in cell.paragraphs:
-            replace_text_smart(paragraph, data_dict)
-
-def replace_text_in_document_full(doc, replacements):
-    for paragraph in doc.paragraphs:
-        replace_text_smart(paragraph, replacements)
-    
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    replace_text_smart(paragraph, replacements)
-                    
-    for section in doc.sections:
-        for header in [section.header, section.first_page_header, section.even_page_header]:
-            if header:
-                for paragraph in header.paragraphs:
-                    replace_text_smart(paragraph, replacements)
-                for table in header.tables:
-                    for row in table.rows:
-                        for cell in row.cells:
-                            for paragraph in cell.paragraphs:
-                                replace_text_smart(paragraph, replacements)
-        
-        for footer in [section.footer, section.first_page_footer, section.even_page_footer]:
-            if footer:
-                for paragraph in footer.paragraphs:
-                    replace_text_smart(paragraph, replacements)
-                for table in footer.tables:
-                    for row in table.rows:
-                        for cell in row.cells:
-                            for paragraph in cell.paragraphs:
-                                replace_text_smart(paragraph, replacements)
+def get_uploaded_roster_source(uploaded_file):
+    """
+    セッションで現在の名簿ファイルの RosterSource を返す。
+    ハッシュはアップロード(file_id)ごとに1回だけ計算し、別のファイルに替わったら前のファイルのキャッシュを破棄する。
+    """
+    file_id = getattr(uploaded_file, 'file_id', None) or uploaded_file.name
+    current = st.session_state.get('roster_upload')
+    if current and current['file_id'] == file_id:
+        digest = current['digest']
+    else:
+        digest = hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+        if current and current['digest'] != digest:
+            get_roster_cache().invalidate(current['digest'])
+        st.session_state['roster_upload'] = {'file_id': file_id, 'digest': digest}
+    return RosterSource(uploaded_file.getvalue(), uploaded_file.name, digest=digest, cache=get_roster_cache())
 
 # ---------------------------------------------------------
 # 2. メール送信機能
 # ---------------------------------------------------------
 
-def send_email_callback():
-    if 'zip_buffer' not in st.session_state or not st.session_state['zip_buffer']:
-        return
-
+def load_mail_settings():
     try:
-        smtp_server = st.secrets["email"]["smtp_server"]
-        smtp_port = st.secrets["email"]["smtp_port"]
-        sender_email = st.secrets["email"]["sender_email"]
-        password = st.secrets["email"]["sender_password"]
+        conf = st.secrets["email"]
+        return MailSettings(conf["smtp_server"], conf["smtp_port"], conf["sender_email"], conf["sender_password"],
+                            conf.get("use_ssl", True))
     except Exception:
         try:
-            smtp_server = st.secrets["smtp"]["server"]
-            smtp_port = st.secrets["smtp"]["port"]
-            sender_email = st.secrets["smtp"]["sender_email"]
-            password = st.secrets["smtp"]["password"]
+            conf = st.secrets["smtp"]
+            return MailSettings(conf["server"], conf["port"], conf["sender_email"], conf["password"],
+                                conf.get("use_ssl", True))
         except:
-            return
+            return None
+
+@st.cache_resource
+def get_mail_queue(settings):
+    """送信スレッドとSMTP接続はリラン・セッションをまたいで1つだけ持つ"""
+    return MailQueue(settings)
+
+def get_session_archive():
+    """
+    このセッションで最後に生成したZIP。セッションには保管場所の run_id だけを持たせ、使うたびに保管場所から取り出す
+    （保管期間を過ぎて消えていれば None）。保管場所を使えないときはセッションの SpooledArchive を返す。
+    """
+    run_id = st.session_state.get('artifact_id')
+    if run_id:
+        store = get_artifact_store()
+        return store.get(run_id) if store is not None else None
+    return st.session_state.get('zip_archive')
+
+def send_email_callback():
+    archive = get_session_archive()
+    if not archive:
+        return
+
+    settings = load_mail_settings()
+    if settings is None:
+        return
 
     contest_name = st.session_state.get('contest_name', '無題')
     user_email = st.session_state.get('user_email', '不明なユーザー')
-    
-    file_list_str = ""
-    try:
-        current_pos = st.session_state['zip_buffer'].tell()
-        st.session_state['zip_buffer'].seek(0)
-        
-        with zipfile.ZipFile(st.session_state['zip_buffer'], 'r') as zf_read:
-            for name in zf_read.namelist():
-                file_list_str += f"・{name}\n"
-        
-        st.session_state['zip_buffer'].seek(current_pos)
-    except Exception as e:
-        file_list_str = f"（ファイル一覧取得エラー: {e}）"
 
     jst_now = datetime.utcnow() + timedelta(hours=9)
     timestamp = jst_now.strftime("%Y年%m月%d日%H時%M分")
 
-    subject = f"採点表等を作成しました：{contest_name}"
-    body = f"""{user_email}が以下のファイルを生成しました。
-
-{file_list_str}
-生成日時：{timestamp}"""
-    
-    msg = MIMEMultipart()
-    msg['From'] = sender_email
-    msg['To'] = sender_email
-    msg['Subject'] = Header(subject, 'utf-8')
-    msg.attach(MIMEText(body, 'plain'))
-
-    part = MIMEBase('application', 'octet-stream')
-    part.set_payload(st.session_state['zip_buffer'].getvalue())
-    encoders.encode_base64(part)
-    
-    filename = f"{contest_name}.zip"
-    encoded_filename = Header(filename, 'utf-8').encode()
-    part.add_header('Content-Disposition', 'attachment', filename=encoded_filename)
-    
-    msg.attach(part)
-
-    try:
-        server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-        server.login(sender_email, password)
-        server.send_message(msg)
-        server.quit()
-    except Exception as e:
-        print(f"Failed to send email: {e}")
+    # 送信はキューに積むだけにして、ダウンロードを待たせない
+    started = time.perf_counter()
+    job = MailJob(archive, contest_name, user_email, timestamp)
+    queued = get_mail_queue(settings).submit(job)
+    st.session_state['mail_job'] = job
 
-# ---------------------------------------------------------
-# 3. ドキュメント生成ロジック
-# ---------------------------------------------------------
-
-def generate_word_from_template(template_path_or_file, groups, all_data, global_context):
-    doc = Document(template_path_or_file)
-    
-    global_replacements = {}
-    for k, v in global_context.items():
-        global_replacements[f"{{{{ {k} }}}}"] = v
-    replace_text_in_document_full(doc, global_replacements)
-
-    target_table = None
-    time_row_template = None
-    data_row_template = None
-    
-    for table in doc.tables:
-        t_row = None
-        d_row = None
-        for row in table.rows:
-            row_text = "".join([c.text for c in row.cells])
-            if "{{ time }}" in row_text:
-                t_row = row
-            if "{{ s.no }}" in row_text:
-                d_row = row
-        
-        if t_row and d_row:
-            target_table = table
-            time_row_template = t_row
-            data_row_template = d_row
-            break
-    
-    if target_table:
-        tbl = target_table._tbl
-        time_tr = time_row_template._tr
-        data_tr = data_row_template._tr
-        
-        tbl.remove(time_tr)
-        tbl.remove(data_tr)
-        
-        for group in groups:
-            new_tr_time = copy.deepcopy(time_tr)
-            tbl.append(new_tr_time)
-            new_time_row = target_table.rows[-1]
-            
-            raw_time = group['time_str']
-            formatted_time = format_time_label(raw_time)
-            fill_row_data(new_time_row, {'{{ time }}': formatted_time})
+    metrics = st.session_state.get('generation_metrics')
+    if metrics is not None and metrics.enabled:
+        record = metrics.add('mail_handoff', time.perf_counter() - started, bytes=archive.size, queued=queued)
+        try:
+            metrics.append_log(stages=[record])
+        except OSError as e:
+            print(f"Failed to write metrics log: {e}")
 
-            target_members = resolve_participants_from_string(group['member_input'], all_data)
-            
-            for member in target_members:
-                new_tr_data = copy.deepcopy(data_tr)
-                tbl.append(new_tr_data)
-                new_data_row = target_table.rows[-1]
-                
-                replacements = {
-                    '{{ s.no }}': member['no'],
-                    '{{ s.name }}': member['name'],
-                    '{{ s.kana }}': member.get('kana', ''),
-                    '{{ s.age }}': member.get('age', ''),
-                    '{{ s.tel }}': member.get('tel', ''),
-                    '{{ s.song }}': member['song'],
-                }
-                fill_row_data(new_data_row, replacements)
-
-    output_buffer = io.BytesIO()
-    doc.save(output_buffer)
-    return output_buffer
-
-def generate_web_program_doc(template_path_or_file, groups, all_data, global_context):
-    doc = Document(template_path_or_file)
-    
-    global_replacements = {}
-    for k, v in global_context.items():
-        global_replacements[f"{{{{ {k} }}}}"] = v
-    
-    replace_text_in_document_full(doc, global_replacements)
-    
-    bold_target_values = [
-        global_context.get('contest_name', ''),
-        global_context.get('contest_date', ''),
-        global_context.get('contest_hall', '')
-    ]
-    
-    def apply_bold_to_targets(doc_obj, target_values):
-        def _process_para(para):
-            for run in para.runs:
-                for val in target_values:
-                    if val and val in run.text:
-                        run.font.bold = True
-
-        for p in doc_obj.paragraphs: _process_para(p)
-        for t in doc_obj.tables:
-            for r in t.rows:
-                for c in r.cells:
-                    for p in c.paragraphs: _process_para(p)
-    
-    apply_bold_to_targets(doc, bold_target_values)
+def show_mail_status():
+    job = st.session_state.get('mail_job')
+    if job is None:
+        return
 
-    template_time_para = None
-    template_data_table = None
-    
-    for p in doc.paragraphs:
-        if "{{ time }}" in p.text:
-            template_time_para = p
-            break
-            
-    if template_time_para:
-        for table in doc.tables:
-            txt = ""
-            for r in table.rows:
-                for c in r.cells:
-                    txt += c.text
-            if "{{ s.no }}" in txt:
-                template_data_table = table
-                break
-        
-        if template_data_table:
-            template_p_xml = copy.deepcopy(template_time_para._p)
-            template_tbl_xml = copy.deepcopy(template_data_table._tbl)
-            
-            parent_body = template_time_para._element.getparent()
-            if parent_body is not None: parent_body.remove(template_time_para._p)
-            
-            parent_tbl = template_data_table._tbl.getparent()
-            if parent_tbl is not None: parent_tbl.remove(template_data_table._tbl)
-            
-            data_tr_list = []
-            header_tr_list = []
-            temp_rows = list(template_tbl_xml.findall('.//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tr'))
-            start_index = -1
-            rows_per_entry = 2 
-
-            for i, tr in enumerate(temp_rows):
-                text_content = "".join([t.text for t in tr.findall('.//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t')])
-                if "{{ s.no }}" in text_content:
-                    start_index = i
-                    break
-                else:
-                    header_tr_list.append(tr)
+    # 送信が終わるまでは数秒おきに表示を更新する
+    pending = job.status not in ('sent', 'failed')
 
-            if start_index != -1:
-                end_index = min(start_index + rows_per_entry, len(temp_rows))
-                data_tr_list = temp_rows[start_index : end_index]
-            
-            for tr in temp_rows: template_tbl_xml.remove(tr)
-            
-            doc_body = doc._body._element
-            
-            for group in groups:
-                new_p_xml = copy.deepcopy(template_p_xml)
-                doc_body.append(new_p_xml)
-                new_para = Paragraph(new_p_xml, doc._body)
-                raw_time = group['time_str']
-                formatted_time = format_time_label(raw_time)
-                replace_text_smart(new_para, {'{{ time }}': formatted_time})
-                
-                new_tbl_xml = copy.deepcopy(template_tbl_xml)
-                doc_body.append(new_tbl_xml)
-                for h_tr in header_tr_list: new_tbl_xml.append(copy.deepcopy(h_tr))
-                
-                target_members = resolve_participants_from_string(group['member_input'], all_data)
-                
-                for member in target_members:
-                    for tr_template in data_tr_list:
-                        new_tr = copy.deepcopy(tr_template)
-                        new_tbl_xml.append(new_tr)
-                        
-                        current_table = doc.tables[-1] 
-                        current_row = current_table.rows[-1]
-                        
-                        for cell in current_row.cells:
-                            cell_text = cell.text
-                            
-                            if "{{ s.no }}" in cell_text:
-                                cell.text = "" 
-                                p = cell.paragraphs[0]
-                                run = p.add_run(f"{member['no']}")
-                                run.font.bold = True
-                                
-                            if "{{ s.name }}" in cell_text:
-                                cell.text = ""
-                                p = cell.paragraphs[0]
-                                run_name = p.add_run(f"{member['name']}")
-                                run_name.font.bold = True
-                                run_sep1 = p.add_run(" （")
-                                run_sep1.font.bold = False
-                                if member.get('kana'):
-                                    run_kana = p.add_run(f"{member['kana']}")
-                                    run_kana.font.bold = False
-                                run_sep2 = p.add_run("・")
-                                run_sep2.font.bold = False
-                                run_age = p.add_run(f"{member.get('age', '')}")
-                                run_age.font.bold = False
-                                run_sep3 = p.add_run("歳）")
-                                run_sep3.font.bold = False
-                                
-                            if "{{ s.song }}" in cell_text:
-                                cell.text = ""
-                                p = cell.paragraphs[0]
-                                run_song = p.add_run(f"{member['song']}")
-                                run_song.font.bold = False
-
-                doc_body.append(copy.deepcopy(template_p_xml))
-                last_p = Paragraph(doc_body[-1], doc._body)
-                last_p.text = "" 
-
-    output_buffer = io.BytesIO()
-    doc.save(output_buffer)
-    return output_buffer
-
-def generate_judges_list_doc(template_path_or_file, judges_list, global_context):
-    doc = Document(template_path_or_file)
-    global_replacements = {}
-    for k, v in global_context.items():
-        global_replacements[f"{{{{ {k} }}}}"] = v
-    replace_text_in_document_full(doc, global_replacements)
-
-    for table in doc.tables:
-        target_row_idx = -1
-        for i, row in enumerate(table.rows):
-            row_text = "".join([c.text for c in row.cells])
-            if "{{ judge_name }}" in row_text:
-                target_row_idx = i
-                break
-        
-        if target_row_idx != -1:
-            template_row = table.rows[target_row_idx]
-            tbl = table._tbl
-            tr_xml = template_row._tr
-            tbl.remove(tr_xml)
-            for judge in judges_list:
-                new_tr = copy.deepcopy(tr_xml)
-                tbl.append(new_tr)
-                new_row = table.rows[-1]
-                fill_row_data(new_row, {'{{ judge_name }}': judge})
-            output_buffer = io.BytesIO()
-            doc.save(output_buffer)
-            return output_buffer
-
-    target_para = None
-    for para in doc.paragraphs:
-        if "{{ judge_name }}" in para.text:
-            target_para = para
-            break
-            
-    if target_para:
-        p_element = target_para._p
-        parent = target_para._parent
-        template_p_xml = copy.deepcopy(p_element)
-        
-        if hasattr(parent, '_element'):
-             try: parent._element.remove(p_element)
-             except: pass
-        else:
-             try: doc._body._body.remove(p_element)
-             except: pass
-        
-        for judge in judges_list:
-            new_p_xml = copy.deepcopy(template_p_xml)
-            doc._body._body.append(new_p_xml)
-            new_para = Paragraph(new_p_xml, parent)
-            replace_text_smart(new_para, {'{{ judge_name }}': judge})
+    @st.fragment(run_every=2 if pending else None)
+    def _status():
+        current = st.session_state.get('mail_job')
+        if current is None:
+            return
+        st.caption(f"運営への通知メール: {current.status_label}")
+        if current.status in ('sent', 'failed') and pending:
+            st.rerun()
 
-    output_buffer = io.BytesIO()
-    doc.save(output_buffer)
-    return output_buffer
+    _status()
 
 # ---------------------------------------------------------
-# 4. 設定ロード用関数
+# 3. 設定ロード用関数
 # ---------------------------------------------------------
 
 def load_settings_from_json(json_data):
@@ -551,10 +149,45 @@ def load_settings_from_json(json_data):
     st.session_state['config_version'] += 1
 
 # ---------------------------------------------------------
-# 5. メインアプリケーションUI
+# 4. メインアプリケーションUI
 # ---------------------------------------------------------
+
+METRICS_STAGE_LABELS = {
+    'roster_load': "名簿読み込み",
+    'validation': "グループ解決・重複チェック",
+    'render': "ドキュメント生成",
+    'zip_write': "ZIP書き込み",
+    'mail_handoff': "メール送信の受付",
+}
+
+def show_generation_metrics():
+    metrics = st.session_state.get('generation_metrics')
+    if metrics is None or not metrics.enabled:
+        return
+    with st.expander("処理時間の内訳"):
+        rows = []
+        for s in metrics.stages:
+            rows.append({
+                "段階": METRICS_STAGE_LABELS.get(s['stage'], s['stage']),
+                "対象": s.get('document') or s.get('sheet') or "",
+                "秒": round(s['seconds'], 3),
+                "うち保存 (秒)": round(s['save_seconds'], 3) if 'save_seconds' in s else None,
+                "件数": s.get('items'),
+                "バイト数": s.get('bytes'),
+                "キャッシュ": "使用" if s.get('cached') else "",
+            })
+        st.dataframe(rows, hide_index=True)
+        st.caption(f"合計 {sum(s['seconds'] for s in metrics.stages):.2f} 秒（ドキュメントは並列に生成されるため、合計は実際の待ち時間より長くなることがあります）")
+        store = get_artifact_store()
+        if store is not None:
+            stats = store.stats()
+            st.caption(f"生成済みZIPの保管場所: {stats.items}件 {stats.bytes / (1024 * 1024):.1f} MB"
+                       f"（取り出し {stats.hits}回・期限切れ {stats.misses}回・削除 {stats.evictions}件）")
+
 def main():
     st.set_page_config(layout="wide", page_title="コンクール資料作成")
+    get_template_cache() # サーバー起動後の最初のアクセスでテンプレートを事前読込
+    warm_render_pool() # 並列生成のワーカーも同じときに起動しておき、最初の生成を待たせない
     
     # 初期化
     if 'config_version' not in st.session_state:
@@ -568,12 +201,9 @@ def main():
     if 'saved_excel_config' not in st.session_state:
         st.session_state['saved_excel_config'] = None
     if 'contest_details' not in st.session_state:
-        st.session_state['contest_details'] = {
-            'date': '', 'hall': '', 'open': '10:00', 'reception': '10:45-15:30',
-            'start': '11:00', 'end': '14:00', 'result': '', 'method': '公式サイト上で掲載'
-        }
+        st.session_state['contest_details'] = dict(DEFAULT_CONTEST_DETAILS)
     if 'contest_name' not in st.session_state:
-        st.session_state['contest_name'] = "第10回BIPCA 東京予選④"
+        st.session_state['contest_name'] = DEFAULT_CONTEST_NAME
 
     # --- 0. メールアドレス確認 (Gateway) ---
     if 'user_email' not in st.session_state:
@@ -640,9 +270,9 @@ def main():
 
     # --- デフォルト値生成ロジック ---
     if not st.session_state['groups']:
-        st.session_state['groups'] = [{'member_input': '', 'time_str': '13:00-14:10'}]
+        st.session_state['groups'] = [dict(DEFAULT_GROUP)]
     if not st.session_state['judges']:
-        st.session_state['judges'] = ["審査員A"]
+        st.session_state['judges'] = list(DEFAULT_JUDGES)
 
     # --- Step 3. 詳細設定と出力 ---
     # ここで初めて Excelデータを読み込み、JSONで指定されたシート名(あれば)を使って初期化する
@@ -650,10 +280,8 @@ def main():
     
     # 3-0. Excel読み込み & シート選択
     st.subheader("3-0. シート選択")
-    all_data = []
     excel_config_to_save = {}
     cols = []
-    df = None
     
     try:
         saved_config = st.session_state.get('saved_excel_config', {})
@@ -661,15 +289,14 @@ def main():
         
         selected_sheet = None
         
-        # ファイルポインタを先頭に戻しておく（念のため）
-        uploaded_excel.seek(0)
+        # 解析結果はファイル内容のハッシュ単位でキャッシュされ、リランでは再解析しない
+        roster_started = time.perf_counter()
+        roster_source = get_uploaded_roster_source(uploaded_excel)
 
-        if uploaded_excel.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_excel)
+        if roster_source.is_csv:
             selected_sheet = "CSV"
         else:
-            xls = pd.ExcelFile(uploaded_excel)
-            sheet_names = xls.sheet_names
+            sheet_names = roster_source.sheet_names()
             
             # JSONから読み込んだシート名があればそれを、なければ0番目を選択
             default_sheet_idx = 0
@@ -678,10 +305,10 @@ def main():
             
             # シート選択（JSON読込後に描画されるので、saved_sheet が反映される）
             selected_sheet = st.selectbox("シートを選択", sheet_names, index=default_sheet_idx, key=f"sheet_sel_{st.session_state['config_version']}")
-            df = pd.read_excel(uploaded_excel, sheet_name=selected_sheet)
 
+        cols = roster_source.columns(selected_sheet)
+        roster_seconds = time.perf_counter() - roster_started
         excel_config_to_save['sheet_name'] = selected_sheet
-        cols = df.columns.tolist()
 
     except Exception as e:
         st.error(f"Excel読み込みエラー: {e}")
@@ -689,56 +316,24 @@ def main():
 
     # 3-1. 列の割り当て
     st.subheader("3-1. 列の割り当て")
-    def get_col_index(saved_key, default_heuristic_cols, all_cols, fallback_index=0):
-        if saved_config and saved_key in saved_config:
-            val = saved_config[saved_key]
-            if val in all_cols: return all_cols.index(val)
-        for h in default_heuristic_cols:
-            if h in all_cols: return all_cols.index(h)
-        return fallback_index
+    # 保存済みの設定 → よくある列名 → 先頭の列、の順で初期選択を決める（CLIと同じ規則）
+    col_defaults = default_column_map(saved_config, cols)
+    optional_options = [ROSTER_OPTIONAL_COLUMN] + cols
+    def col_index(key):
+        return cols.index(col_defaults[key]) if col_defaults[key] in cols else 0
+    def optional_col_index(key):
+        return optional_options.index(col_defaults[key])
 
     c1, c2, c3, c4 = st.columns(4)
-    idx_no = get_col_index('col_no', ["出場番号", "No", "No."], cols, 0)
-    col_no = c1.selectbox("出場番号", cols, index=idx_no, key=f"c_no_{st.session_state['config_version']}")
+    col_no = c1.selectbox("出場番号", cols, index=col_index('col_no'), key=f"c_no_{st.session_state['config_version']}")
+    col_name = c2.selectbox("氏名", cols, index=col_index('col_name'), key=f"c_name_{st.session_state['config_version']}")
+    col_kana = c3.selectbox("フリガナ (任意)", optional_options, index=optional_col_index('col_kana'), key=f"c_kana_{st.session_state['config_version']}")
+    col_song = c4.selectbox("演奏曲目", cols, index=col_index('col_song'), key=f"c_song_{st.session_state['config_version']}")
 
-    idx_name = get_col_index('col_name', ["氏名", "名前"], cols, 0)
-    col_name = c2.selectbox("氏名", cols, index=idx_name, key=f"c_name_{st.session_state['config_version']}")
-    
-    kana_options = ["(なし)"] + cols
-    idx_kana = 0
-    if saved_config and 'col_kana' in saved_config:
-        if saved_config['col_kana'] in kana_options: idx_kana = kana_options.index(saved_config['col_kana'])
-    elif "フリガナ" in cols:
-        idx_kana = cols.index("フリガナ") + 1
-    col_kana = c3.selectbox("フリガナ (任意)", kana_options, index=idx_kana, key=f"c_kana_{st.session_state['config_version']}")
-    
-    idx_song = get_col_index('col_song', ["演奏曲目", "曲目"], cols, 0)
-    col_song = c4.selectbox("演奏曲目", cols, index=idx_song, key=f"c_song_{st.session_state['config_version']}")
-    
     c5, c6, c7 = st.columns(3)
-    age_options = ["(なし)"] + cols
-    idx_age = 0
-    if saved_config and 'col_age' in saved_config:
-            if saved_config['col_age'] in age_options: idx_age = age_options.index(saved_config['col_age'])
-    elif "年齢" in cols:
-            idx_age = cols.index("年齢") + 1
-    col_age = c5.selectbox("年齢列 (任意)", age_options, index=idx_age, key=f"c_age_{st.session_state['config_version']}")
-
-    tel_options = ["(なし)"] + cols
-    idx_tel = 0
-    if saved_config and 'col_tel' in saved_config:
-            if saved_config['col_tel'] in tel_options: idx_tel = tel_options.index(saved_config['col_tel'])
-    elif "電話番号" in cols:
-            idx_tel = cols.index("電話番号") + 1
-    col_tel = c6.selectbox("電話番号列 (受付表用)", tel_options, index=idx_tel, key=f"c_tel_{st.session_state['config_version']}")
-
-    dur_options = ["(なし)"] + cols
-    idx_dur = 0
-    if saved_config and 'col_duration' in saved_config:
-            if saved_config['col_duration'] in dur_options: idx_dur = dur_options.index(saved_config['col_duration'])
-    elif "演奏時間" in cols:
-            idx_dur = cols.index("演奏時間") + 1
-    col_duration = c7.selectbox("演奏時間列 (自動計算用)", dur_options, index=idx_dur, key=f"c_dur_{st.session_state['config_version']}")
+    col_age = c5.selectbox("年齢列 (任意)", optional_options, index=optional_col_index('col_age'), key=f"c_age_{st.session_state['config_version']}")
+    col_tel = c6.selectbox("電話番号列 (受付表用)", optional_options, index=optional_col_index('col_tel'), key=f"c_tel_{st.session_state['config_version']}")
+    col_duration = c7.selectbox("演奏時間列 (自動計算用)", optional_options, index=optional_col_index('col_duration'), key=f"c_dur_{st.session_state['config_version']}")
 
     excel_config_to_save.update({
         'col_no': col_no, 'col_name': col_name, 'col_kana': col_kana,
@@ -746,30 +341,19 @@ def main():
     })
 
     # データ構築
-    for _, row in df.iterrows():
-        kana_val = str(row[col_kana]) if col_kana != "(なし)" else ""
-        age_val = str(row[col_age]) if col_age != "(なし)" else ""
-        tel_val = str(row[col_tel]) if col_tel != "(なし)" else ""
-        dur_seconds = 0
-        if col_duration != "(なし)":
-            raw_dur = str(row[col_duration])
-            dur_seconds = parse_jp_time_to_seconds(raw_dur)
-
-        all_data.append({
-            'no': str(row[col_no]), 'name': str(row[col_name]),
-            'kana': kana_val, 'song': str(row[col_song]),
-            'age': age_val, 'tel': tel_val, 'duration_sec': dur_seconds
-        })
+    roster_started = time.perf_counter()
+    all_data, participant_index, roster_issues = roster_source.roster(selected_sheet, excel_config_to_save)
+    roster_seconds += time.perf_counter() - roster_started
     st.write(f"読み込み完了: {len(all_data)} 件のデータ")
+    issue_lines = format_roster_issues(roster_issues)
+    if issue_lines:
+        st.warning("名簿の確認をお願いします。\n\n" + "\n".join(f"- {line}" for line in issue_lines))
 
     st.markdown("---")
 
     # テンプレート選択
     st.subheader("3-2. Wordテンプレート選択")
-    TEMPLATE_DIR = "templates"
-    template_files = []
-    if os.path.exists(TEMPLATE_DIR):
-        template_files = [f for f in os.listdir(TEMPLATE_DIR) if f.endswith(".docx") and not f.startswith("~$")]
+    template_files = list_template_files(TEMPLATE_DIR)
     
     score_template_path = None
     reception_template_path = None
@@ -778,12 +362,11 @@ def main():
     use_manual_upload = False
 
     if template_files:
-        idx_score = 0; idx_reception = 0; idx_web = 0; idx_judges = 0
-        for i, f in enumerate(template_files):
-            if "採点表" in f: idx_score = i
-            if "受付表" in f: idx_reception = i
-            if "WEB" in f or "プログラム" in f: idx_web = i
-            if "審査員" in f and "リスト" not in f: idx_judges = i
+        default_files = default_template_files(template_files)
+        idx_score = template_files.index(default_files['score'])
+        idx_reception = template_files.index(default_files['reception'])
+        idx_web = template_files.index(default_files['web'])
+        idx_judges = template_files.index(default_files['judges_list'])
         
         col_t1, col_t2 = st.columns(2)
         col_t3, col_t4 = st.columns(2)
@@ -818,6 +401,14 @@ def main():
         if uploaded_web_template: web_template_path = uploaded_web_template
         if uploaded_judges_template: judges_list_template_path = uploaded_judges_template
 
+    # 選んだ時点で読み込み、runの統合などの前処理を済ませておく（結果はテンプレートキャッシュに残る）
+    template_issues = template_issue_lines({
+        'score': score_template_path, 'reception': reception_template_path,
+        'web': web_template_path, 'judges_list': judges_list_template_path,
+    })
+    if template_issues:
+        st.warning("テンプレートに差し込めないプレースホルダがあります。\n\n" + "\n".join(f"- {line}" for line in template_issues))
+
     st.markdown("---")
 
     # グループ設定
@@ -829,6 +420,28 @@ def main():
         if idx < len(st.session_state['groups']) - 1: st.session_state['groups'][idx], st.session_state['groups'][idx+1] = st.session_state['groups'][idx+1], st.session_state['groups'][idx]
     def remove_group(idx): st.session_state['groups'].pop(idx)
 
+    with st.expander("名簿順に自動でグループ分け"):
+        c_a1, c_a2, c_a3 = st.columns(3)
+        auto_start = c_a1.text_input("開始時刻", value=st.session_state['contest_details'].get('start', ''), key="auto_start", placeholder="例: 11:00")
+        auto_block_min = c_a2.number_input("1グループの目安（分）", min_value=5, value=60, step=5, key="auto_block_min")
+        auto_gap_min = c_a3.number_input("グループ間の休憩（分）", min_value=0, value=10, step=5, key="auto_gap_min")
+        c_b1, c_b2, c_b3 = st.columns(3)
+        auto_long_every = c_b1.number_input("長い休憩を入れる間隔（グループ数、0なら入れない）", min_value=0, value=0, step=1, key="auto_long_every")
+        auto_long_min = c_b2.number_input("長い休憩（分）", min_value=0, value=45, step=5, key="auto_long_min")
+        auto_default_min = c_b3.number_input("演奏時間が空欄の出場者（分）", min_value=1, value=DEFAULT_ENTRY_SECONDS // 60, step=1, key="auto_default_min")
+        if st.button("この条件でグループを作り直す", key="btn_auto_groups"):
+            if len(participant_index) == 0:
+                st.warning("名簿に出場者がいません。")
+            else:
+                st.session_state['groups'] = partition_groups(
+                    participant_index, auto_block_min * 60, auto_start, gap_sec=auto_gap_min * 60,
+                    long_break_sec=auto_long_min * 60, long_break_every=auto_long_every,
+                    default_duration_sec=auto_default_min * 60,
+                )
+                # 入力欄を新しいグループの値で作り直す
+                st.session_state['config_version'] += 1
+                st.rerun()
+
     st.button("＋ グループ追加", on_click=add_group, key=f"btn_add_grp_{st.session_state['config_version']}")
 
     for i, grp in enumerate(st.session_state['groups']):
@@ -840,15 +453,17 @@ def main():
         input_val = c_input.text_input(f"グループ {i+1} 対象番号", value=grp['member_input'], key=f"g_in_{i}_{st.session_state['config_version']}", placeholder="例: A01-A05, C01")
         st.session_state['groups'][i]['member_input'] = input_val
         
-        current_members = resolve_participants_from_string(input_val, all_data)
-        total_sec = sum(m['duration_sec'] for m in current_members)
-        
-        with c_total:
-             st.markdown(f"<div style='margin-top: 1.8rem; font-weight:bold; color: #004280;'>計: {format_seconds_to_jp_label(total_sec)}</div>", unsafe_allow_html=True)
-
         time_val = c_time.text_input("時間", value=grp['time_str'], key=f"g_time_{i}_{st.session_state['config_version']}", placeholder="例: 13:00-14:00")
         st.session_state['groups'][i]['time_str'] = time_val
 
+        # 合計は名簿順の累積和から求め、同じ対象番号の入力は再計算しない
+        estimate = estimate_group(participant_index, st.session_state['groups'][i])
+        with c_total:
+             st.markdown(f"<div style='margin-top: 1.8rem; font-weight:bold; color: #004280;'>計: {format_seconds_to_jp_label(estimate.total_sec)}</div>", unsafe_allow_html=True)
+             if estimate.end:
+                 over = estimate.planned_end is not None and estimate.end > estimate.planned_end
+                 st.markdown(f"<div style='font-size: 0.8rem; color: {'#c00' if over else '#666'};'>終了見込み {estimate.end}</div>", unsafe_allow_html=True)
+
         with c_del:
             st.markdown("<div style='margin-top: 1.8rem;'></div>", unsafe_allow_html=True)
             if st.button("×", key=f"del_{i}_{st.session_state['config_version']}"): remove_group(i); st.rerun()
@@ -886,7 +501,7 @@ def main():
 
     col_d7, col_d8 = st.columns(2)
     result_val = col_d7.text_input("結果発表日時", value=det_current['result'], key=f"detail_result_{st.session_state['config_version']}")
-    method_options = ["公式サイト上で掲載", "会場ロビーもしくはホワイエで掲示", "表彰式にて発表", "その他"]
+    method_options = RESULT_METHOD_OPTIONS
     curr_method = det_current.get('method', "公式サイト上で掲載")
     idx_method = method_options.index(curr_method) if curr_method in method_options else 0
     method_val = col_d8.selectbox("結果発表方式", method_options, index=idx_method, key=f"detail_method_{st.session_state['config_version']}")
@@ -900,93 +515,88 @@ def main():
 
     # --- ファイル出力 ---
     st.header("Step 4. ファイル生成")
+    # PDFはWordを経由せずに直接組むので、印刷用にWordから書き出す手間がいらない
+    format_options = list(SHEET_FORMAT_OPTIONS)
+    sheet_format = st.radio("採点表・受付表の出力形式", format_options, index=format_options.index(DEFAULT_SHEET_FORMAT),
+                            format_func=SHEET_FORMAT_OPTIONS.get, horizontal=True, key="sheet_format")
     if st.button("ファイル生成を実行", type="primary", key=f"btn_gen_{st.session_state['config_version']}"):
+        # 段階ごとの処理時間・件数・サイズを記録する（名簿の読み込みはこのリランでかかった時間）
+        metrics = new_run_metrics(contest_name=contest_name)
+        metrics.add('roster_load', roster_seconds, items=len(all_data), sheet=selected_sheet)
+
         # バリデーション
-        assigned_nos = []
-        for grp in st.session_state['groups']:
-            members = resolve_participants_from_string(grp['member_input'], all_data)
-            for m in members: assigned_nos.append(m['no'])
-        
-        counts = Counter(assigned_nos)
-        duplicates = [no for no, count in counts.items() if count > 1]
-        if duplicates:
-            st.error(f"⛔ エラー: 出場番号重複: {', '.join(duplicates)}")
+        # グループの解決はここで1回だけ行い、重複チェックと各帳票の生成で同じ割り当てを使う
+        with metrics.stage('validation', items=len(st.session_state['groups'])) as record:
+            plan = build_assignment_plan(st.session_state['groups'], participant_index)
+            record.update(duplicates=len(plan.duplicates), unassigned=len(plan.unassigned))
+        if plan.duplicates:
+            st.error(f"⛔ エラー: 出場番号重複: {', '.join(plan.duplicates)}")
             return
+        for line in format_plan_issues(plan):
+            st.warning(line)
         
         if not score_template_path:
             st.error("採点表テンプレートが選択されていません。")
             return
 
         valid_judges = [j for j in st.session_state['judges'] if j.strip()]
-        details_formatted = {
-            'contest_date': det_updated['date'], 'contest_hall': det_updated['hall'],
-            'contest_open': format_single_time_label(det_updated['open']),
-            'contest_reception': format_time_label(det_updated['reception']),
-            'contest_start': format_single_time_label(det_updated['start']),
-            'contest_end': format_single_time_label(det_updated['end']),
-            'contest_result': det_updated['result'], 'contest_method': det_updated['method']
+        contest = ContestSettings(contest_name, st.session_state['groups'], valid_judges, det_updated, excel_config_to_save)
+        templates = {
+            'score': score_template_path, 'reception': reception_template_path,
+            'web': web_template_path, 'judges_list': judges_list_template_path,
         }
 
-        config_json = json.dumps({
-            'groups': st.session_state['groups'], 'judges': valid_judges,
-            'contest_name': contest_name, 'contest_details': det_updated,
-            'excel_config': excel_config_to_save
-        }, ensure_ascii=False, indent=2)
-
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            base_context = {'contest_name': contest_name, **details_formatted}
-            
-            for judge in valid_judges:
-                try:
-                    if hasattr(score_template_path, 'seek'): score_template_path.seek(0)
-                    context = base_context.copy(); context['judge_name'] = judge
-                    doc_io = generate_word_from_template(score_template_path, st.session_state['groups'], all_data, context)
-                    zf.writestr(f"採点表_{judge}.docx", doc_io.getvalue())
-                except Exception as e: st.error(f"採点表生成エラー ({judge}): {e}")
-
-            if reception_template_path:
-                try:
-                    if hasattr(reception_template_path, 'seek'): reception_template_path.seek(0)
-                    context = base_context.copy(); context['judge_name'] = '受付用'
-                    doc_io = generate_word_from_template(reception_template_path, st.session_state['groups'], all_data, context)
-                    zf.writestr("受付表.docx", doc_io.getvalue())
-                except: pass
-
-            if web_template_path:
-                try:
-                    if hasattr(web_template_path, 'seek'): web_template_path.seek(0)
-                    context = base_context.copy(); context['judge_name'] = ''
-                    doc_io = generate_web_program_doc(web_template_path, st.session_state['groups'], all_data, context)
-                    zf.writestr("WEBプログラム.docx", doc_io.getvalue())
-                except: pass
-            
-            if judges_list_template_path:
-                try:
-                    if hasattr(judges_list_template_path, 'seek'): judges_list_template_path.seek(0)
-                    context = base_context.copy()
-                    doc_io = generate_judges_list_doc(judges_list_template_path, valid_judges, context)
-                    zf.writestr("本日の審査員.docx", doc_io.getvalue())
-                except: pass
-
-            if os.path.exists(TEMPLATE_DIR):
-                for f in os.listdir(TEMPLATE_DIR):
-                    if f.endswith(".pdf"): zf.write(os.path.join(TEMPLATE_DIR, f), arcname=f)
-
-            zf.writestr("設定データ.json", config_json)
+        # 前回の出力は参照を外すだけにする（保管場所の期限・上限で消える）。
+        # 新しいZIPは保管場所のファイルへ直接書き込み、セッションには run_id だけを残す
+        st.session_state.pop('zip_archive', None)
+        st.session_state.pop('artifact_id', None)
+        store = get_artifact_store()
+        zip_archive = store.create() if store is not None else SpooledArchive()
+
+        with zip_archive.open_zip() as zf:
+            # 生成処理はCLIと共通（engine.write_contest_archive）
+            for output in write_contest_archive(zf, contest, plan, templates, TEMPLATE_DIR, metrics=metrics,
+                                                sheet_format=sheet_format):
+                if output.error:
+                    judge_label = f" ({output.judge})" if output.judge else ""
+                    st.error(f"{output.label}生成エラー{judge_label}: {output.error}")
         
-        st.session_state['zip_buffer'] = zip_buffer
+        if store is not None:
+            st.session_state['artifact_id'] = zip_archive.run_id
+        else:
+            st.session_state['zip_archive'] = zip_archive
+        st.session_state['generation_metrics'] = metrics
+        if metrics.enabled:
+            try:
+                metrics.append_log()
+            except OSError as e:
+                print(f"Failed to write metrics log: {e}")
         st.success("生成完了！")
     
-    if 'zip_buffer' in st.session_state and st.session_state['zip_buffer']:
+    run_id = st.session_state.get('artifact_id')
+    download_data = None
+    if run_id:
+        store = get_artifact_store()
+        if store is not None and store.contains(run_id):
+            download_data = functools.partial(store.read, run_id)
+        else:
+            st.session_state.pop('artifact_id', None)
+            st.info("生成したZIPは保管期間を過ぎたため削除されました。もう一度「ファイル生成を実行」してください。")
+    elif st.session_state.get('zip_archive'):
+        download_data = st.session_state['zip_archive'].read
+
+    if download_data is not None:
         st.download_button(
             label="ZIPファイルをダウンロード",
-            data=st.session_state['zip_buffer'].getvalue(),
+            # クリックされたときだけ読み出す（リランのたびにZIP全体を複製しない）
+            data=download_data,
             file_name=f"{contest_name}.zip",
             mime="application/zip",
             on_click=send_email_callback,
             key=f"dl_btn_{st.session_state['config_version']}"
         )
+        show_mail_status()
+        show_generation_metrics()
 
 if __name__ == "__main__":
     main()
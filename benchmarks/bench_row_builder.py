@@ -0,0 +1,46 @@
+"""
+採点表の出場者表（generate_word_from_template）の行数に対するスケーリングを計測する。
+
+    python benchmarks/bench_row_builder.py [行数 ...]
+
+行あたりの時間がほぼ一定であれば線形に伸びている。
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from engine import TEMPLATE_DIR, generate_word_from_template  # noqa: E402
+
+SCORE_TEMPLATE = os.path.join(ROOT, TEMPLATE_DIR, "テンプレート：採点表.docx")
+GROUP_SIZE = 50
+
+def make_roster(n):
+    return [
+        {'no': f"A{i:05d}", 'name': f"出場者 {i}", 'kana': f"シュツジョウシャ {i}",
+         'song': f"練習曲 第{i % 24 + 1}番", 'age': str(6 + i % 12), 'tel': '', 'duration_sec': 180}
+        for i in range(n)
+    ]
+
+def make_groups(all_data):
+    groups = []
+    for start in range(0, len(all_data), GROUP_SIZE):
+        chunk = all_data[start:start + GROUP_SIZE]
+        groups.append({'member_input': f"{chunk[0]['no']}-{chunk[-1]['no']}", 'time_str': '10:00-11:00'})
+    return groups
+
+def main(sizes):
+    context = {'contest_name': 'ベンチマーク', 'judge_name': '審査員A'}
+    print(f"{'rows':>8} {'total [s]':>10} {'per row [us]':>13}")
+    for n in sizes:
+        all_data = make_roster(n)
+        groups = make_groups(all_data)
+        start = time.perf_counter()
+        generate_word_from_template(SCORE_TEMPLATE, groups, all_data, context)
+        elapsed = time.perf_counter() - start
+        print(f"{n:>8} {elapsed:>10.3f} {elapsed / n * 1e6:>13.1f}")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1000, 5000, 10000])
@@ -0,0 +1,450 @@
+"""
+生成処理の主な経路を、合成した名簿（100 / 1,000 / 5,000 / 20,000 人）と templates/ の実テンプレートで計測する。
+
+    python benchmarks/bench_suite.py                    # 計測して baseline.json と比較する
+    python benchmarks/bench_suite.py --save-baseline    # 計測結果を baseline.json に保存する
+    python benchmarks/bench_suite.py --sizes 100 1000 --only resolve zip
+
+計測ごとに子プロセスを起動するので、ピークメモリ（最大RSS）は他の計測の影響を受けない。
+子プロセスでは計測しない1回を先に実行し、テンプレートの読み込みなど初回だけの処理を除いてから繰り返し測る。
+ベースラインより threshold（既定20%）以上遅い、またはメモリが多い計測があれば終了コード1で終わる。
+時間はそのままの値と、同じプロセスで測った calibrate() との比の両方で比べ、回帰に見えた計測は別のプロセスで測り直してから判定する。
+ベースラインにない計測は比べられないので NEW と表示し、最後に一覧を出す（--save-baseline で追加する）。
+ベースラインは各計測を BASELINE_RUNS 個のプロセスで測り、中央の値を保存する。
+ベースラインの値はマシンに依存するため、比較は同じマシンで保存したものに対して行う。
+"""
+import argparse
+import ctypes
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = [100, 1000, 5000, 20000]
+DEFAULT_THRESHOLD = 0.2
+# 計測しない1回のあとに繰り返す回数
+DEFAULT_REPEAT = 5
+# 回帰に見えた計測を別のプロセスで測り直す回数
+CONFIRM_RUNS = 2
+# ベースラインを保存するときに測るプロセスの数（時間が中央のものを保存する）
+BASELINE_RUNS = 3
+CALIBRATION_LOOPS = 300000
+CALIBRATION_REPEAT = 5
+# これより短い計測は揺れが大きいので、遅くなっても回帰とはみなさない
+NOISE_FLOOR_SECONDS = 0.01
+NOISE_FLOOR_MB = 5.0
+# replace_text_smart は1行あたり数ミリ秒かかるため、大きな名簿でも先頭のこの人数分だけ置換する
+REPLACE_TEXT_SMART_MAX_ROWS = 2000
+# roster_xlsx で名簿に足す、割り当てに使わない列の数
+ROSTER_XLSX_EXTRA_COLUMNS = 30
+
+CATEGORY_PREFIXES = ["A", "B", "C", "D", "E", "F", "G", "J"]
+FAMILY_NAMES = [("山田", "ヤマダ"), ("佐藤", "サトウ"), ("鈴木", "スズキ"), ("高橋", "タカハシ"), ("田中", "タナカ"),
+                ("伊藤", "イトウ"), ("渡辺", "ワタナベ"), ("中村", "ナカムラ"), ("小林", "コバヤシ"), ("加藤", "カトウ")]
+GIVEN_NAMES = [("花子", "ハナコ"), ("太郎", "タロウ"), ("美咲", "ミサキ"), ("陽翔", "ハルト"), ("結衣", "ユイ"),
+               ("蓮", "レン"), ("さくら", "サクラ"), ("大翔", "ヒロト"), ("葵", "アオイ"), ("悠真", "ユウマ")]
+SONGS = ["ブルグミュラー：アラベスク", "ショパン：子犬のワルツ", "バッハ：インヴェンション第1番",
+         "モーツァルト：ソナタ K.545 第1楽章", "ドビュッシー：月の光", "ベートーヴェン：エリーゼのために"]
+JUDGES = ["審査員A", "審査員B", "審査員C", "審査員D", "審査員E"]
+CONTEST_NAME = "ベンチマーク予選"
+
+# ---------------------------------------------------------
+# 合成データ
+# ---------------------------------------------------------
+
+def make_roster_frame(n, seed=0):
+    """UIでアップロードされるExcelと同じ列の DataFrame を作る"""
+    import pandas as pd
+    rnd = random.Random(seed)
+    per_category = -(-n // len(CATEGORY_PREFIXES))
+    width = max(3, len(str(per_category)))
+    rows = []
+    for i in range(n):
+        prefix = CATEGORY_PREFIXES[i // per_category]
+        family, family_kana = rnd.choice(FAMILY_NAMES)
+        given, given_kana = rnd.choice(GIVEN_NAMES)
+        minutes, seconds = rnd.randint(1, 7), rnd.randint(0, 59)
+        rows.append({
+            '出場番号': f"{prefix}{i % per_category + 1:0{width}d}",
+            '氏名': f"{family} {given}",
+            'フリガナ': f"{family_kana} {given_kana}",
+            '演奏曲目': rnd.choice(SONGS),
+            '年齢': rnd.randint(4, 18),
+            '電話番号': f"090-{rnd.randint(1000, 9999)}-{rnd.randint(1000, 9999)}",
+            '演奏時間': f"{minutes}分{seconds}秒" if seconds else f"{minutes}分",
+        })
+    return pd.DataFrame(rows)
+
+def make_groups(all_data, seed=0):
+    """部門（番号の頭文字）ごとに10〜15人の範囲指定で区切り、ときどき個別の番号を足したグループを作る"""
+    rnd = random.Random(seed)
+    groups = []
+    hour = 10
+    i = 0
+    while i < len(all_data):
+        size = rnd.randint(10, 15)
+        chunk = all_data[i:i + size]
+        # 部門をまたがないようにする
+        chunk = [m for m in chunk if m['no'][0] == chunk[0]['no'][0]]
+        parts = [f"{chunk[0]['no']}-{chunk[-1]['no']}"] if len(chunk) > 1 else [chunk[0]['no']]
+        i += len(chunk)
+        if len(chunk) > 3 and rnd.random() < 0.3:
+            # 範囲の最後の1人を外して個別に指定する
+            parts = [f"{chunk[0]['no']}-{chunk[-2]['no']}", chunk[-1]['no']]
+        groups.append({'member_input': ", ".join(parts), 'time_str': f"{hour % 24:02d}:00-{hour % 24:02d}:50"})
+        hour += 1
+    return groups
+
+def make_contest(n, seed=0):
+    from engine import normalize_roster_frame
+    df = make_roster_frame(n, seed)
+    col_map = {'col_no': '出場番号', 'col_name': '氏名', 'col_kana': 'フリガナ', 'col_song': '演奏曲目',
+               'col_age': '年齢', 'col_tel': '電話番号', 'col_duration': '演奏時間'}
+    all_data, _ = normalize_roster_frame(df, col_map)
+    return df, col_map, all_data, make_groups(all_data, seed)
+
+def base_context():
+    from engine import format_contest_details, DEFAULT_CONTEST_DETAILS
+    details = dict(DEFAULT_CONTEST_DETAILS, date="2025年12月21日", hall="ベンチマークホール")
+    return {'contest_name': CONTEST_NAME, **format_contest_details(details)}
+
+def template_paths():
+    from engine import TEMPLATE_DIR, select_template_paths
+    return select_template_paths(os.path.join(ROOT, TEMPLATE_DIR))
+
+# ---------------------------------------------------------
+# 計測対象
+# ---------------------------------------------------------
+
+def bench_roster(n):
+    from engine import normalize_roster_frame
+    df, col_map, _, _ = make_contest(n)
+    return lambda: normalize_roster_frame(df, col_map)
+
+def bench_roster_xlsx(n):
+    # 申込書の列が多いExcelを想定し、使わない列を足してから保存したものを読む
+    import io
+    from engine import RosterSource
+    df, col_map, _, _ = make_contest(n)
+    for i in range(ROSTER_XLSX_EXTRA_COLUMNS):
+        df[f"申込項目{i + 1}"] = f"記入内容{i + 1}"
+    buf = io.BytesIO()
+    df.to_excel(buf, index=False)
+    data = buf.getvalue()
+    # 毎回新しいキャッシュで、シート名・列名の取得から名簿の構築までを計測する
+    def run():
+        source = RosterSource(data, "roster.xlsx")
+        sheet_name = source.sheet_names()[0]
+        source.columns(sheet_name)
+        source.roster(sheet_name, col_map)
+    return run
+
+def bench_resolve(n):
+    from engine import ParticipantIndex, resolve_participants_from_string
+    _, _, all_data, groups = make_contest(n)
+    def run():
+        # UIと同じく名簿ごとに索引を作り、全グループを解決する
+        index = ParticipantIndex(all_data)
+        for g in groups:
+            resolve_participants_from_string(g['member_input'], index)
+    return run
+
+def bench_replace_text_smart(n):
+    import copy
+    from docx.oxml.ns import qn
+    from docx.text.paragraph import Paragraph
+    from engine import load_template, replace_text_smart, member_replacements
+    _, _, all_data, _ = make_contest(n)
+    doc = load_template(template_paths()['score'])
+    template_tr = copy.deepcopy(doc.tables[0].rows[-1]._tr)
+    def run():
+        # 1行ずつ行を複製して置換していた頃の経路（出場者数ぶん呼ばれる）
+        for member in all_data[:REPLACE_TEXT_SMART_MAX_ROWS]:
+            tr = copy.deepcopy(template_tr)
+            replacements = member_replacements(member)
+            for p in tr.iter(qn('w:p')):
+                replace_text_smart(Paragraph(p, None), replacements)
+    return run
+
+def bench_score(n):
+    from engine import generate_word_from_template
+    _, _, all_data, groups = make_contest(n)
+    template = template_paths()['score']
+    context = dict(base_context(), judge_name=JUDGES[0])
+    return lambda: generate_word_from_template(template, groups, all_data, context)
+
+def bench_reception(n):
+    from engine import generate_word_from_template
+    _, _, all_data, groups = make_contest(n)
+    template = template_paths()['reception']
+    context = dict(base_context(), judge_name='受付用')
+    return lambda: generate_word_from_template(template, groups, all_data, context)
+
+def bench_score_pdf(n):
+    # 審査員ごとの差はタイトルだけなので、レイアウトと1人分の書き出しを計測する
+    from engine import generate_pdf_sheet
+    _, _, all_data, groups = make_contest(n)
+    return lambda: generate_pdf_sheet('score', groups, all_data, base_context(), JUDGES[0])
+
+def bench_reception_pdf(n):
+    from engine import generate_pdf_sheet
+    _, _, all_data, groups = make_contest(n)
+    context = dict(base_context(), judge_name='受付用')
+    return lambda: generate_pdf_sheet('reception', groups, all_data, context)
+
+def bench_web(n):
+    from engine import generate_web_program_doc
+    _, _, all_data, groups = make_contest(n)
+    template = template_paths()['web']
+    context = dict(base_context(), judge_name='')
+    return lambda: generate_web_program_doc(template, groups, all_data, context)
+
+def bench_judges_list(n):
+    # 審査員リストは名簿の大きさに依存しないが、他と同じ表に並べるため全サイズで計測する
+    from engine import generate_judges_list_doc
+    template = template_paths()['judges_list']
+    return lambda: generate_judges_list_doc(template, JUDGES, base_context())
+
+def bench_zip(n):
+    from engine import (TEMPLATE_DIR, ContestSettings, DEFAULT_CONTEST_DETAILS, ParticipantIndex,
+                        SpooledArchive, write_contest_archive)
+    _, col_map, all_data, groups = make_contest(n)
+    index = ParticipantIndex(all_data)
+    contest = ContestSettings(CONTEST_NAME, groups, JUDGES, dict(DEFAULT_CONTEST_DETAILS), dict(col_map, sheet_name="CSV"))
+    templates = template_paths()
+    def run():
+        archive = SpooledArchive()
+        with archive.open_zip() as zf:
+            for output in write_contest_archive(zf, contest, index, templates, os.path.join(ROOT, TEMPLATE_DIR)):
+                if output.error:
+                    raise RuntimeError(output.error)
+        archive.close()
+    return run
+
+BENCHMARKS = {
+    'roster': bench_roster,
+    'roster_xlsx': bench_roster_xlsx,
+    'resolve': bench_resolve,
+    'replace_text_smart': bench_replace_text_smart,
+    'score': bench_score,
+    'reception': bench_reception,
+    'score_pdf': bench_score_pdf,
+    'reception_pdf': bench_reception_pdf,
+    'web': bench_web,
+    'judges_list': bench_judges_list,
+    'zip': bench_zip,
+}
+
+# ---------------------------------------------------------
+# 実行と比較
+# ---------------------------------------------------------
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _release_free_memory():
+    # glibc は解放したヒープをプロセスに残すため、OSに返してから測らないと前の回の残りにまぎれて増分が出ない
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def _reset_peak_rss():
+    # Linux では clear_refs に 5 を書くと最大RSS（VmHWM）がその時点のRSSに戻る
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux では KB 単位。リセットできないので、プロセス開始からの最大になる
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def calibrate():
+    """
+    決まった量の純Pythonの計算にかかる時間（最短）。同じマシンでも他のプロセスの負荷で全体が遅くなる時間帯があるため、
+    比較ではこの時間に対する比を使う。
+    """
+    best = None
+    for _ in range(CALIBRATION_REPEAT):
+        start = time.perf_counter()
+        total = 0
+        for i in range(CALIBRATION_LOOPS):
+            total += i * i % 7
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_case(name, n, repeat):
+    """
+    子プロセス側。準備を済ませ、計測しない1回（テンプレートの読み込みなど初回だけの処理）を実行してから
+    repeat 回計測し、最短時間と、各回の実行前のRSSから見た最大RSSの増分の中央値を返す。
+    lxml のメモリは tracemalloc では追えないため、プロセスのRSSで測る。
+    """
+    run = BENCHMARKS[name](n)
+    run()
+    times = []
+    peaks = []
+    for _ in range(repeat):
+        _release_free_memory()
+        rss_before = _rss_mb()
+        can_reset = _reset_peak_rss()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        peak_after = _peak_rss_mb()
+        if can_reset and rss_before is not None and peak_after is not None:
+            peaks.append(max(0.0, peak_after - rss_before))
+    peak_mb = statistics.median(peaks) if peaks else None
+    return {'seconds': min(times), 'peak_mb': peak_mb, 'calibration': calibrate()}
+
+def spawn_case(name, n, repeat):
+    env = dict(os.environ)
+    # 並列生成の有無で結果が変わらないよう、ZIP組み立ても1プロセスで計測する
+    env.setdefault("BIPCA_RENDER_WORKERS", "1")
+    # 繰り返し計測で生成済みドキュメントのキャッシュが効かないようにする
+    env["BIPCA_DOC_CACHE"] = "0"
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--case", name, str(n), "--repeat", str(repeat)],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{name}/{n} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def spawn_baseline_case(name, n, repeat):
+    """
+    ベースライン用。1つのプロセスだけだと速い時間帯に当たった値を保存してしまうことがあるので、
+    BASELINE_RUNS 個のプロセスで測り、時間が中央の結果（calibrate() もその回のもの）とメモリの中央値を使う。
+    """
+    runs = sorted((spawn_case(name, n, repeat) for _ in range(BASELINE_RUNS)), key=lambda r: r['seconds'])
+    result = dict(runs[len(runs) // 2])
+    peaks = [r['peak_mb'] for r in runs if r.get('peak_mb') is not None]
+    result['peak_mb'] = statistics.median(peaks) if peaks else None
+    return result
+
+def compare(result, base, threshold):
+    notes = []
+    if base is None:
+        return notes
+    # 両方に calibrate() の時間があれば、マシン全体の速さの違いを割り引いたベースラインの時間とも比べる。
+    # calibrate() 自体も揺れるため、そのままの時間と割り引いた時間のどちらで見ても遅いときだけ回帰とする
+    base_seconds = base['seconds']
+    if result.get('calibration') and base.get('calibration'):
+        base_seconds = max(base_seconds, base_seconds * result['calibration'] / base['calibration'])
+    if result['seconds'] > max(base_seconds * (1 + threshold), base_seconds + NOISE_FLOOR_SECONDS):
+        notes.append(f"time +{(result['seconds'] / base_seconds - 1) * 100:.0f}%")
+    if result.get('peak_mb') is not None and base.get('peak_mb') is not None:
+        if result['peak_mb'] > max(base['peak_mb'] * (1 + threshold), base['peak_mb'] + NOISE_FLOOR_MB):
+            notes.append(f"memory +{result['peak_mb'] - base['peak_mb']:.0f}MB")
+    return notes
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('cases', {})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="計測する項目")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help="各計測の繰り返し回数（時間は最短、メモリは中央値を使う）")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="回帰とみなす増加率")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--case", nargs=2, metavar=("NAME", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(args.case[0], int(args.case[1]), args.repeat)))
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = []
+    # ベースラインにない計測。比べられないまま通ってしまわないよう、最後にまとめて知らせる
+    missing = []
+    print(f"{'case':<26} {'time [s]':>10} {'base [s]':>10} {'peak [MB]':>10} {'base [MB]':>10}")
+    for name in args.only or list(BENCHMARKS):
+        for n in args.sizes:
+            key = f"{name}/{n}"
+            if args.save_baseline:
+                result = spawn_baseline_case(name, n, args.repeat)
+            else:
+                result = spawn_case(name, n, args.repeat)
+            base = baseline.get(key)
+            notes = compare(result, base, args.threshold)
+            # 他のプロセスの負荷などで遅く出ることがあるので、回帰に見えたら別のプロセスで測り直して確かめる
+            for _ in range(CONFIRM_RUNS):
+                if not notes or args.save_baseline:
+                    break
+                retry = spawn_case(name, n, args.repeat)
+                # 時間は calibrate() と組で、メモリはそれぞれ小さいほうを残す
+                merged = dict(retry if retry['seconds'] < result['seconds'] else result)
+                peaks = [r['peak_mb'] for r in (result, retry) if r.get('peak_mb') is not None]
+                merged['peak_mb'] = min(peaks) if peaks else None
+                result = merged
+                notes = compare(result, base, args.threshold)
+            results[key] = result
+            if notes:
+                regressions.append(key)
+            if base is None:
+                missing.append(key)
+
+            def fmt(v, spec):
+                return format(v, spec) if v is not None else "-"
+            print(f"{key:<26} {fmt(result['seconds'], '10.3f')} {fmt(base and base['seconds'], '10.3f')} "
+                  f"{fmt(result['peak_mb'], '10.1f')} {fmt(base and base.get('peak_mb'), '10.1f')}"
+                  + (f"  REGRESSION ({', '.join(notes)})" if notes else "")
+                  + ("  NEW (not in baseline)" if base is None and not args.save_baseline else ""), flush=True)
+
+    if args.save_baseline:
+        saved = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                saved = json.load(f).get('cases', {})
+        saved.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': sys.version.split()[0], 'cases': dict(sorted(saved.items()))}, f, indent=2)
+            f.write("\n")
+        print(f"baseline saved: {args.baseline}")
+        return 0
+
+    if missing:
+        print(f"{len(missing)} case(s) not in baseline, not compared: {', '.join(missing)}"
+              f" (run with --save-baseline to add them)")
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
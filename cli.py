@@ -0,0 +1,101 @@
+"""
+ブラウザを使わずにZIPを生成するコマンドライン版。
+名簿ファイルと設定データ.json（UIで保存したもの）から、UIと同じドキュメントを作る。
+
+    python cli.py 名簿.xlsx 設定データ.json [-t templates] [-o 出力.zip] [-w ワーカー数] [-f docx|pdf|both]
+
+設定データにフォルダを渡すと、中の *.json をすべて一括で生成する（-o は出力先フォルダ）。
+各設定データは同じ名簿ブックの別々のシートを指していてもよい。
+
+    python cli.py 名簿.xlsx 設定フォルダ/ [-o 出力フォルダ/]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from engine import (
+    TEMPLATE_DIR, DEFAULT_SHEET_FORMAT, SHEET_FORMAT_OPTIONS, RosterSource, contest_settings_from_json,
+    generate_contest_archive, generate_contest_batch,
+)
+
+def load_contest_settings(path):
+    with open(path, encoding='utf-8') as f:
+        return contest_settings_from_json(json.load(f))
+
+def print_result(result):
+    for line in result.warnings:
+        print(f"警告: {result.contest_name}: {line}", file=sys.stderr)
+    if result.error:
+        print(f"エラー: {result.contest_name}: {result.error}", file=sys.stderr)
+    else:
+        print(f"生成完了: {result.output_path} ({result.elapsed:.2f}秒)")
+
+def batch_contests(settings_dir, output_dir):
+    """設定フォルダ内の *.json を名前順に読み、(設定, 出力先パス) の並びを返す"""
+    contests = []
+    used_paths = set()
+    for file_name in sorted(os.listdir(settings_dir)):
+        if not file_name.endswith(".json"):
+            continue
+        contest = load_contest_settings(os.path.join(settings_dir, file_name))
+        output_path = os.path.join(output_dir, f"{contest.contest_name}.zip")
+        if output_path in used_paths:
+            # コンクール名が重なる場合は設定ファイル名で区別する
+            output_path = os.path.join(output_dir, f"{contest.contest_name}_{os.path.splitext(file_name)[0]}.zip")
+        used_paths.add(output_path)
+        contests.append((contest, output_path))
+    return contests
+
+def print_batch_summary(results, wall_time):
+    print("")
+    print("--- 一括生成の結果 ---")
+    for result in results:
+        status = f"エラー: {result.error}" if result.error else "OK"
+        print(f"{result.elapsed:8.2f}秒  {result.contest_name}  {status}")
+    failed = sum(1 for r in results if r.error)
+    print(f"{len(results)}件 (エラー {failed}件)  合計 {wall_time:.2f}秒")
+
+def run_batch(args):
+    output_dir = args.output or "."
+    os.makedirs(output_dir, exist_ok=True)
+    contests = batch_contests(args.settings, output_dir)
+    roster_source = RosterSource.from_path(args.roster)
+
+    started = time.perf_counter()
+    results = []
+    for result in generate_contest_batch(roster_source, contests, args.templates, args.workers, args.format):
+        print_result(result)
+        results.append(result)
+    # 一覧は設定ファイルの順に並べる
+    order = {contest.contest_name: i for i, (contest, _) in enumerate(contests)}
+    results.sort(key=lambda r: order.get(r.contest_name, len(order)))
+    print_batch_summary(results, time.perf_counter() - started)
+    return 1 if any(r.error for r in results) else 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="名簿と設定データ.json から採点表などのZIPを生成する")
+    parser.add_argument("roster", help="名簿ファイル (.xlsx / .xls / .csv)")
+    parser.add_argument("settings", help="設定データ.json、または設定データを入れたフォルダ")
+    parser.add_argument("-t", "--templates", default=TEMPLATE_DIR, help=f"テンプレートのフォルダ (既定: {TEMPLATE_DIR})")
+    parser.add_argument("-o", "--output", help="出力するZIPのパス (既定: コンクール名.zip)。フォルダ指定時は出力先フォルダ")
+    parser.add_argument("-w", "--workers", type=int, help="並列に生成するプロセス数 (既定: CPUコア数。名簿が小さいときは1プロセスで生成する)")
+    parser.add_argument("-f", "--format", choices=list(SHEET_FORMAT_OPTIONS), default=DEFAULT_SHEET_FORMAT,
+                        help=f"採点表・受付表の出力形式。pdf はWordの代わりにPDF、both は両方 (既定: {DEFAULT_SHEET_FORMAT})")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if os.path.isdir(args.settings):
+        return run_batch(args)
+
+    contest = load_contest_settings(args.settings)
+    roster_source = RosterSource.from_path(args.roster)
+    output_path = args.output or f"{contest.contest_name}.zip"
+
+    result = generate_contest_archive(roster_source, contest, output_path, args.templates, args.workers, args.format)
+    print_result(result)
+    return 1 if result.error else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
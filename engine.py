@@ -0,0 +1,3023 @@
+"""
+コンクール資料（採点表・受付表・WEBプログラム・本日の審査員）の生成エンジン。
+Streamlitに依存しないため、生成用のワーカープロセスからも読み込める。
+"""
+import io
+import zipfile
+import re
+import os
+import copy
+import functools
+import math
+import hashlib
+import threading
+import multiprocessing
+import tempfile
+import time
+import uuid
+import base64
+import json
+import zlib
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from itertools import accumulate
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape as xml_escape
+from datetime import datetime, timedelta
+import pandas as pd
+from pandas.io.parsers import TextParser
+from openpyxl import load_workbook
+from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+from openpyxl.utils.cell import coordinate_to_tuple
+from openpyxl.worksheet._reader import WorkSheetParser, INLINE_STRING, VALUE_TAG
+from openpyxl.xml.constants import SHEET_MAIN_NS
+from docx import Document
+from docx.document import _Body
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from docx.table import _Cell
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn, nsdecls
+from lxml import etree
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfgen import canvas as pdf_canvas
+from reportlab.platypus import Table, TableStyle
+
+# ---------------------------------------------------------
+# 1. ユーティリティ
+# ---------------------------------------------------------
+
+def parse_jp_time_to_seconds(time_str):
+    if not time_str:
+        return 0
+    s = str(time_str)
+    minutes = re.search(r'(\d+)\s*[分m]', s)
+    seconds = re.search(r'(\d+)\s*[秒s]', s)
+    
+    total_sec = 0
+    if minutes:
+        total_sec += int(minutes.group(1)) * 60
+    if seconds:
+        total_sec += int(seconds.group(1))
+    return total_sec
+
+def format_seconds_to_jp_label(total_seconds):
+    if total_seconds <= 0:
+        return "0分"
+    
+    minutes = total_seconds // 60
+    remainder_seconds = total_seconds % 60
+    
+    if remainder_seconds >= 30:
+        minutes += 1
+        
+    h = minutes // 60
+    m = minutes % 60
+    
+    if h > 0:
+        return f"{h}時間{m}分"
+    else:
+        return f"{m}分"
+
+def format_time_label(text):
+    if not text:
+        return ""
+    matches = re.findall(r'(\d{1,2})[:：](\d{2})', str(text))
+    if len(matches) >= 2:
+        start_time = f"{matches[0][0]}時{matches[0][1]}分"
+        end_time = f"{matches[1][0]}時{matches[1][1]}分"
+        return f"{start_time}～{end_time}"
+    else:
+        return text
+
+def format_single_time_label(text):
+    if not text:
+        return ""
+    match = re.search(r'(\d{1,2})[:：](\d{2})', str(text))
+    if match:
+        return f"{match.group(1)}時{match.group(2)}分"
+    return text
+
+def calculate_next_day_morning(date_str):
+    if not date_str:
+        return ""
+    match = re.search(r'(\d{4})[^\d](\d{1,2})[^\d](\d{1,2})', str(date_str))
+    if match:
+        try:
+            year, month, day = map(int, match.groups())
+            dt = datetime(year, month, day)
+            next_day = dt + timedelta(days=1)
+            return next_day.strftime(f"%Y年%m月%d日10時00分")
+        except:
+            return ""
+    return ""
+
+PARTICIPANT_EXPR_CACHE_SIZE = 512
+
+class ParticipantIndex:
+    """
+    名簿(all_data)から1回だけ作る出場番号の索引。
+    対象番号の入力（例: "A01-A05, C01"）は名簿上の位置の区間に変換してLRUでメモ化し、
+    同じ入力を何度解決しても再解析しない。
+    """
+    def __init__(self, all_data):
+        self.all_data = all_data
+        self.id_map = {str(item['no']): i for i, item in enumerate(all_data)}
+        self.parse = functools.lru_cache(maxsize=PARTICIPANT_EXPR_CACHE_SIZE)(self._parse)
+        self.total_duration = functools.lru_cache(maxsize=PARTICIPANT_EXPR_CACHE_SIZE)(self._total_duration)
+        self._duration_prefix = None
+
+    def __len__(self):
+        return len(self.all_data)
+
+    def _parse(self, input_str):
+        # 戻り値: 名簿上の位置の半開区間 (start, stop) のタプル
+        spans = []
+        parts = [p.strip() for p in input_str.replace('、', ',').split(',')]
+        for part in parts:
+            if not part:
+                continue
+            if '-' in part:
+                range_parts = part.split('-')
+                if len(range_parts) == 2:
+                    start_id = range_parts[0].strip()
+                    end_id = range_parts[1].strip()
+                    if start_id in self.id_map and end_id in self.id_map:
+                        s_idx = self.id_map[start_id]
+                        e_idx = self.id_map[end_id]
+                        if s_idx > e_idx:
+                            s_idx, e_idx = e_idx, s_idx
+                        spans.append((s_idx, e_idx + 1))
+            else:
+                if part in self.id_map:
+                    idx = self.id_map[part]
+                    spans.append((idx, idx + 1))
+        return tuple(spans)
+
+    def get(self, no):
+        idx = self.id_map.get(str(no))
+        return None if idx is None else self.all_data[idx]
+
+    def resolve(self, input_str):
+        if not input_str:
+            return []
+        resolved_members = []
+        for start, stop in self.parse(input_str):
+            resolved_members.extend(self.all_data[start:stop])
+        return resolved_members
+
+    def _total_duration(self, input_str):
+        # 名簿順の演奏時間の累積和で、区間ごとの合計を出場者を並べずに求める（秒）
+        if not input_str:
+            return 0
+        if self._duration_prefix is None:
+            self._duration_prefix = list(accumulate((item.get('duration_sec', 0) for item in self.all_data), initial=0))
+        prefix = self._duration_prefix
+        return sum(prefix[stop] - prefix[start] for start, stop in self.parse(input_str))
+
+def as_participant_index(all_data):
+    # 名簿のリストか、作成済みの ParticipantIndex のどちらも受け付ける
+    if isinstance(all_data, ParticipantIndex):
+        return all_data
+    return ParticipantIndex(all_data)
+
+# start / end / planned_end は "HH:MM"（読み取れなければ None）。end は start に演奏時間の合計を足した見込み
+GroupEstimate = namedtuple('GroupEstimate', ['total_sec', 'start', 'end', 'planned_end'])
+
+def _clock_minutes(text):
+    return [int(h) * 60 + int(m) for h, m in re.findall(r'(\d{1,2})[:：](\d{2})', str(text or ""))]
+
+def _format_clock(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def estimate_group(participant_index, group):
+    """グループの演奏時間の合計と、時間欄（例: 13:00-14:00）の開始時刻から見た終了見込み"""
+    total_sec = as_participant_index(participant_index).total_duration(group.get('member_input') or "")
+    clock = _clock_minutes(group.get('time_str'))
+    if not clock:
+        return GroupEstimate(total_sec, None, None, None)
+    # 表示の「計: X分」と同じく30秒以上は切り上げる
+    end = clock[0] + (total_sec + 30) // 60
+    return GroupEstimate(total_sec, _format_clock(clock[0]), _format_clock(end),
+                         _format_clock(clock[1]) if len(clock) >= 2 else None)
+
+# --- 割り当て（グループ→出場者） ---
+
+PLAN_ISSUE_LIMIT = 20
+
+# members は名簿の出場者の辞書のタプル、time_label は帳票に載せる時刻（format_time_label の結果）
+PlannedGroup = namedtuple('PlannedGroup', ['member_input', 'time_str', 'time_label', 'members', 'total_sec'])
+# duplicates は複数回割り当てられた出場番号、unassigned はどのグループにも入っていない出場番号（名簿順）
+AssignmentPlan = namedtuple('AssignmentPlan', ['groups', 'duplicates', 'unassigned'])
+
+def build_assignment_plan(groups, participant_index):
+    """
+    グループの対象番号を1回だけ解決し、重複チェック・各帳票の生成で共通に使う割り当てを作る。
+    プロセス間で受け渡すときも名簿全体ではなく割り当てられた出場者だけを送ればよい。
+    """
+    index = as_participant_index(participant_index)
+    planned = []
+    counts = Counter()
+    assigned = set()
+    for grp in groups:
+        member_input = grp.get('member_input') or ""
+        time_str = grp.get('time_str') or ""
+        spans = index.parse(member_input) if member_input else ()
+        members = tuple(m for start, stop in spans for m in index.all_data[start:stop])
+        for start, stop in spans:
+            assigned.update(range(start, stop))
+        counts.update(m['no'] for m in members)
+        planned.append(PlannedGroup(member_input, time_str, format_time_label(time_str), members,
+                                    index.total_duration(member_input)))
+    duplicates = tuple(no for no, count in counts.items() if count > 1)
+    unassigned = tuple(item['no'] for i, item in enumerate(index.all_data) if i not in assigned)
+    return AssignmentPlan(tuple(planned), duplicates, unassigned)
+
+def as_assignment_plan(groups, all_data):
+    # 作成済みの AssignmentPlan はそのまま使う（そのとき all_data は見ない）
+    if isinstance(groups, AssignmentPlan):
+        return groups
+    return build_assignment_plan(groups, all_data)
+
+def format_plan_issues(plan):
+    if not plan.unassigned:
+        return []
+    nos = [str(no) for no in plan.unassigned]
+    text = ", ".join(nos[:PLAN_ISSUE_LIMIT])
+    if len(nos) > PLAN_ISSUE_LIMIT:
+        text += f" ほか{len(nos) - PLAN_ISSUE_LIMIT}件"
+    return [f"どのグループにも入っていない出場者: {text}"]
+
+# --- グループの自動分割 ---
+
+# 演奏時間が空欄・読み取れない出場者に見込む秒数
+DEFAULT_ENTRY_SECONDS = 300
+
+def entry_durations(all_data, default_duration_sec=DEFAULT_ENTRY_SECONDS):
+    return [d if d > 0 else default_duration_sec for d in (item.get('duration_sec') or 0 for item in all_data)]
+
+def _blocks_needed(prefix, cap):
+    # 先頭から詰めていったときの区間数（cap 以内に分けられる最少の数）。各要素は cap 以下であること
+    count, block_start = 1, 0
+    for i in range(1, len(prefix)):
+        if prefix[i] - prefix[block_start] > cap:
+            count += 1
+            block_start = i - 1
+    return count
+
+def linear_partition(durations, k):
+    """
+    durations を名簿順のまま k 個（出場者数が少なければその数）の連続した区間に分け、各区間の終わりの位置を返す。
+    区間の合計の最大は最小（二分探索）にしたうえで、各境界はできるだけ均等な位置に置く。
+    """
+    n = len(durations)
+    if n == 0:
+        return []
+    k = max(1, min(k, n))
+    prefix = list(accumulate(durations, initial=0))
+
+    lo, hi = max(durations), prefix[n]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _blocks_needed(prefix, mid) <= k:
+            hi = mid
+        else:
+            lo = mid + 1
+    cap = lo
+
+    # nxt[i]: i から始めて cap に収まる最も遠い終わり。need[i]: i 以降を cap 以内で分けるのに要る最少の区間数
+    nxt = [0] * n
+    e = 0
+    for i in range(n):
+        e = max(e, i + 1)
+        while e < n and prefix[e + 1] - prefix[i] <= cap:
+            e += 1
+        nxt[i] = e
+    need = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        need[i] = 1 + need[nxt[i]]
+
+    ends = []
+    start = 0
+    for j in range(k - 1):
+        remaining = k - j - 1
+        # 残りを remaining 個に分けられる範囲で、残りを均等に割った位置に最も近い終わりを選ぶ（need は単調減少）
+        hi_e = min(nxt[start], n - remaining)
+        lo_e, upper = start + 1, hi_e
+        while lo_e < upper:
+            mid = (lo_e + upper) // 2
+            if need[mid] <= remaining:
+                upper = mid
+            else:
+                lo_e = mid + 1
+        target = prefix[start] + (prefix[n] - prefix[start]) / (remaining + 1)
+        e = min(max(bisect_left(prefix, target, lo_e, hi_e + 1), lo_e), hi_e)
+        if e > lo_e and target - prefix[e - 1] <= prefix[e] - target:
+            e -= 1
+        ends.append(e)
+        start = e
+    ends.append(n)
+    return ends
+
+def partition_groups(participant_index, target_block_sec, start_time="", gap_sec=0,
+                     long_break_sec=0, long_break_every=0, default_duration_sec=DEFAULT_ENTRY_SECONDS):
+    """
+    名簿順のまま、1グループの演奏時間の合計が target_block_sec 以内に収まる最少の数の連続したグループに分け、
+    {'member_input', 'time_str'} のリストを返す。時刻は start_time（例: 11:00）から、グループ間に gap_sec、
+    long_break_every グループごとに gap_sec の代わりに long_break_sec の休憩を入れて計算する。
+    """
+    if target_block_sec <= 0:
+        raise ValueError("target_block_sec must be positive")
+    all_data = as_participant_index(participant_index).all_data
+    durations = entry_durations(all_data, default_duration_sec)
+    if not durations:
+        return []
+    prefix = list(accumulate(durations, initial=0))
+    # 目安に収まる最少のグループ数で、各グループの長さをできるだけそろえる
+    ends = linear_partition(durations, _blocks_needed(prefix, max(target_block_sec, max(durations))))
+
+    clock = _clock_minutes(start_time)
+    minute = clock[0] if clock else None
+    groups = []
+    start = 0
+    for j, end in enumerate(ends):
+        first, last = str(all_data[start]['no']), str(all_data[end - 1]['no'])
+        member_input = first if end - start == 1 else f"{first}-{last}"
+        time_str = ""
+        if minute is not None:
+            end_minute = minute + (prefix[end] - prefix[start] + 30) // 60
+            time_str = f"{_format_clock(minute)}-{_format_clock(end_minute)}"
+            long_break = long_break_every > 0 and (j + 1) % long_break_every == 0
+            minute = end_minute + ((long_break_sec if long_break else gap_sec) + 30) // 60
+        groups.append({'member_input': member_input, 'time_str': time_str})
+        start = end
+    return groups
+
+def resolve_participants_from_string(input_str, all_data_list):
+    if not input_str:
+        return []
+    return as_participant_index(all_data_list).resolve(input_str)
+
+# --- テンプレートキャッシュ ---
+
+TEMPLATE_DIR = "templates"
+TEMPLATE_CACHE_MAX_ENTRIES = 16
+
+class TemplateCache:
+    """
+    解析済みテンプレート(Document)をプロセス全体で共有するLRUキャッシュ。
+    パス指定は (絶対パス, 更新時刻, サイズ)、アップロードファイルは内容のハッシュをキーとする。
+    キャッシュ本体は書き換えず、呼び出し側には deepcopy したクローンを渡す。
+    クローンには読み込み時に作ったプレースホルダの位置（TemplateIndex）を template_index 属性として付ける。
+    """
+    def __init__(self, max_entries=TEMPLATE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(template_path_or_file):
+        if hasattr(template_path_or_file, 'read'):
+            if hasattr(template_path_or_file, 'getvalue'):
+                data = template_path_or_file.getvalue()
+            else:
+                template_path_or_file.seek(0)
+                data = template_path_or_file.read()
+            return ('sha1', hashlib.sha1(data).hexdigest()), data
+        path = os.path.abspath(template_path_or_file)
+        stat = os.stat(path)
+        return ('path', path, stat.st_mtime_ns, stat.st_size), None
+
+    def _load(self, template_path_or_file):
+        key, data = self.make_key(template_path_or_file)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        doc = Document(io.BytesIO(data) if data is not None else key[1])
+        entry = (doc, TemplateIndex(doc))
+
+        with self._lock:
+            if key[0] == 'path':
+                # 同じファイルの古い版（更新前のmtime）は破棄
+                for old_key in [k for k in self._entries if k[0] == 'path' and k[1] == key[1]]:
+                    del self._entries[old_key]
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def get(self, template_path_or_file):
+        doc, index = self._load(template_path_or_file)
+        clone = copy.deepcopy(doc)
+        clone.template_index = index
+        return clone
+
+    def report(self, template_path_or_file):
+        # 読み込み時の前処理（runの統合）の結果。未読込なら読み込んでキャッシュする
+        return self._load(template_path_or_file)[1].report
+
+    def warm(self, template_dir=TEMPLATE_DIR):
+        if not os.path.exists(template_dir):
+            return
+        for f in os.listdir(template_dir):
+            if f.endswith(".docx") and not f.startswith("~$"):
+                try: self._load(os.path.join(template_dir, f))
+                except Exception as e: print(f"Failed to preload template {f}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_template_cache = None
+_template_cache_lock = threading.Lock()
+
+def get_template_cache():
+    # プロセス内で1つだけ作り、最初の呼び出しで templates フォルダを事前読込する。
+    # このモジュールはimportされる側なので、Streamlitのリランでも作り直されない
+    global _template_cache
+    with _template_cache_lock:
+        if _template_cache is None:
+            _template_cache = TemplateCache()
+            _template_cache.warm(TEMPLATE_DIR)
+        return _template_cache
+
+def load_template(template_path_or_file):
+    return get_template_cache().get(template_path_or_file)
+
+def template_report(template_path_or_file):
+    return get_template_cache().report(template_path_or_file)
+
+# --- Word操作系 ---
+
+W_R = qn('w:r')
+W_T = qn('w:t')
+W_RPR = qn('w:rPr')
+W_HYPERLINK = qn('w:hyperlink')
+XML_SPACE = qn('xml:space')
+PLACEHOLDER_OPEN = "{{"
+# タブ・改行・図などw:t以外の中身の位置に置く文字。プレースホルダがこれをまたいで一致しないようにする
+_TEXT_BARRIER = "\x00"
+
+@functools.lru_cache(maxsize=64)
+def _placeholder_matcher(keys):
+    # 長いキーを先に試し、同じ位置で短いキーが一致しないようにする
+    pattern = re.compile("|".join(re.escape(k) for k in sorted(keys, key=len, reverse=True)))
+    return pattern, all(PLACEHOLDER_OPEN in k for k in keys)
+
+def _paragraph_runs(p):
+    # paragraph.text と同じく、段落直下のrunとハイパーリンク内のrunを対象にする
+    for child in p:
+        if child.tag == W_R:
+            yield child
+        elif child.tag == W_HYPERLINK:
+            yield from child.iterchildren(W_R)
+
+def _set_run_text(r, t, text):
+    """rPr と w:t 1つだけのrunの文字列を書き換える。結果は Run.text に代入したときと同じ。"""
+    if not text or '\t' in text or '\n' in text or '\r' in text:
+        # 空文字・タブ・改行はpython-docxに任せる（w:t の削除や w:tab / w:br への変換）
+        Run(r, None).text = text
+        return
+    t.text = text
+    if len(text.strip()) < len(text):
+        t.set(XML_SPACE, 'preserve')
+    else:
+        t.attrib.pop(XML_SPACE, None)
+
+def _replace_in_segments(full_text, segments, matches):
+    """
+    一致した範囲を置換した後の各w:tの文字列を返す（変わったものだけ）。
+    置換後の文字列は一致の始まりを含むw:tに入れ、後続のw:tからは一致した部分だけを取り除く。
+    """
+    changed = {}
+    mi = 0
+    for t, start, end in segments:
+        while mi < len(matches) and matches[mi][1] <= start:
+            mi += 1
+        if mi == len(matches) or matches[mi][0] >= end:
+            continue
+        pieces = []
+        cur = start
+        for ms, me, value in matches[mi:]:
+            if ms >= end:
+                break
+            if ms >= start:
+                pieces.append(full_text[cur:ms])
+                pieces.append(value)
+            cur = min(me, end)
+            if me > end:
+                break
+        pieces.append(full_text[cur:end])
+        new_text = "".join(pieces)
+        if new_text != full_text[start:end]:
+            changed[t] = new_text
+    return changed
+
+def replace_text_smart(paragraph, replacements):
+    """
+    段落内のプレースホルダを1回の走査でまとめて置換する。
+    runをまたぐプレースホルダは始まりのrunに置換後の文字列を入れ、残りのrunからはその部分だけを取り除くため、
+    他のrunの書式はそのまま残る。書き換えるのは文字列が変わるrunだけ。
+    """
+    if not replacements:
+        return
+    p = paragraph._p
+    pattern, all_braced = _placeholder_matcher(tuple(replacements))
+
+    runs = []
+    segments = []
+    parts = []
+    pos = 0
+    for r in _paragraph_runs(p):
+        run_ts = []
+        for child in r:
+            tag = child.tag
+            if tag == W_T:
+                text = child.text or ""
+                segments.append((child, pos, pos + len(text)))
+                run_ts.append(child)
+                parts.append(text)
+                pos += len(text)
+            elif tag != W_RPR:
+                parts.append(_TEXT_BARRIER)
+                pos += 1
+        if run_ts:
+            runs.append((r, run_ts))
+
+    full_text = "".join(parts)
+    if all_braced and PLACEHOLDER_OPEN not in full_text:
+        return
+    matches = [(m.start(), m.end(), str(replacements[m.group()])) for m in pattern.finditer(full_text)]
+    if not matches:
+        return
+
+    changed = _replace_in_segments(full_text, segments, matches)
+    for r, run_ts in runs:
+        if not any(t in changed for t in run_ts):
+            continue
+        if len(run_ts) == 1 and _is_simple_run(r):
+            _set_run_text(r, run_ts[0], changed[run_ts[0]])
+        else:
+            # w:t が複数ある、タブや改行を含むなどのrunは、run全体の文字列を組み立て直して Run.text に任せる
+            run = Run(r, None)
+            run.text = "".join(changed.get(e, e.text or "") if e.tag == W_T else str(e)
+                               for e in r.xpath("w:br | w:cr | w:noBreakHyphen | w:ptab | w:t | w:tab"))
+
+def fill_row_data(row, data_dict):
+    for cell in row.cells:
+        for paragraph in cell.paragraphs:
+            replace_text_smart(paragraph, data_dict)
+
+def _is_simple_run(r):
+    # rPr を除いた子要素が w:t 1つだけのrun
+    children = [c for c in r if c.tag != W_RPR]
+    return len(children) == 1 and children[0].tag == W_T
+
+class RowBuilder:
+    """
+    テンプレート行(w:tr)を複製し、差し込み済みの新しい行をlxml要素のまま作る。
+    プレースホルダを含む段落とw:tの位置は差し込むキーの組ごとに1回だけ調べておくため、
+    行を追加するたびに表全体(table.rows)を作り直したり、runを総なめしたりする必要がない。
+    """
+    def __init__(self, template_tr):
+        self.template_tr = template_tr
+        self._prepared = {}
+
+    def _prepare(self, keys):
+        prepared_tr = copy.deepcopy(self.template_tr)
+        plans = []
+        for i, p in enumerate(prepared_tr.iter(qn('w:p'))):
+            para = Paragraph(p, None)
+            full_text = para.text
+            if not any(k in full_text for k in keys):
+                continue
+
+            runs = para.runs
+            run_texts = [r.text for r in runs]
+            if any(full_text.count(k) != sum(t.count(k) for t in run_texts) for k in keys):
+                # runをまたぐプレースホルダは、テンプレート側で先に始まりのrunへ寄せておく
+                # （キーをキー自身に置換すると、replace_text_smart が1つのrunにまとめる）
+                replace_text_smart(para, {k: k for k in keys})
+                runs = para.runs
+                run_texts = [r.text for r in runs]
+                full_text = para.text
+
+            indices = [j for j, t in enumerate(run_texts) if any(k in t for k in keys)]
+            # ハイパーリンク内などにまだ残っている場合は、行ごとに replace_text_smart で置換する
+            in_runs = all(full_text.count(k) == sum(t.count(k) for t in run_texts) for k in keys)
+            if in_runs and all(_is_simple_run(runs[j]._r) for j in indices):
+                plans.append((i, indices))
+            else:
+                plans.append((i, None))
+        return prepared_tr, plans
+
+    def build(self, replacements):
+        keys = tuple(replacements)
+        if keys not in self._prepared:
+            self._prepared[keys] = self._prepare(keys)
+        prepared_tr, plans = self._prepared[keys]
+
+        new_tr = copy.deepcopy(prepared_tr)
+        if not plans:
+            return new_tr
+
+        pattern, _ = _placeholder_matcher(keys)
+        values = {k: str(v) for k, v in replacements.items()}
+        substitute = lambda m: values[m.group()]
+
+        paras = list(new_tr.iter(qn('w:p')))
+        for pos, run_indices in plans:
+            p = paras[pos]
+            if run_indices is None:
+                replace_text_smart(Paragraph(p, None), replacements)
+                continue
+
+            runs = p.findall(W_R)
+            for ri in run_indices:
+                t = runs[ri].find(W_T)
+                _set_run_text(runs[ri], t, pattern.sub(substitute, t.text or ""))
+        return new_tr
+
+    def build_many(self, replacements_list):
+        return [self.build(r) for r in replacements_list]
+
+def member_replacements(member):
+    return {
+        '{{ s.no }}': member['no'],
+        '{{ s.name }}': member['name'],
+        '{{ s.kana }}': member.get('kana', ''),
+        '{{ s.age }}': member.get('age', ''),
+        '{{ s.tel }}': member.get('tel', ''),
+        '{{ s.song }}': member['song'],
+    }
+
+def save_document(doc):
+    """
+    doc を BytesIO に保存して返す。保存にかかった秒数を save_seconds 属性に残す（計測用）。
+    保存後の doc は release_document で中身を捨てるので、呼び出し側はそれ以上使わないこと。
+    """
+    started = time.perf_counter()
+    output_buffer = io.BytesIO()
+    doc.save(output_buffer)
+    output_buffer.save_seconds = time.perf_counter() - started
+    release_document(doc)
+    return output_buffer
+
+def release_document(doc):
+    # python-docx の Document は _Body と、部品はパッケージと循環参照していて、保存時の iter_parts も
+    # 全部品を抱えた循環参照を残すため、参照カウントだけでは解放されない。
+    # 本文のXMLツリーへの参照を循環の外に出し、doc が参照されなくなった時点でlxmlのノードを解放させる
+    part = doc.part
+    part.__dict__.pop('document', None)
+    part._element = None
+    doc._Document__body = None
+
+# --- テンプレートの前処理 ---
+
+PLACEHOLDER_PATTERN = re.compile(r"\{\{.*?\}\}")
+W_PROOF_ERR = qn('w:proofErr')
+W_TAB = qn('w:tab')
+W_BR = qn('w:br')
+TEMPLATE_ISSUE_LIMIT = 20
+
+TemplateIssue = namedtuple('TemplateIssue', ['location', 'placeholder', 'reason'])
+TemplateReport = namedtuple('TemplateReport', ['merged_runs', 'moved_placeholders', 'issues'])
+
+def _is_text_run(r):
+    # rPr と w:t だけからなるrun
+    return r.find(W_T) is not None and all(c.tag in (W_T, W_RPR) for c in r)
+
+def _run_format_key(r):
+    rpr = r.find(W_RPR)
+    return b"" if rpr is None else etree.tostring(rpr)
+
+def _merge_text_runs(p):
+    """
+    段落直下で隣り合う、書式(rPr)が同じで文字列だけのrunを1つにまとめ、まとめたrunの数を返す。
+    runの間にある文章校正の印(w:proofErr)は取り除く。rsidなどrun自体の属性は先頭のrunのものを残す
+    """
+    for e in p.findall(W_PROOF_ERR):
+        p.remove(e)
+    merged = 0
+    prev = prev_key = None
+    for child in list(p):
+        if child.tag != W_R or not _is_text_run(child):
+            prev = None
+            continue
+        key = _run_format_key(child)
+        if prev is None or key != prev_key:
+            prev, prev_key = child, key
+            continue
+        ts = prev.findall(W_T)
+        text = "".join(t.text or "" for t in ts) + "".join(t.text or "" for t in child.iterchildren(W_T))
+        for t in ts[1:]:
+            prev.remove(t)
+        ts[0].text = text
+        if len(text.strip()) < len(text):
+            ts[0].set(XML_SPACE, 'preserve')
+        else:
+            ts[0].attrib.pop(XML_SPACE, None)
+        p.remove(child)
+        merged += 1
+    return merged
+
+def _split_placeholders(p, text):
+    run_texts = [Run(r, None).text for r in _paragraph_runs(p)]
+    return [k for k in dict.fromkeys(PLACEHOLDER_PATTERN.findall(text))
+            if text.count(k) != sum(t.count(k) for t in run_texts)]
+
+def normalize_template_paragraph(paragraph):
+    """
+    プレースホルダが1つのrunに収まるよう段落を整える。
+    戻り値は (まとめたrunの数, 始まりのrunへ寄せたプレースホルダの数, [(プレースホルダ, 理由)])。
+    """
+    p = paragraph._p
+    # テキストボックスなど入れ子の段落も含めた、この段落のXML上の文字列（w:tabs内のタブ位置の指定は除く）
+    raw_text = "".join((e.text or "") if e.tag == W_T else ("\t" if e.tag == W_TAB else "\n")
+                       for e in p.iter(W_T, W_TAB, W_BR) if e.tag == W_T or e.getparent().tag == W_R)
+    if PLACEHOLDER_OPEN not in raw_text:
+        return 0, 0, []
+
+    merged = _merge_text_runs(p)
+    text = paragraph.text
+    split = _split_placeholders(p, text)
+    if split:
+        # キーをキー自身に置換すると、replace_text_smart が始まりのrunにまとめる
+        replace_text_smart(paragraph, {k: k for k in split})
+        text = paragraph.text
+    still_split = _split_placeholders(p, text)
+    problems = [(k, "複数のrunに分かれたまま") for k in still_split]
+    # テキストボックス・フィールド・変更履歴の中などは paragraph.text に現れず、差し込まれない
+    visible = set(PLACEHOLDER_PATTERN.findall(text))
+    problems.extend((k, "差し込みの対象外の位置（テキストボックス・フィールド・変更履歴など）")
+                    for k in dict.fromkeys(PLACEHOLDER_PATTERN.findall(raw_text)) if k not in visible)
+    return merged, len(split) - len(still_split), problems
+
+def format_template_issues(report):
+    lines = [f"{issue.location}: {issue.placeholder}（{issue.reason}）" for issue in report.issues[:TEMPLATE_ISSUE_LIMIT]]
+    if len(report.issues) > TEMPLATE_ISSUE_LIMIT:
+        lines.append(f"ほか{len(report.issues) - TEMPLATE_ISSUE_LIMIT}件")
+    return lines
+
+HEADER_FOOTER_ATTRS = ('header', 'first_page_header', 'even_page_header',
+                       'footer', 'first_page_footer', 'even_page_footer')
+
+def _element_path(root, el):
+    # root から el までの子要素の番号の並び。deepcopy したクローンでも同じ要素を指す
+    path = []
+    while el is not root:
+        parent = el.getparent()
+        path.append(parent.index(el))
+        el = parent
+    return tuple(reversed(path))
+
+def _element_at(root, path):
+    el = root
+    for i in path:
+        el = el[i]
+    return el
+
+def _table_row_text(row):
+    return "".join([c.text for c in row.cells])
+
+class TemplateIndex:
+    """
+    テンプレート内のプレースホルダの位置。テンプレートの読み込み時に1回だけ作り、
+    差し込みと各生成処理の目印（{{ time }} / {{ s.* }} の行など）探しはここに載っている要素だけを見る。
+    位置は本文（document.xml）またはヘッダー・フッターの部品ごとに、ルート要素からのパスで持つ。
+    作るときに各段落を normalize_template_paragraph で整え、その結果を report に残す。
+    """
+    def __init__(self, doc):
+        body_root = doc.element
+        # doc.paragraphs などを使うと Document が本文の参照を持ったままになり、deepcopy したクローンが
+        # 別の本文を指してしまうので、その場限りの _Body を通して読む
+        body = _Body(body_root.body, doc)
+        # 差し込み対象の段落: (部品のrId（本文はNone）, パス, 本文かどうか)
+        self.paragraphs = []
+        # プレースホルダのない本文の段落: (パス, テキスト)。WEBプログラムの太字処理用
+        self.static_body_paragraphs = []
+        # 本文直下の段落のうちプレースホルダを含むもの: (パス, テキスト)
+        self.body_paragraphs = []
+        # 本文直下の表: (表のパス, [(行のパス, 行のテキスト)])。行はプレースホルダを含むものだけ
+        self.tables = []
+        seen = set()
+        merged_runs = moved_placeholders = 0
+        issues = []
+
+        def add_paragraph(part_id, root, paragraph, location):
+            nonlocal merged_runs, moved_placeholders
+            path = _element_path(root, paragraph._p)
+            if (part_id, path) in seen:
+                return
+            seen.add((part_id, path))
+            merged, moved, problems = normalize_template_paragraph(paragraph)
+            merged_runs += merged
+            moved_placeholders += moved
+            issues.extend(TemplateIssue(location, k, reason) for k, reason in problems)
+            in_body = location != "ヘッダー・フッター"
+            text = paragraph.text
+            if PLACEHOLDER_OPEN in text:
+                self.paragraphs.append((part_id, path, in_body))
+            elif in_body and text:
+                self.static_body_paragraphs.append((path, text))
+
+        for paragraph in body.paragraphs:
+            add_paragraph(None, body_root, paragraph, "本文")
+            if PLACEHOLDER_OPEN in paragraph.text:
+                self.body_paragraphs.append((_element_path(body_root, paragraph._p), paragraph.text))
+        for table in body.tables:
+            rows = []
+            for row in table.rows:
+                for cell in row.cells:
+                    for paragraph in cell.paragraphs:
+                        add_paragraph(None, body_root, paragraph, "本文の表")
+                row_text = _table_row_text(row)
+                if PLACEHOLDER_OPEN in row_text:
+                    rows.append((_element_path(body_root, row._tr), row_text))
+            self.tables.append((_element_path(body_root, table._tbl), rows))
+
+        # ヘッダー・フッターは定義がなければpython-docxが空の定義を追加する。
+        # 以前は差し込みのたびにクローン側で起きていたので、同じ順番でここで1回だけ起こしておく
+        part_ids = {rel.target_part: r_id for r_id, rel in doc.part.rels.items() if not rel.is_external}
+        for section in doc.sections:
+            for attr in HEADER_FOOTER_ATTRS:
+                container = getattr(section, attr)
+                part = container._get_or_add_definition()
+                part_id = part_ids.get(part)
+                if part_id is None:
+                    part_ids = {rel.target_part: r_id for r_id, rel in doc.part.rels.items() if not rel.is_external}
+                    part_id = part_ids[part]
+                for paragraph in container.paragraphs:
+                    add_paragraph(part_id, part.element, paragraph, "ヘッダー・フッター")
+                for table in container.tables:
+                    for row in table.rows:
+                        for cell in row.cells:
+                            for paragraph in cell.paragraphs:
+                                add_paragraph(part_id, part.element, paragraph, "ヘッダー・フッター")
+
+        self.report = TemplateReport(merged_runs, moved_placeholders, issues)
+
+    @staticmethod
+    def _part_root(doc, part_id):
+        return doc.element if part_id is None else doc.part.related_parts[part_id].element
+
+    def replace(self, doc, replacements, body_paragraph_hook=None, static_hook_values=()):
+        """
+        doc は読み込み時のテンプレートのクローン（構造を変える前のもの）。
+        static_hook_values を含むプレースホルダなしの本文段落にも body_paragraph_hook を呼ぶ
+        """
+        roots = {}
+        for part_id, path, in_body in self.paragraphs:
+            root = roots.get(part_id)
+            if root is None:
+                root = roots[part_id] = self._part_root(doc, part_id)
+            paragraph = Paragraph(_element_at(root, path), doc._body)
+            replace_text_smart(paragraph, replacements)
+            if in_body and body_paragraph_hook: body_paragraph_hook(paragraph)
+
+        if body_paragraph_hook and static_hook_values:
+            for path, text in self.static_body_paragraphs:
+                if any(val in text for val in static_hook_values):
+                    body_paragraph_hook(Paragraph(_element_at(doc.element, path), doc._body))
+
+    def find_table_rows(self, doc, keys, last=False):
+        """
+        keys のそれぞれを含む行がそろう最初の本文の表を探し、(表の要素, [行の要素]) を返す。
+        同じキーを含む行が複数あれば、last=True なら最後の行、そうでなければ最初の行を使う
+        """
+        for table_path, rows in self.tables:
+            found = {}
+            for row_path, row_text in rows:
+                for key in keys:
+                    if key in row_text and (last or key not in found):
+                        found[key] = row_path
+            if len(found) == len(keys):
+                return (_element_at(doc.element, table_path),
+                        [_element_at(doc.element, found[key]) for key in keys])
+        return None
+
+    def find_table(self, doc, key):
+        for table_path, rows in self.tables:
+            if any(key in row_text for _, row_text in rows):
+                return _element_at(doc.element, table_path)
+        return None
+
+    def find_body_paragraph(self, doc, key):
+        for path, text in self.body_paragraphs:
+            if key in text:
+                return Paragraph(_element_at(doc.element, path), doc._body)
+        return None
+
+def template_index_for(doc):
+    # キャッシュを通さずに開いたDocumentはその場で作る（ヘッダー・フッターの定義の追加もここで起きる）
+    index = getattr(doc, 'template_index', None)
+    if index is None:
+        index = doc.template_index = TemplateIndex(doc)
+    return index
+
+def replace_text_in_document_full(doc, replacements, body_paragraph_hook=None, static_hook_values=()):
+    # body_paragraph_hook: 本文・本文の表の段落ごとに、置換の直後に呼ばれる（ヘッダー/フッターは対象外）
+    template_index_for(doc).replace(doc, replacements, body_paragraph_hook, static_hook_values)
+
+# ---------------------------------------------------------
+# 2. ドキュメント生成ロジック
+# ---------------------------------------------------------
+
+def generate_word_from_template(template_path_or_file, groups, all_data, global_context):
+    # groups は AssignmentPlan か、グループの辞書のリスト（その場合は all_data の名簿で解決する）
+    doc = load_template(template_path_or_file)
+    plan = as_assignment_plan(groups, all_data)
+    
+    global_replacements = {}
+    for k, v in global_context.items():
+        global_replacements[f"{{{{ {k} }}}}"] = v
+    replace_text_in_document_full(doc, global_replacements)
+
+    # 時刻行と出場者行の両方を持つ最初の表（テンプレート読み込み時に調べた位置）
+    anchors = template_index_for(doc).find_table_rows(doc, ("{{ time }}", "{{ s.no }}"), last=True)
+    
+    if anchors:
+        tbl, (time_tr, data_tr) = anchors
+        
+        tbl.remove(time_tr)
+        tbl.remove(data_tr)
+
+        time_builder = RowBuilder(time_tr)
+        data_builder = RowBuilder(data_tr)
+        
+        for group in plan.groups:
+            new_rows = [time_builder.build({'{{ time }}': group.time_label})]
+            new_rows.extend(data_builder.build_many(member_replacements(m) for m in group.members))
+
+            # グループ分の行をまとめて組み立ててから一度に追加する
+            tbl.extend(new_rows)
+
+    return save_document(doc)
+
+# 審査員名の差し込み位置を示す目印（私用領域の文字なのでテンプレート本文と衝突しない）
+JUDGE_NAME_SENTINEL_OPEN = "\ue000"
+JUDGE_NAME_SENTINEL_CLOSE = "\ue001"
+JUDGE_NAME_SENTINEL = f"{JUDGE_NAME_SENTINEL_OPEN}judge_name{JUDGE_NAME_SENTINEL_CLOSE}"
+
+class JudgeSheetStamper:
+    """
+    採点表の本体（グループ・出場者の表）を1回だけ組み立て、
+    保存済みXMLの審査員名の箇所だけを差し替えて審査員ごとの出力を作る。
+    judges を渡し、そのどれも差し替えで作れない（can_stamp）ときは、本体を組まずに通常の生成だけをする。
+    """
+    def __init__(self, template_path_or_file, groups, all_data, global_context, judges=None):
+        self.template_path_or_file = template_path_or_file
+        self.plan = as_assignment_plan(groups, all_data)
+        self.global_context = global_context
+        self.save_seconds = 0.0
+        self._base_bytes = None
+        if judges is None or any(self.can_stamp(judge) for judge in judges):
+            self._prepare()
+
+    def _prepare(self):
+        template_path_or_file = self.template_path_or_file
+        if hasattr(template_path_or_file, 'seek'): template_path_or_file.seek(0)
+        context = self.global_context.copy(); context['judge_name'] = JUDGE_NAME_SENTINEL
+        base_io = generate_word_from_template(template_path_or_file, self.plan, None, context)
+        self.save_seconds = base_io.save_seconds
+
+        # 審査員名を含まない部品（本文の大きな表を含む document.xml など）は1回だけ圧縮しておき、
+        # 審査員ごとには審査員名を含む部品だけを追記する
+        sentinel_bytes = JUDGE_NAME_SENTINEL.encode('utf-8')
+        self._stamped_members = []
+        base_buffer = io.BytesIO()
+        with zipfile.ZipFile(base_io, 'r') as zin, zipfile.ZipFile(base_buffer, 'w') as zbase:
+            for info in zin.infolist():
+                segments = zin.read(info).split(sentinel_bytes)
+                if len(segments) > 1:
+                    self._stamped_members.append((info, segments))
+                else:
+                    zbase.writestr(self._copy_info(info), segments[0])
+        self._base_bytes = base_buffer.getvalue()
+
+    @staticmethod
+    def _copy_info(info):
+        new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+        new_info.compress_type = info.compress_type
+        new_info.external_attr = info.external_attr
+        return new_info
+
+    @staticmethod
+    def can_stamp(judge_name):
+        # タブ・改行はpython-docxが別要素に変換するため、通常の生成に回す。目印の区切り文字を含む名前も同様。
+        # 前後に空白のある名前は、差し替え先の w:t に xml:space="preserve" がなく Word が空白を落とすので通常の生成に回す
+        judge_name = str(judge_name)
+        return judge_name == judge_name.strip() and all(
+            ord(c) >= 0x20 and c not in (JUDGE_NAME_SENTINEL_OPEN, JUDGE_NAME_SENTINEL_CLOSE) for c in judge_name)
+
+    def render(self, judge_name):
+        if not self.can_stamp(judge_name):
+            if hasattr(self.template_path_or_file, 'seek'): self.template_path_or_file.seek(0)
+            context = self.global_context.copy(); context['judge_name'] = judge_name
+            return generate_word_from_template(self.template_path_or_file, self.plan, None, context)
+
+        if self._base_bytes is None:
+            self._prepare()
+        judge_bytes = xml_escape(str(judge_name)).encode('utf-8')
+        output_buffer = io.BytesIO(self._base_bytes)
+        if self._stamped_members:
+            with zipfile.ZipFile(output_buffer, 'a') as zout:
+                for info, segments in self._stamped_members:
+                    zout.writestr(self._copy_info(info), judge_bytes.join(segments))
+        output_buffer.seek(0)
+        return output_buffer
+
+WEB_PROGRAM_ROWS_PER_ENTRY = 2
+
+_BOLD_RUN_XML = parse_xml(f'<w:r {nsdecls("w")}><w:rPr><w:b/></w:rPr></w:r>')
+_PLAIN_RUN_XML = parse_xml(f'<w:r {nsdecls("w")}><w:rPr><w:b w:val="0"/></w:rPr></w:r>')
+
+def _make_run_xml(text, bold):
+    # paragraph.add_run(text) + run.font.bold = bold と同じw:rを、python-docxを介さずに作る
+    r = copy.deepcopy(_BOLD_RUN_XML if bold else _PLAIN_RUN_XML)
+    text = str(text)
+    if '\t' in text or '\n' in text or '\r' in text:
+        Run(r, None).text = text
+    elif text:
+        t = etree.SubElement(r, qn('w:t'))
+        t.text = text
+        if len(text.strip()) < len(text):
+            t.set(qn('xml:space'), 'preserve')
+    return r
+
+def _prepare_web_program_row(tr):
+    """
+    データ行を複製し、出場番号・氏名・曲目を書き込むセルをあらかじめ空にしておく（cell.text = "" と同じ）。
+    戻り値は (準備済みの行, [(セル番号, 書き込む項目)])。
+    """
+    prepared_tr = copy.deepcopy(tr)
+    plan = []
+    for idx, tc in enumerate(prepared_tr.findall(qn('w:tc'))):
+        cell = _Cell(tc, None)
+        cell_text = cell.text
+        kinds = [k for k in ('no', 'name', 'song') if f"{{{{ s.{k} }}}}" in cell_text]
+        if kinds:
+            cell.text = ""
+            # 複数の項目を含むセルは、最後の項目で上書きされる
+            plan.append((idx, kinds[-1]))
+    return prepared_tr, plan
+
+def _web_program_runs(kind, member):
+    if kind == 'no':
+        return [_make_run_xml(member['no'], True)]
+    if kind == 'name':
+        runs = [_make_run_xml(member['name'], True), _make_run_xml(" （", False)]
+        if member.get('kana'):
+            runs.append(_make_run_xml(member['kana'], False))
+        runs.append(_make_run_xml("・", False))
+        runs.append(_make_run_xml(member.get('age', ''), False))
+        runs.append(_make_run_xml("歳）", False))
+        return runs
+    return [_make_run_xml(member['song'], False)]
+
+def generate_web_program_doc(template_path_or_file, groups, all_data, global_context):
+    doc = load_template(template_path_or_file)
+    plan = as_assignment_plan(groups, all_data)
+    
+    global_replacements = {}
+    for k, v in global_context.items():
+        global_replacements[f"{{{{ {k} }}}}"] = v
+    
+    bold_target_values = [
+        global_context.get('contest_name', ''),
+        global_context.get('contest_date', ''),
+        global_context.get('contest_hall', '')
+    ]
+    bold_target_values = [v for v in bold_target_values if v]
+
+    def bold_targets(para):
+        for run in para.runs:
+            if any(val in run.text for val in bold_target_values):
+                run.font.bold = True
+
+    # 差し込みと同じ走査で、大会名・日付・会場を含むrunを太字にする
+    replace_text_in_document_full(doc, global_replacements, body_paragraph_hook=bold_targets if bold_target_values else None,
+                                  static_hook_values=bold_target_values)
+
+    index = template_index_for(doc)
+    template_time_para = index.find_body_paragraph(doc, "{{ time }}")
+            
+    if template_time_para:
+        template_data_tbl = index.find_table(doc, "{{ s.no }}")
+        
+        if template_data_tbl is not None:
+            template_p_xml = copy.deepcopy(template_time_para._p)
+            template_tbl_xml = copy.deepcopy(template_data_tbl)
+            
+            parent_body = template_time_para._element.getparent()
+            if parent_body is not None: parent_body.remove(template_time_para._p)
+            
+            parent_tbl = template_data_tbl.getparent()
+            if parent_tbl is not None: parent_tbl.remove(template_data_tbl)
+            
+            data_tr_list = []
+            header_tr_list = []
+            temp_rows = list(template_tbl_xml.iter(qn('w:tr')))
+            start_index = -1
+
+            for i, tr in enumerate(temp_rows):
+                text_content = "".join([t.text or "" for t in tr.iter(qn('w:t'))])
+                if "{{ s.no }}" in text_content:
+                    start_index = i
+                    break
+                else:
+                    header_tr_list.append(tr)
+
+            if start_index != -1:
+                end_index = min(start_index + WEB_PROGRAM_ROWS_PER_ENTRY, len(temp_rows))
+                data_tr_list = temp_rows[start_index : end_index]
+            
+            for tr in temp_rows: tr.getparent().remove(tr)
+
+            data_row_plans = [_prepare_web_program_row(tr) for tr in data_tr_list]
+
+            # グループ間の空段落は全グループ共通なので1回だけ作っておく
+            blank_p_xml = copy.deepcopy(template_p_xml)
+            Paragraph(blank_p_xml, None).text = ""
+            
+            doc_body = doc._body._element
+            
+            for group in plan.groups:
+                new_p_xml = copy.deepcopy(template_p_xml)
+                replace_text_smart(Paragraph(new_p_xml, doc._body), {'{{ time }}': group.time_label})
+                doc_body.append(new_p_xml)
+                
+                new_tbl_xml = copy.deepcopy(template_tbl_xml)
+                for h_tr in header_tr_list: new_tbl_xml.append(copy.deepcopy(h_tr))
+                
+                for member in group.members:
+                    for tr_template, cell_plan in data_row_plans:
+                        new_tr = copy.deepcopy(tr_template)
+                        tcs = new_tr.findall(qn('w:tc'))
+                        for idx, kind in cell_plan:
+                            tcs[idx].find(qn('w:p')).extend(_web_program_runs(kind, member))
+                        new_tbl_xml.append(new_tr)
+
+                doc_body.append(new_tbl_xml)
+                doc_body.append(copy.deepcopy(blank_p_xml))
+
+    return save_document(doc)
+
+def generate_judges_list_doc(template_path_or_file, judges_list, global_context):
+    doc = load_template(template_path_or_file)
+    global_replacements = {}
+    for k, v in global_context.items():
+        global_replacements[f"{{{{ {k} }}}}"] = v
+    replace_text_in_document_full(doc, global_replacements)
+
+    index = template_index_for(doc)
+    anchors = index.find_table_rows(doc, ("{{ judge_name }}",))
+    if anchors:
+        tbl, (tr_xml,) = anchors
+        tbl.remove(tr_xml)
+        row_builder = RowBuilder(tr_xml)
+        tbl.extend(row_builder.build_many({'{{ judge_name }}': judge} for judge in judges_list))
+        return save_document(doc)
+
+    target_para = index.find_body_paragraph(doc, "{{ judge_name }}")
+            
+    if target_para:
+        p_element = target_para._p
+        parent = target_para._parent
+        template_p_xml = copy.deepcopy(p_element)
+        
+        if hasattr(parent, '_element'):
+             try: parent._element.remove(p_element)
+             except: pass
+        else:
+             try: doc._body._body.remove(p_element)
+             except: pass
+        
+        for judge in judges_list:
+            new_p_xml = copy.deepcopy(template_p_xml)
+            doc._body._body.append(new_p_xml)
+            new_para = Paragraph(new_p_xml, parent)
+            replace_text_smart(new_para, {'{{ judge_name }}': judge})
+
+    return save_document(doc)
+
+# --- PDF（採点表・受付表） ---
+# Wordを経由せず、割り当てから直接PDFの表を組む。
+# 文字は日本語のCIDフォント（PDFに埋め込まず、閲覧側の同名フォントで表示する）で描く
+
+PDF_FONT = "HeiseiKakuGo-W5"
+PDF_FONT_SIZE = 9
+PDF_LEADING = 11
+PDF_TITLE_FONT_SIZE = 10.5
+PDF_CELL_PADDING = 3
+# 用紙と余白はWordテンプレートと同じ（上の余白にタイトルを置く）
+PDF_PAGE_SIZE = A4
+PDF_MARGIN = 12.7 * mm
+PDF_MARGIN_TOP = 30 * mm
+PDF_TITLE_DISTANCE = 15 * mm
+PDF_HEADER_FILL = colors.HexColor("#E8A7E0")
+PDF_TIME_ROW_FILL = colors.HexColor("#E8E8E8")
+PDF_HEADER_FORM = "sheet_header"
+
+# (列見出し, 幅mm, 出場者の値のキー)。キーが None の列は記入欄として空けておく
+PDF_SHEET_COLUMNS = {
+    'score': (("番号", 12.3, 'no'), ("氏名", 37.5, 'name'), ("年齢", 13.5, 'age'),
+              ("曲目", 74.2, 'song'), ("採点", 14.1, None), ("修正・メモ", 33.1, None)),
+    'reception': (("受付", 9.8, 'check'), ("番号", 14.8, 'no'), ("氏名", 37.5, 'name'),
+                  ("年齢", 13.5, 'age'), ("曲目", 84.2, 'song'), ("電話番号", 25.0, 'tel')),
+}
+PDF_SHEET_TITLES = {'score': "{contest_name}：{judge_name}先生", 'reception': "{contest_name}：受付表"}
+# 折り返さずに1行で載せる値。列の幅に収まらなければ、その列の文字を一番長い値が収まる大きさまで小さくする
+PDF_ONE_LINE_KEYS = ('no', 'age', 'tel', 'check')
+PDF_MIN_FONT_SIZE = 5
+
+_PDF_BASE_STYLE = [
+    ('FONT', (0, 0), (-1, -1), PDF_FONT, PDF_FONT_SIZE, PDF_LEADING),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('LEFTPADDING', (0, 0), (-1, -1), PDF_CELL_PADDING),
+    ('RIGHTPADDING', (0, 0), (-1, -1), PDF_CELL_PADDING),
+    ('TOPPADDING', (0, 0), (-1, -1), PDF_CELL_PADDING),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), PDF_CELL_PADDING),
+]
+
+@functools.lru_cache(maxsize=None)
+def register_pdf_font(name=PDF_FONT):
+    # 登録はプロセスごとに1回だけでよい
+    pdfmetrics.registerFont(UnicodeCIDFont(name))
+    return name
+
+def _pdf_member_values(member):
+    return {
+        'no': member['no'], 'name': f"{member['name']} {member.get('kana', '')}", 'age': member.get('age', ''),
+        'song': member['song'], 'tel': member.get('tel', ''), 'check': "□",
+    }
+
+def _wrap_pdf_text(text, width):
+    """
+    text を幅 width（pt）に収まるよう折り返した行のリストを返す。
+    日本語は空白で区切れないので1文字単位で折り返し、行に空白があればそこで折り返す（「氏名 カナ」など）。
+    """
+    lines = []
+    for raw in str(text).splitlines() or [""]:
+        if pdfmetrics.stringWidth(raw, PDF_FONT, PDF_FONT_SIZE) <= width:
+            lines.append(raw)
+            continue
+        line, line_width = "", 0.0
+        for ch in raw:
+            ch_width = pdfmetrics.stringWidth(ch, PDF_FONT, PDF_FONT_SIZE)
+            if line and line_width + ch_width > width:
+                cut = line.rfind(" ")
+                if cut > 0:
+                    lines.append(line[:cut])
+                    line = line[cut + 1:]
+                else:
+                    lines.append(line)
+                    line = ""
+                line_width = pdfmetrics.stringWidth(line, PDF_FONT, PDF_FONT_SIZE)
+            line += ch
+            line_width += ch_width
+        lines.append(line)
+    return lines
+
+def _fit_pdf_font_size(values, width):
+    text_width = max((pdfmetrics.stringWidth(str(v), PDF_FONT, PDF_FONT_SIZE) for v in values), default=0.0)
+    if text_width <= width:
+        return PDF_FONT_SIZE
+    return max(PDF_MIN_FONT_SIZE, math.floor(PDF_FONT_SIZE * width / text_width * 10) / 10)
+
+def _pdf_row_height(line_count):
+    return line_count * PDF_LEADING + 2 * PDF_CELL_PADDING
+
+def _new_pdf_canvas(output_buffer):
+    # invariant にすると作成日時などが入らず、同じ入力からは同じバイト列になる。
+    # 最初にフォントを設定して、どのキャンバスでもPDF内のフォント名（/F2 など）が同じになるようにする
+    c = pdf_canvas.Canvas(output_buffer, pagesize=PDF_PAGE_SIZE, invariant=1)
+    c.setFont(PDF_FONT, PDF_FONT_SIZE)
+    return c
+
+class PdfSheetLayout:
+    """
+    採点表・受付表のPDFの表をページ単位に割り付け、各ページの描画命令を1回だけ作っておく。
+    審査員ごとの採点表はタイトルだけが違うので、同じレイアウトから render で書き出す。
+    タイトルと列見出しの行は各ページで同じなので、PDFのフォームとして1回だけ描いて全ページから参照する。
+    """
+    def __init__(self, kind, groups, all_data, global_context):
+        register_pdf_font()
+        self.kind = kind
+        self.plan = as_assignment_plan(groups, all_data)
+        self.global_context = global_context
+        columns = PDF_SHEET_COLUMNS[kind]
+        self.col_widths = [width * mm for _, width, _ in columns]
+        self.header_table = Table([[label for label, _, _ in columns]], colWidths=self.col_widths,
+                                  rowHeights=[_pdf_row_height(1)],
+                                  style=TableStyle(_PDF_BASE_STYLE + [('BACKGROUND', (0, 0), (-1, -1), PDF_HEADER_FILL),
+                                                                      ('ALIGN', (0, 0), (-1, -1), 'CENTER')]))
+        self.header_table.wrap(sum(self.col_widths), PDF_MARGIN_TOP)
+        self.body_top = PDF_PAGE_SIZE[1] - PDF_MARGIN_TOP - _pdf_row_height(1)
+        text_widths = [width - 2 * PDF_CELL_PADDING for width in self.col_widths]
+        members = [_pdf_member_values(m) for group in self.plan.groups for m in group.members]
+        self.font_sizes = [_fit_pdf_font_size((v[key] for v in members), width) if key in PDF_ONE_LINE_KEYS else PDF_FONT_SIZE
+                           for (_, _, key), width in zip(columns, text_widths)]
+        pages = self._paginate(self._rows(columns, text_widths), self.body_top - PDF_MARGIN)
+        self.page_contents = self._record_pages(pages)
+        self.save_seconds = 0.0
+
+    def _rows(self, columns, text_widths):
+        # (セルの値のリスト, 行の高さ, 時刻行か)
+        time_height = _pdf_row_height(1)
+        for group in self.plan.groups:
+            yield [group.time_label] + [""] * (len(columns) - 1), time_height, True
+            for member in group.members:
+                values = _pdf_member_values(member)
+                cells = []
+                line_count = 1
+                for (_, _, key), width in zip(columns, text_widths):
+                    if key in PDF_ONE_LINE_KEYS:
+                        lines = [str(values[key])]
+                    else:
+                        lines = _wrap_pdf_text(values[key], width) if key else [""]
+                    line_count = max(line_count, len(lines))
+                    cells.append("\n".join(lines))
+                yield cells, _pdf_row_height(line_count), False
+
+    @staticmethod
+    def _paginate(rows, body_height):
+        # 時刻行がページの最後に取り残されないよう、次の出場者の行とひとまとまりにして割り付ける
+        blocks = []
+        pending = None
+        for row in rows:
+            if row[2]:
+                if pending is not None:
+                    blocks.append(pending)
+                pending = [row]
+            elif pending is not None:
+                pending.append(row)
+                blocks.append(pending)
+                pending = None
+            else:
+                blocks.append([row])
+        if pending is not None:
+            blocks.append(pending)
+
+        pages = []
+        page, used = [], 0.0
+        for block in blocks:
+            height = sum(row[1] for row in block)
+            if page and used + height > body_height:
+                pages.append(page)
+                page, used = [], 0.0
+            page.extend(block)
+            used += height
+        pages.append(page)
+        return pages
+
+    def _page_table(self, rows):
+        style = list(_PDF_BASE_STYLE)
+        for col, size in enumerate(self.font_sizes):
+            if size != PDF_FONT_SIZE:
+                style.append(('FONTSIZE', (col, 0), (col, -1), size))
+        for i, (_, _, is_time) in enumerate(rows):
+            if is_time:
+                style.append(('SPAN', (0, i), (-1, i)))
+                style.append(('BACKGROUND', (0, i), (-1, i), PDF_TIME_ROW_FILL))
+                style.append(('FONTSIZE', (0, i), (-1, i), PDF_FONT_SIZE))
+        return Table([cells for cells, _, _ in rows], colWidths=self.col_widths,
+                     rowHeights=[height for _, height, _ in rows], style=TableStyle(style))
+
+    def _record_pages(self, pages):
+        # 表とページ番号は審査員によらず同じなので、作業用のキャンバスに描いた命令列をページごとに残す
+        page_width = PDF_PAGE_SIZE[0]
+        c = _new_pdf_canvas(io.BytesIO())
+        contents = []
+        for number, rows in enumerate(pages, 1):
+            if rows:
+                table = self._page_table(rows)
+                _, height = table.wrap(sum(self.col_widths), self.body_top)
+                table.drawOn(c, PDF_MARGIN, self.body_top - height)
+            c.setFont(PDF_FONT, PDF_FONT_SIZE)
+            c.drawCentredString(page_width / 2, PDF_MARGIN / 2, f"{number} / {len(pages)}")
+            contents.append(c.getCurrentPageContent())
+            c.showPage()
+        return contents
+
+    def title(self, judge_name=None):
+        context = dict(self.global_context)
+        if judge_name is not None:
+            context['judge_name'] = judge_name
+        return PDF_SHEET_TITLES[self.kind].format_map(context)
+
+    def render(self, judge_name=None):
+        """PDFを BytesIO に書き出して返す。保存にかかった秒数を save_seconds 属性に残す（計測用）"""
+        page_width, page_height = PDF_PAGE_SIZE
+        title = self.title(judge_name)
+        output_buffer = io.BytesIO()
+        c = _new_pdf_canvas(output_buffer)
+        c.setTitle(title)
+
+        c.beginForm(PDF_HEADER_FORM)
+        c.setFont(PDF_FONT, PDF_TITLE_FONT_SIZE)
+        c.drawRightString(page_width - PDF_MARGIN, page_height - PDF_TITLE_DISTANCE - PDF_TITLE_FONT_SIZE, title)
+        self.header_table.drawOn(c, PDF_MARGIN, self.body_top)
+        c.endForm()
+
+        for content in self.page_contents:
+            c.doForm(PDF_HEADER_FORM)
+            c.addLiteral(content)
+            c.showPage()
+
+        started = time.perf_counter()
+        c.save()
+        output_buffer.save_seconds = time.perf_counter() - started
+        output_buffer.seek(0)
+        return output_buffer
+
+def generate_pdf_sheet(kind, groups, all_data, global_context, judge_name=None):
+    # kind は 'score' か 'reception'
+    return PdfSheetLayout(kind, groups, all_data, global_context).render(judge_name)
+
+# ---------------------------------------------------------
+# 3. 並列生成
+# ---------------------------------------------------------
+
+# ワーカープロセス数。未設定なら使えるCPUコア数、1以下なら同じプロセスで順に生成する
+RENDER_WORKERS_ENV = "BIPCA_RENDER_WORKERS"
+# プールが起動していないとき、割り当てられた出場者の行数（タスクの合計）がこれ未満なら同じプロセスで生成する。
+# 未設定なら、ワーカーの起動にかかる時間を並列にして縮む時間で取り戻せる行数を、使えるコア数から求める（render_pool_min_rows）
+RENDER_POOL_MIN_ROWS_ENV = "BIPCA_RENDER_POOL_MIN_ROWS"
+# spawn でのワーカー1つの起動（pandas・python-docx などの読み込み）にかかる秒数と、
+# 同じプロセスで生成するときの1行あたりの秒数の目安（採点表・受付表・WEBプログラムの平均）
+RENDER_POOL_STARTUP_SECONDS = 0.6
+RENDER_SECONDS_PER_ROW = 0.0002
+
+# プロセス間で受け渡すため、テンプレートはパス（文字列）かファイル内容（bytes）で持つ（PDFの帳票では None）。
+# plan は AssignmentPlan（審査員リストでは None）で、名簿全体ではなく割り当てられた出場者だけを送る。
+# RenderOutput.data は保存済みの BytesIO（エラー時は None）。
+# RenderOutput.metrics は生成・保存の秒数とサイズの辞書（エラー時は None）
+RenderTask = namedtuple('RenderTask', ['kind', 'label', 'template', 'plan', 'context', 'judges'])
+RenderOutput = namedtuple('RenderOutput', ['label', 'judge', 'arcname', 'data', 'error', 'metrics'], defaults=(None,))
+
+RENDER_ARCNAMES = {
+    'reception': "受付表.docx",
+    'reception_pdf': "受付表.pdf",
+    'web': "WEBプログラム.docx",
+    'judges_list': "本日の審査員.docx",
+}
+# 審査員ごとに1ファイルずつ作る種類
+JUDGE_SHEET_KINDS = ('score', 'score_pdf')
+
+# 採点表・受付表の出力形式。'pdf' ではWordの代わりにPDFを、'both' では両方を書き込む
+SHEET_FORMAT_OPTIONS = {'docx': "Word", 'pdf': "PDF", 'both': "WordとPDF"}
+DEFAULT_SHEET_FORMAT = 'docx'
+
+def render_arcname(kind, judge=None):
+    if kind == 'score':
+        return f"採点表_{judge}.docx"
+    if kind == 'score_pdf':
+        return f"採点表_{judge}.pdf"
+    return RENDER_ARCNAMES[kind]
+
+def template_source(template_path_or_file):
+    if hasattr(template_path_or_file, 'read'):
+        if hasattr(template_path_or_file, 'getvalue'):
+            return template_path_or_file.getvalue()
+        template_path_or_file.seek(0)
+        return template_path_or_file.read()
+    return template_path_or_file
+
+def _open_template_source(source):
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+def build_render_tasks(groups, all_data, judges, base_context,
+                       score_template=None, reception_template=None, web_template=None, judges_list_template=None,
+                       sheet_format=DEFAULT_SHEET_FORMAT):
+    # groups は AssignmentPlan か、グループの辞書のリスト（その場合は all_data の名簿で解決する）。
+    # 採点表・受付表のPDF（sheet_format）はテンプレートを使わずに組むので、template は None になる
+    if sheet_format not in SHEET_FORMAT_OPTIONS:
+        raise ValueError(f"unknown sheet format: {sheet_format}")
+    with_docx = sheet_format != 'pdf'
+    with_pdf = sheet_format != 'docx'
+    plan = as_assignment_plan(groups, all_data)
+    judges = list(judges)
+    tasks = []
+    if score_template and judges:
+        if with_docx:
+            tasks.append(RenderTask('score', '採点表', template_source(score_template), plan, dict(base_context), judges))
+        if with_pdf:
+            tasks.append(RenderTask('score_pdf', '採点表PDF', None, plan, dict(base_context), judges))
+    if reception_template:
+        context = base_context.copy(); context['judge_name'] = '受付用'
+        if with_docx:
+            tasks.append(RenderTask('reception', '受付表', template_source(reception_template), plan, context, None))
+        if with_pdf:
+            tasks.append(RenderTask('reception_pdf', '受付表PDF', None, plan, context, None))
+    if web_template:
+        context = base_context.copy(); context['judge_name'] = ''
+        tasks.append(RenderTask('web', 'WEBプログラム', template_source(web_template), plan, context, None))
+    if judges_list_template:
+        tasks.append(RenderTask('judges_list', '本日の審査員', template_source(judges_list_template), None, dict(base_context), judges))
+    return tasks
+
+def _render_metrics(started, doc_io, save_seconds=None, **fields):
+    if save_seconds is None:
+        save_seconds = getattr(doc_io, 'save_seconds', 0.0)
+    return {'seconds': time.perf_counter() - started, 'save_seconds': save_seconds,
+            'bytes': doc_io.getbuffer().nbytes, **fields}
+
+def render_task(task):
+    """1タスク分を生成して RenderOutput のリストを返す。プロセスプールのワーカーから呼ばれる。"""
+    template = _open_template_source(task.template)
+
+    if task.kind in JUDGE_SHEET_KINDS:
+        started = time.perf_counter()
+        try:
+            if task.kind == 'score':
+                stamper = JudgeSheetStamper(template, task.plan, None, task.context, task.judges)
+            else:
+                stamper = PdfSheetLayout('score', task.plan, None, task.context)
+        except Exception as e:
+            return [RenderOutput(task.label, None, None, None, str(e))]
+        # 本体の組み立てと保存は1回だけなので、最初の審査員の分に含めて記録する
+        prepare_seconds = time.perf_counter() - started
+        outputs = []
+        for i, judge in enumerate(task.judges):
+            started = time.perf_counter()
+            try:
+                doc_io = stamper.render(judge)
+                save_seconds = getattr(doc_io, 'save_seconds', 0.0) if task.kind == 'score_pdf' else 0.0
+                metrics = _render_metrics(started, doc_io, save_seconds + (stamper.save_seconds if i == 0 else 0.0))
+                if i == 0:
+                    metrics['seconds'] += prepare_seconds
+                outputs.append(RenderOutput(task.label, judge, render_arcname(task.kind, judge), doc_io, None, metrics))
+            except Exception as e:
+                outputs.append(RenderOutput(task.label, judge, None, None, str(e)))
+        return outputs
+
+    started = time.perf_counter()
+    try:
+        if task.kind == 'reception':
+            doc_io = generate_word_from_template(template, task.plan, None, task.context)
+        elif task.kind == 'reception_pdf':
+            doc_io = generate_pdf_sheet('reception', task.plan, None, task.context)
+        elif task.kind == 'web':
+            doc_io = generate_web_program_doc(template, task.plan, None, task.context)
+        elif task.kind == 'judges_list':
+            doc_io = generate_judges_list_doc(template, task.judges, task.context)
+        else:
+            raise ValueError(f"unknown render task: {task.kind}")
+        return [RenderOutput(task.label, None, render_arcname(task.kind), doc_io, None, _render_metrics(started, doc_io))]
+    except Exception as e:
+        return [RenderOutput(task.label, None, None, None, str(e))]
+
+def write_render_outputs(zf, tasks, max_workers=None, doc_cache=None):
+    """
+    生成したドキュメントを終わったものから zf のエントリへ直接書き込み、RenderOutput を返す。
+    docx自体はZIP形式で書き込み先のseekが必要なため BytesIO に保存し、そのバッファをコピーせずに書き込む。
+    エントリの圧縮方式は zip_member_compression で決める。
+    doc_cache（DocumentCache）を渡すと、入力が前回と同じドキュメントは生成せずキャッシュから書き込む。
+    """
+    outputs = iter_render_outputs(tasks, max_workers) if doc_cache is None else iter_cached_render_outputs(tasks, doc_cache, max_workers)
+    for output in outputs:
+        if output.error is None:
+            started = time.perf_counter()
+            write_zip_member(zf, output.arcname, output.data.getbuffer())
+            if output.metrics is not None:
+                output.metrics['zip_seconds'] = time.perf_counter() - started
+            output = output._replace(data=None)
+        yield output
+
+def default_render_workers():
+    value = os.environ.get(RENDER_WORKERS_ENV)
+    if value:
+        return max(1, int(value))
+    return available_cpus()
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+def render_pool_min_rows(workers):
+    """
+    起動していないプールを workers 個の仕事のために起動してよい行数。1コアでは並列にならないので None（起動しない）。
+    同時に動くワーカーは起動も並列に進むので、起動の時間はおよそ1つ分になる。
+    """
+    value = os.environ.get(RENDER_POOL_MIN_ROWS_ENV)
+    if value:
+        return max(0, int(value))
+    cores = min(workers, available_cpus())
+    if cores <= 1:
+        return None
+    return int(RENDER_POOL_STARTUP_SECONDS / (RENDER_SECONDS_PER_ROW * (1 - 1 / cores)))
+
+def plan_rows(plan):
+    # 帳票の行数の目安。審査員リストのように割り当てを使わないものは0
+    if plan is None:
+        return 0
+    return sum(len(g.members) for g in plan.groups)
+
+_render_pool = None
+_render_pool_workers = 0
+_render_pool_lock = threading.Lock()
+
+def use_render_pool(max_workers, jobs, rows):
+    """
+    jobs 個の仕事（合計 rows 行）をプロセスプールで並列に生成するか。
+    同じワーカー数のプールが起動済みならそれを使い、なければ起動の時間を取り戻せる行数があるときだけ起動する。
+    """
+    if max_workers <= 1 or jobs <= 1:
+        return False
+    with _render_pool_lock:
+        if _render_pool is not None and _render_pool_workers == max_workers:
+            return True
+    min_rows = render_pool_min_rows(min(max_workers, jobs))
+    return min_rows is not None and rows >= min_rows
+
+def get_render_pool(max_workers):
+    # ワーカーのテンプレートキャッシュを活かすため、プールは使い回す。
+    # Streamlitのサーバーはスレッドを持つので、forkではなくspawnで起動する
+    global _render_pool, _render_pool_workers
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool_workers != max_workers:
+            if _render_pool is not None:
+                _render_pool.shutdown(wait=False)
+            _render_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _render_pool_workers = max_workers
+        return _render_pool
+
+def _warm_render_worker():
+    # ワーカーを起動させ、テンプレートを事前読込する
+    get_template_cache()
+
+def warm_render_pool(max_workers=None):
+    """
+    並列に生成するときのプロセスプールを先に起動しておく（Streamlitのサーバーで、最初の生成を待たせないため）。
+    起動は待たずに戻る。ワーカーが1つ以下か、1コアで並列にならないときは何もしない。
+    """
+    if max_workers is None:
+        max_workers = default_render_workers()
+    if max_workers <= 1 or available_cpus() <= 1:
+        return None
+    with _render_pool_lock:
+        if _render_pool is not None and _render_pool_workers == max_workers:
+            return _render_pool
+    pool = get_render_pool(max_workers)
+    # プールはワーカーを必要なだけ起動するので、全員が起動するようワーカーの数だけ投げる
+    for _ in range(max_workers):
+        pool.submit(_warm_render_worker)
+    return pool
+
+def split_judge_tasks(tasks, workers):
+    """
+    プールで生成するとき、審査員ごとの帳票を最大 workers 個のタスクに分け、ワーカーに振り分けられるようにする。
+    PDFの採点表は審査員ごとに1枚ずつ組むので、審査員を均等に分ける。
+    Wordの採点表は本体を1回組んで審査員名だけを差し替えるため、差し替えで作れる審査員は1つのタスクにまとめたまま、
+    通常の生成に回る審査員（JudgeSheetStamper.can_stamp）の分だけを分ける。
+    """
+    def chunks(judges, n):
+        n = max(1, min(n, len(judges)))
+        size, extra = divmod(len(judges), n)
+        start = 0
+        for i in range(n):
+            end = start + size + (1 if i < extra else 0)
+            yield judges[start:end]
+            start = end
+
+    split = []
+    for task in tasks:
+        if task.kind not in JUDGE_SHEET_KINDS or workers <= 1 or len(task.judges) <= 1:
+            split.append(task)
+        elif task.kind == 'score_pdf':
+            split.extend(task._replace(judges=judges) for judges in chunks(task.judges, workers))
+        else:
+            stamped = [j for j in task.judges if JudgeSheetStamper.can_stamp(j)]
+            rendered = [j for j in task.judges if not JudgeSheetStamper.can_stamp(j)]
+            if stamped:
+                split.append(task._replace(judges=stamped))
+            if rendered:
+                split.extend(task._replace(judges=judges) for judges in chunks(rendered, workers - (1 if stamped else 0)))
+    return split
+
+def _discard_render_pool(pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+def iter_render_outputs(tasks, max_workers=None):
+    """
+    タスクをプロセスプールで並列に生成し、終わったものから順に RenderOutput を返す。
+    審査員ごとの帳票はワーカーに振り分けられるよう分ける（split_judge_tasks）。
+    max_workers が1以下、タスクが1つ以下、またはプールを起動するほどの行数がなければ（use_render_pool）
+    同じプロセスで順に生成する。
+    """
+    if max_workers is None:
+        max_workers = default_render_workers()
+    pool_tasks = split_judge_tasks(tasks, max_workers)
+    if not use_render_pool(max_workers, len(pool_tasks), sum(plan_rows(task.plan) for task in tasks)):
+        for task in tasks:
+            yield from render_task(task)
+        return
+
+    pool = get_render_pool(max_workers)
+    futures = {pool.submit(render_task, task): task for task in pool_tasks}
+    for future in as_completed(futures):
+        task = futures[future]
+        try:
+            outputs = future.result()
+        except BrokenProcessPool as e:
+            _discard_render_pool(pool)
+            outputs = [RenderOutput(task.label, None, None, None, f"ワーカープロセスが異常終了しました: {e}")]
+        except Exception as e:
+            outputs = [RenderOutput(task.label, None, None, None, str(e))]
+        yield from outputs
+
+# --- ディスク上のキャッシュの共通処理 ---
+
+def private_directory(path):
+    """
+    path を本人だけが読み書きできるディレクトリ（0o700）として用意する。
+    出場者の個人情報を含むファイルを置くので、他のユーザーが持っているディレクトリは使わない（OSError）。
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        st = os.stat(path)
+        if st.st_uid != os.getuid():
+            raise OSError(f"他のユーザーのディレクトリは使えません: {path}")
+        if st.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+def default_cache_directory(name):
+    # 一時フォルダの下に、ユーザーごとのディレクトリを作る
+    if hasattr(os, 'getuid'):
+        name = f"{name}_{os.getuid()}"
+    return os.path.join(tempfile.gettempdir(), name)
+
+def scan_cache_files(directory, suffixes):
+    """directory の suffixes の付いたファイルと書きかけの一時ファイル（.tmp）を (更新時刻, サイズ, 名前, パス) で返す"""
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(tuple(suffixes) + (".tmp",)):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.name, entry.path))
+    return entries
+
+def evict_cache_files(directory, suffixes, max_bytes, ttl_seconds, keep_name=None):
+    """
+    最後に使われてから（更新時刻から）ttl_seconds たったファイルと、合計サイズが max_bytes を超えた分を古いものから消し、
+    消したファイルの数（一時ファイルを除く）を返す。keep_name（書き終えたばかりのファイル）は上限を超えていても消さない。
+    """
+    now = time.time()
+    kept = []
+    removed = 0
+    for mtime, size, name, path in scan_cache_files(directory, suffixes):
+        # 書きかけの一時ファイルは、書き込み中のものを消さないよう期限切れのときだけ片付ける
+        expired = now - mtime > ttl_seconds
+        if name.endswith(".tmp") and not expired:
+            continue
+        if expired and name != keep_name:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if not name.endswith(".tmp"):
+                removed += 1
+            continue
+        if not name.endswith(".tmp"):
+            kept.append((mtime, size, name, path))
+
+    kept.sort()
+    total = sum(size for _, size, _, _ in kept)
+    for _, size, name, path in kept:
+        if total <= max_bytes:
+            break
+        if name == keep_name:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+# --- 生成済みドキュメントのキャッシュ ---
+
+# "0" にすると生成済みドキュメントのキャッシュを使わない
+DOCUMENT_CACHE_ENV = "BIPCA_DOC_CACHE"
+DOCUMENT_CACHE_DIR_ENV = "BIPCA_DOC_CACHE_DIR"
+DOCUMENT_CACHE_MB_ENV = "BIPCA_DOC_CACHE_MB"
+DOCUMENT_CACHE_TTL_ENV = "BIPCA_DOC_CACHE_TTL_HOURS"
+DOCUMENT_CACHE_DEFAULT_MB = 512
+DOCUMENT_CACHE_DEFAULT_TTL_HOURS = 24
+# 生成結果が変わる修正をしたときに上げる（engine.py 自体の内容もキーに含めている）
+DOCUMENT_CACHE_VERSION = 1
+
+class DocumentCache:
+    """
+    生成済みドキュメント（docx・PDF）のディスクキャッシュ。入力（テンプレート・グループ・名簿・差し込み値）のハッシュを
+    ファイル名にするので、セッションやプロセス（CLIの一括生成のワーカーを含む）をまたいで共有できる。
+    出場者の個人情報を含むため、本人だけが読めるディレクトリに置き、ArtifactStore と同じく
+    最後に使われてから ttl_seconds たったものと、合計サイズが max_bytes を超えた分を古いものから消す。
+    """
+    SUFFIXES = (".docx", ".pdf")
+
+    def __init__(self, directory, max_bytes, ttl_seconds):
+        self.directory = private_directory(directory)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+    def _path(self, key, suffix):
+        if suffix not in self.SUFFIXES:
+            raise ValueError(f"unknown document suffix: {suffix}")
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix):
+        path = self._path(key, suffix)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl_seconds:
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 最後に使った時刻として更新時刻を進める
+            os.utime(path)
+        except OSError:
+            return None
+        return io.BytesIO(data)
+
+    def put(self, key, suffix, doc_io):
+        path = self._path(key, suffix)
+        # 書きかけのファイルを他のプロセスが読まないよう、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(doc_io.getbuffer())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to store rendered document: {e}")
+            try: os.remove(tmp_path)
+            except OSError: pass
+            return
+        self.evict(keep_name=os.path.basename(path))
+
+    def evict(self, keep_name=None):
+        return evict_cache_files(self.directory, self.SUFFIXES, self.max_bytes, self.ttl_seconds, keep_name)
+
+    def clear(self):
+        for _, _, name, path in scan_cache_files(self.directory, self.SUFFIXES):
+            try: os.remove(path)
+            except OSError: pass
+
+_document_cache = None
+_document_cache_lock = threading.Lock()
+
+def get_document_cache():
+    # 無効（BIPCA_DOC_CACHE=0）なら None。ディレクトリは BIPCA_DOC_CACHE_DIR、上限は BIPCA_DOC_CACHE_MB、
+    # 保管期間は BIPCA_DOC_CACHE_TTL_HOURS で変えられる
+    global _document_cache
+    if os.environ.get(DOCUMENT_CACHE_ENV, "1") == "0":
+        return None
+    with _document_cache_lock:
+        if _document_cache is None:
+            directory = os.environ.get(DOCUMENT_CACHE_DIR_ENV) or default_cache_directory("bipca_doc_cache")
+            max_mb = float(os.environ.get(DOCUMENT_CACHE_MB_ENV) or DOCUMENT_CACHE_DEFAULT_MB)
+            ttl_hours = float(os.environ.get(DOCUMENT_CACHE_TTL_ENV) or DOCUMENT_CACHE_DEFAULT_TTL_HOURS)
+            try:
+                _document_cache = DocumentCache(directory, int(max_mb * 1024 * 1024), ttl_hours * 3600)
+                # 前回の起動で残った期限切れのドキュメントを片付ける
+                _document_cache.evict()
+            except OSError as e:
+                print(f"Document cache disabled: {e}")
+                return None
+        return _document_cache
+
+@functools.lru_cache(maxsize=1)
+def _engine_digest():
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+@functools.lru_cache(maxsize=64)
+def _template_file_digest(path, mtime_ns, size):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _template_digest(source):
+    if isinstance(source, bytes):
+        return hashlib.sha256(source).hexdigest()
+    path = os.path.abspath(source)
+    stat = os.stat(path)
+    return _template_file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+def _json_digest(value):
+    payload = json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def render_document_keys(task, plan_digests=None):
+    """
+    task が作る各ドキュメントのキャッシュキーを [(審査員名（採点表以外は None）, キー)] で返す。
+    割り当て（出場者を含む各グループ）のハッシュは plan_digests に AssignmentPlan の id ごとに残し、
+    同じ割り当てを共有するタスク間で使い回す。
+    """
+    if plan_digests is None:
+        plan_digests = {}
+    plan_digest = None
+    if task.plan is not None:
+        plan_digest = plan_digests.get(id(task.plan))
+        if plan_digest is None:
+            # 重複・未割り当ての一覧は出力に影響しないので含めない
+            plan_digest = plan_digests[id(task.plan)] = _json_digest(task.plan.groups)
+    template_digest = _template_digest(task.template) if task.template is not None else None
+    base = [DOCUMENT_CACHE_VERSION, _engine_digest(), task.kind, template_digest, plan_digest]
+    if task.kind in JUDGE_SHEET_KINDS:
+        return [(judge, _json_digest(base + [{**task.context, 'judge_name': judge}])) for judge in task.judges]
+    return [(None, _json_digest(base + [task.context, task.judges]))]
+
+def iter_cached_render_outputs(tasks, doc_cache, max_workers=None):
+    """
+    iter_render_outputs と同じだが、入力が前回と同じドキュメントは doc_cache から返し、残りだけを生成する。
+    採点表は審査員ごとに調べ、キャッシュにない審査員の分だけを生成する。生成したものはキャッシュに入れる。
+    """
+    plan_digests = {}
+    pending_keys = {}
+    pending_tasks = []
+    for task in tasks:
+        started = time.perf_counter()
+        try:
+            doc_keys = render_document_keys(task, plan_digests)
+        except (OSError, TypeError, ValueError) as e:
+            # テンプレートが読めないなどはキャッシュを通さずに生成し、エラーはそちらで返す
+            print(f"Document cache skipped for {task.label}: {e}")
+            pending_tasks.append(task)
+            continue
+        missing = []
+        for judge, key in doc_keys:
+            data = doc_cache.get(key, os.path.splitext(render_arcname(task.kind, judge))[1])
+            if data is None:
+                missing.append(judge)
+                pending_keys[(task.label, judge)] = key
+                continue
+            metrics = {'seconds': time.perf_counter() - started, 'save_seconds': 0.0,
+                       'bytes': data.getbuffer().nbytes, 'cached': True}
+            started = time.perf_counter()
+            yield RenderOutput(task.label, judge, render_arcname(task.kind, judge), data, None, metrics)
+        if missing:
+            pending_tasks.append(task._replace(judges=missing) if task.kind in JUDGE_SHEET_KINDS else task)
+
+    for output in iter_render_outputs(pending_tasks, max_workers):
+        key = pending_keys.get((output.label, output.judge))
+        if output.error is None and key is not None:
+            doc_cache.put(key, os.path.splitext(output.arcname)[1], output.data)
+        yield output
+
+# ---------------------------------------------------------
+# 4. 出力ZIP
+# ---------------------------------------------------------
+
+# --- エントリごとの圧縮 ---
+
+# 圧縮するエントリの圧縮レベル（0〜9）
+ZIP_LEVEL_ENV = "BIPCA_ZIP_LEVEL"
+ZIP_DEFAULT_LEVEL = 6
+# 中身が圧縮済みでZIPではほとんど縮まない形式は、圧縮せずに格納する。
+# 生成したdocx・PDFも中は圧縮済みだが、表の行の繰り返しが多く、ZIPでさらに3〜8割縮むので圧縮する
+ZIP_STORED_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif', '.zip')
+# 同梱ファイルは最初に1回圧縮してみて、これより縮まなければ以後は圧縮せずに格納する（元のサイズに対する割合）
+ZIP_ASSET_MIN_SAVING = 0.1
+
+def zip_compress_level():
+    value = os.environ.get(ZIP_LEVEL_ENV)
+    return min(9, max(0, int(value))) if value else ZIP_DEFAULT_LEVEL
+
+def zip_member_compression(arcname):
+    """arcname のエントリを書き込むときの (compress_type, compresslevel)"""
+    if arcname.lower().endswith(ZIP_STORED_SUFFIXES):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, zip_compress_level()
+
+def write_zip_member(zf, arcname, data, compression=None):
+    # data は bytes / str / memoryview（BytesIO.getbuffer() をコピーせずに渡せる）
+    compress_type, compresslevel = compression or zip_member_compression(arcname)
+    zf.writestr(arcname, data, compress_type=compress_type, compresslevel=compresslevel)
+
+# --- 同梱ファイル ---
+
+# templates/ からそのままZIPに入れるファイル
+STATIC_ASSET_SUFFIXES = (".pdf",)
+# compression は write_zip_member に渡す (compress_type, compresslevel)
+StaticAsset = namedtuple('StaticAsset', ['arcname', 'data', 'compression'])
+
+def _asset_compression(arcname, data):
+    compression = zip_member_compression(arcname)
+    if compression[0] == zipfile.ZIP_STORED or not data:
+        return compression
+    compressor = zlib.compressobj(compression[1], zlib.DEFLATED, -15)
+    compressed_size = len(compressor.compress(data)) + len(compressor.flush())
+    if compressed_size > len(data) * (1 - ZIP_ASSET_MIN_SAVING):
+        return zipfile.ZIP_STORED, None
+    return compression
+
+class StaticAssetCache:
+    """
+    templates/ のPDFなど、どのZIPにも同じ内容で入れるファイルをプロセス全体で持っておく。
+    中身の読み込みと圧縮するかどうかの判定はファイルごとに1回だけ行い、更新時刻・サイズが変わったら読み直す。
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+        with open(path, 'rb') as f:
+            data = f.read()
+        arcname = os.path.basename(path)
+        asset = StaticAsset(arcname, data, _asset_compression(arcname, data))
+        with self._lock:
+            self._entries[path] = (key, asset)
+        return asset
+
+    def assets(self, template_dir=TEMPLATE_DIR):
+        """template_dir の同梱ファイルを StaticAsset のリストで返す（消えたファイルの分は手放す）"""
+        if not os.path.exists(template_dir):
+            return []
+        paths = [os.path.abspath(os.path.join(template_dir, f)) for f in os.listdir(template_dir)
+                 if f.endswith(STATIC_ASSET_SUFFIXES)]
+        directory = os.path.abspath(template_dir)
+        with self._lock:
+            for path in [p for p in self._entries if os.path.dirname(p) == directory and p not in paths]:
+                del self._entries[path]
+        assets = []
+        for path in paths:
+            try:
+                assets.append(self.get(path))
+            except OSError as e:
+                print(f"Failed to read static asset {path}: {e}")
+        return assets
+
+_static_asset_cache = None
+_static_asset_cache_lock = threading.Lock()
+
+def get_static_asset_cache():
+    global _static_asset_cache
+    with _static_asset_cache_lock:
+        if _static_asset_cache is None:
+            _static_asset_cache = StaticAssetCache()
+        return _static_asset_cache
+
+# --- メモリ・一時ファイル上のZIP ---
+
+# これを超えるとZIPをメモリではなく一時ファイルに置く
+OUTPUT_SPOOL_MAX_MEMORY = 32 * 1024 * 1024
+
+class SpooledArchive:
+    """
+    生成したZIPの置き場所。一定サイズまではメモリ、超えると一時ファイルに書き出す。
+    ダウンロードとメール送信が別スレッドから読むことがあるため、読み出しはロックで直列化する。
+    """
+    def __init__(self, max_memory=OUTPUT_SPOOL_MAX_MEMORY):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self.lock = threading.Lock()
+
+    def open_zip(self, compression=zipfile.ZIP_DEFLATED):
+        # 書き込み用。生成処理の中でだけ使う
+        self.file.seek(0)
+        self.file.truncate()
+        return zipfile.ZipFile(self.file, 'w', compression)
+
+    @property
+    def size(self):
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            return self.file.tell()
+
+    def read(self):
+        with self.lock:
+            self.file.seek(0)
+            return self.file.read()
+
+    def namelist(self):
+        with self.lock:
+            self.file.seek(0)
+            with zipfile.ZipFile(self.file, 'r') as zf:
+                return zf.namelist()
+
+    def base64_lines(self):
+        with self.lock:
+            self.file.seek(0)
+            return _base64_lines(self.file)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def _base64_lines(f, chunk_size=57 * 1024):
+    # email.encoders.encode_base64 と同じ形式（76文字ごとに改行）を、全体を一度に読まずに作る
+    encoded = []
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        encoded.append(base64.encodebytes(chunk).decode('ascii'))
+    return "".join(encoded)
+
+# --- 生成済みZIPの保管場所 ---
+
+ARTIFACT_STORE_DIR_ENV = "BIPCA_ARTIFACT_DIR"
+ARTIFACT_STORE_MB_ENV = "BIPCA_ARTIFACT_MB"
+ARTIFACT_STORE_TTL_ENV = "BIPCA_ARTIFACT_TTL_HOURS"
+ARTIFACT_STORE_DEFAULT_MB = 1024
+ARTIFACT_STORE_DEFAULT_TTL_HOURS = 24
+RUN_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# items / bytes は今ある件数と合計サイズ、hits / misses / evictions はこのプロセスで数えた回数
+ArtifactStoreStats = namedtuple('ArtifactStoreStats', ['items', 'bytes', 'hits', 'misses', 'evictions'])
+
+class StoredArchive:
+    """
+    ArtifactStore に置いた1回分のZIP。SpooledArchive と同じように読み書きできるが、中身はディスクにだけ置き、
+    読むたびにファイルを開く（消されたあとは FileNotFoundError になる）。
+    """
+    def __init__(self, store, run_id):
+        self.store = store
+        self.run_id = run_id
+        self.path = store._path(run_id)
+
+    @contextmanager
+    def open_zip(self, compression=zipfile.ZIP_DEFLATED):
+        # 書き込み用。書きかけのZIPを読まれないよう一時ファイルに書き、書き終えてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.store.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w+b') as f, zipfile.ZipFile(f, 'w', compression) as zf:
+                yield zf
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+        self.store.evict(keep=self.run_id)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def namelist(self):
+        with zipfile.ZipFile(self.path, 'r') as zf:
+            return zf.namelist()
+
+    def base64_lines(self):
+        with open(self.path, 'rb') as f:
+            return _base64_lines(f)
+
+    def close(self):
+        # ファイルは保管場所が消すので、ここでは何もしない
+        pass
+
+class ArtifactStore:
+    """
+    生成したZIPを実行ID（run_id）ごとにディスクに置く。セッションには run_id だけを持たせ、
+    ダウンロードやメール送信のたびにここから読む。
+    最後に使われてから ttl_seconds たったものと、合計サイズが max_bytes を超えた分を古いものから消す。
+    """
+    SUFFIX = ".zip"
+
+    def __init__(self, directory, max_bytes, ttl_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        private_directory(directory)
+
+    def _path(self, run_id):
+        return os.path.join(self.directory, run_id + self.SUFFIX)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def create(self):
+        """新しい run_id の書き込み先を返す。open_zip で書き終えた時点で保管される"""
+        return StoredArchive(self, uuid.uuid4().hex)
+
+    def contains(self, run_id):
+        # 表示用。使った回数にも最後に使った時刻にも数えない
+        if not run_id or not RUN_ID_PATTERN.fullmatch(run_id):
+            return False
+        try:
+            return time.time() - os.stat(self._path(run_id)).st_mtime <= self.ttl_seconds
+        except OSError:
+            return False
+
+    def get(self, run_id):
+        """run_id のZIPを返す。ないか保管期間を過ぎていれば None"""
+        if not self.contains(run_id):
+            self._count('misses')
+            return None
+        try:
+            # 最後に使った時刻として更新時刻を進める
+            os.utime(self._path(run_id))
+        except OSError:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return StoredArchive(self, run_id)
+
+    def read(self, run_id):
+        archive = self.get(run_id)
+        if archive is None:
+            raise FileNotFoundError(f"生成済みのZIPが見つかりません: {run_id}")
+        return archive.read()
+
+    def evict(self, keep=None):
+        # keep（書き終えたばかりの run_id）は上限を超えていても消さない
+        removed = evict_cache_files(self.directory, (self.SUFFIX,), self.max_bytes, self.ttl_seconds,
+                                    keep + self.SUFFIX if keep else None)
+        if removed:
+            self._count('evictions', removed)
+
+    def stats(self):
+        items = [(size, name) for _, size, name, _ in scan_cache_files(self.directory, (self.SUFFIX,))
+                 if name.endswith(self.SUFFIX)]
+        with self._lock:
+            counts = dict(self._counts)
+        return ArtifactStoreStats(len(items), sum(size for size, _ in items),
+                                  counts.get('hits', 0), counts.get('misses', 0), counts.get('evictions', 0))
+
+_artifact_store = None
+_artifact_store_lock = threading.Lock()
+
+def get_artifact_store():
+    # ディレクトリは BIPCA_ARTIFACT_DIR、上限は BIPCA_ARTIFACT_MB、保管期間は BIPCA_ARTIFACT_TTL_HOURS で変えられる。
+    # ディレクトリを作れなければ None（呼び出し側はメモリの SpooledArchive を使う）
+    global _artifact_store
+    with _artifact_store_lock:
+        if _artifact_store is None:
+            directory = os.environ.get(ARTIFACT_STORE_DIR_ENV) or default_cache_directory("bipca_artifacts")
+            max_mb = float(os.environ.get(ARTIFACT_STORE_MB_ENV) or ARTIFACT_STORE_DEFAULT_MB)
+            ttl_hours = float(os.environ.get(ARTIFACT_STORE_TTL_ENV) or ARTIFACT_STORE_DEFAULT_TTL_HOURS)
+            try:
+                _artifact_store = ArtifactStore(directory, int(max_mb * 1024 * 1024), ttl_hours * 3600)
+                # 前回の起動で残った期限切れのZIPを片付ける
+                _artifact_store.evict()
+            except OSError as e:
+                print(f"Artifact store disabled: {e}")
+                return None
+        return _artifact_store
+
+# ---------------------------------------------------------
+# 5. 名簿読み込み
+# ---------------------------------------------------------
+
+ROSTER_CACHE_MAX_ENTRIES = 32
+ROSTER_OPTIONAL_COLUMN = "(なし)"
+# 割り当てが必須の列
+ROSTER_REQUIRED_COLUMNS = ('col_no', 'col_name', 'col_song')
+
+class RosterCache:
+    """
+    名簿ファイルの解析結果をリラン・セッションをまたいで共有するLRUキャッシュ。
+    キーは (種類, ファイル内容のハッシュ, ...) のタプルで、
+    ('book', digest) / ('workbook', digest) / ('frame', digest, シート名) / ('columns', digest, シート名) /
+    ('roster', digest, シート名, 列の割り当て) を格納する。
+    """
+    def __init__(self, max_entries=ROSTER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        value = loader()
+
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, digest):
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == digest]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# 「3分30秒」「3m30s」の分・秒をそれぞれ独立に最初の一致から取り出す（parse_jp_time_to_seconds と同じ規則）
+DURATION_EXTRACT_PATTERN = r'(?s)^(?=(?:.*?(\d+)\s*[分m])?)(?=(?:.*?(\d+)\s*[秒s])?)'
+ROSTER_ISSUE_LIMIT = 20
+
+def _column_as_str(df, col):
+    # 1セルずつ str() した結果と同じ（astype(str) は欠損値をそのまま残すため map を使う）
+    return df[col].map(str)
+
+def normalize_roster_frame(df, col_map):
+    """
+    名簿のDataFrameを列単位でまとめて変換し、(all_data, issues) を返す。
+    issues には出場番号の重複、氏名の空欄、読み取れない演奏時間をExcelの行番号で記録する。
+    空のシートのように必須の列が割り当てられていない（None）か見つからないときは、空の名簿を返す。
+    """
+    if any(col_map.get(key) is None or col_map[key] not in df.columns for key in ROSTER_REQUIRED_COLUMNS):
+        return [], {'duplicate_nos': [], 'empty_name_rows': [], 'bad_duration_rows': []}
+
+    def optional_column(key):
+        col = col_map.get(key, ROSTER_OPTIONAL_COLUMN)
+        return col if col in df.columns else ROSTER_OPTIONAL_COLUMN
+
+    def optional(key):
+        col = optional_column(key)
+        if col == ROSTER_OPTIONAL_COLUMN:
+            return pd.Series([""] * len(df), index=df.index, dtype=object)
+        return _column_as_str(df, col)
+
+    nos = _column_as_str(df, col_map['col_no'])
+    names = _column_as_str(df, col_map['col_name'])
+    songs = _column_as_str(df, col_map['col_song'])
+    kanas = optional('col_kana')
+    ages = optional('col_age')
+    tels = optional('col_tel')
+
+    # ヘッダーが1行目にある前提で、DataFrameの位置をExcelの行番号に直す
+    excel_rows = pd.Series(range(2, len(df) + 2), index=df.index)
+
+    col_duration = optional_column('col_duration')
+    bad_duration_rows = []
+    if col_duration != ROSTER_OPTIONAL_COLUMN:
+        raw_durations = _column_as_str(df, col_duration)
+        parts = raw_durations.str.extract(DURATION_EXTRACT_PATTERN)
+        durations = parts[0].fillna('0').astype('int64') * 60 + parts[1].fillna('0').astype('int64')
+        unparsed = parts[0].isna() & parts[1].isna() & df[col_duration].notna() & (raw_durations.str.strip() != "")
+        bad_duration_rows = [f"{r} ({v})" for r, v in zip(excel_rows[unparsed], raw_durations[unparsed])]
+    else:
+        durations = pd.Series([0] * len(df), index=df.index, dtype='int64')
+
+    empty_name = df[col_map['col_name']].isna() | (names.str.strip() == "")
+    issues = {
+        'duplicate_nos': nos[nos.duplicated()].unique().tolist(),
+        'empty_name_rows': excel_rows[empty_name].tolist(),
+        'bad_duration_rows': bad_duration_rows,
+    }
+
+    all_data = [
+        {'no': no, 'name': name, 'kana': kana, 'song': song, 'age': age, 'tel': tel, 'duration_sec': dur}
+        for no, name, kana, song, age, tel, dur in zip(
+            nos.tolist(), names.tolist(), kanas.tolist(), songs.tolist(),
+            ages.tolist(), tels.tolist(), durations.tolist())
+    ]
+    return all_data, issues
+
+def format_roster_issues(issues):
+    def head(values):
+        values = [str(v) for v in values]
+        text = ", ".join(values[:ROSTER_ISSUE_LIMIT])
+        if len(values) > ROSTER_ISSUE_LIMIT:
+            text += f" ほか{len(values) - ROSTER_ISSUE_LIMIT}件"
+        return text
+
+    lines = []
+    if issues.get('duplicate_nos'):
+        lines.append(f"出場番号の重複: {head(issues['duplicate_nos'])}")
+    if issues.get('empty_name_rows'):
+        lines.append(f"氏名が空欄の行: {head(issues['empty_name_rows'])}")
+    if issues.get('bad_duration_rows'):
+        lines.append(f"演奏時間を読み取れない行: {head(issues['bad_duration_rows'])}")
+    return lines
+
+# openpyxl の読み取り専用モードで、必要な行・列だけを流し読みする形式
+ROSTER_STREAMING_SUFFIXES = ('.xlsx', '.xlsm')
+_INLINE_TEXT_TAG = f"{{{SHEET_MAIN_NS}}}t"
+_INLINE_RUN_TEXT_PATH = f"{{{SHEET_MAIN_NS}}}r/{{{SHEET_MAIN_NS}}}t"
+
+def _xlsx_cell_value(value, data_type):
+    # pandas.read_excel（openpyxl）と同じ変換。空欄は "" にして、読み込み時に欠損値として扱わせる
+    if value is None:
+        return ""
+    if data_type == TYPE_ERROR:
+        return float('nan')
+    if data_type == TYPE_NUMERIC:
+        number = int(value)
+        if number == value:
+            return number
+        return float(value)
+    return value
+
+class _SelectedColumnsParser(WorkSheetParser):
+    """
+    columns（1始まりの列番号の集合）の列だけを parse_cell で読み、ほかの列は値があるかどうかだけを見る。
+    XMLは全セル分たどるが、文字列の組み立てや数値・日付の変換は割り当てた列の分しか行わない。
+    parse() は (行番号, セルのリスト) を返し、row_has_data にその行に空欄でないセルがあったかが入る。
+    """
+    def __init__(self, src, shared_strings, columns=None, **kwargs):
+        super().__init__(src, shared_strings, **kwargs)
+        self.columns = columns
+        self.row_has_data = False
+
+    def parse_row(self, row):
+        self.row_has_data = False
+        row_number, cells = super().parse_row(row)
+        return row_number, [cell for cell in cells if cell is not None]
+
+    def parse_cell(self, element):
+        coordinate = element.get('r')
+        if coordinate:
+            column = coordinate_to_tuple(coordinate)[1]
+        else:
+            column = self.col_counter + 1
+        if self.columns is not None and column not in self.columns:
+            self.col_counter = column
+            if not self.row_has_data:
+                self.row_has_data = self._has_value(element)
+            return None
+        cell = super().parse_cell(element)
+        if cell['value'] is not None and cell['value'] != "":
+            self.row_has_data = True
+        return cell
+
+    def _has_value(self, element):
+        # pandas が空欄（""）とみなさない値を持つか
+        data_type = element.get('t', 'n')
+        if data_type == 'inlineStr':
+            child = element.find(INLINE_STRING)
+            if child is None:
+                return False
+            return bool(child.findtext(_INLINE_TEXT_TAG) or
+                        any(t.text for t in child.iterfind(_INLINE_RUN_TEXT_PATH)))
+        value = element.findtext(VALUE_TAG, None)
+        if not value:
+            return False
+        if data_type == 's':
+            return self.shared_strings[int(value)] != ""
+        return True
+
+def _xlsx_sheet_rows(workbook, sheet_name, columns=None):
+    """
+    読み取り専用のブックから、シートの行を1行目から (行番号, セルのリスト, 空欄でないセルがあるか) で順に返す。
+    セルは {'column', 'value', 'data_type', ...} の辞書で、行の抜けは埋めない。
+    ReadOnlyWorksheet が行を読むときと同じ設定でシートのXMLを読む。
+    """
+    worksheet = workbook[sheet_name]
+    with worksheet._get_source() as src:
+        parser = _SelectedColumnsParser(
+            src, worksheet._shared_strings, columns=columns, data_only=workbook.data_only, epoch=workbook.epoch,
+            date_formats=workbook._date_formats, timedelta_formats=workbook._timedelta_formats)
+        for row_number, cells in parser.parse():
+            yield row_number, cells, parser.row_has_data
+
+def _parse_rows(rows):
+    # 列名の補完（Unnamed: n）・重複名の付け替えと型の推定を pandas.read_excel と同じ規則で行う
+    return TextParser(rows, header=0, skip_blank_lines=False).read()
+
+class RosterSource:
+    """
+    名簿ファイル1つ分。解析結果は RosterCache から取り出す。
+    .xlsx は openpyxl の読み取り専用モードで開き、シート名・ヘッダー行・割り当てた列だけを読む。
+    .xls と CSV は pandas で全体を読む。
+    """
+    def __init__(self, data, file_name, digest=None, cache=None):
+        self.data = data
+        self.file_name = file_name
+        self.digest = digest or hashlib.sha1(data).hexdigest()
+        self.cache = cache if cache is not None else RosterCache()
+
+    @classmethod
+    def from_path(cls, path, cache=None):
+        with open(path, 'rb') as f:
+            data = f.read()
+        return cls(data, os.path.basename(path), cache=cache)
+
+    @property
+    def is_csv(self):
+        return self.file_name.endswith('.csv')
+
+    @property
+    def is_streaming(self):
+        return self.file_name.lower().endswith(ROSTER_STREAMING_SUFFIXES)
+
+    def _book(self):
+        return self.cache.get_or_load(('book', self.digest), lambda: pd.ExcelFile(io.BytesIO(self.data)))
+
+    def _workbook(self):
+        # 読み取り専用モードでは、開いた時点ではセルを読まない
+        def load():
+            return load_workbook(io.BytesIO(self.data), read_only=True, data_only=True, keep_links=False)
+        return self.cache.get_or_load(('workbook', self.digest), load)
+
+    def sheet_names(self):
+        if self.is_csv:
+            return ["CSV"]
+        if self.is_streaming:
+            return self._workbook().sheetnames
+        return self._book().sheet_names
+
+    def frame(self, sheet_name):
+        def load():
+            if self.is_csv:
+                return pd.read_csv(io.BytesIO(self.data))
+            return self._book().parse(sheet_name)
+        return self.cache.get_or_load(('frame', self.digest, sheet_name), load)
+
+    def columns(self, sheet_name):
+        """
+        列の割り当てに使う列名の一覧。pandas.read_excel と同じく1行目をヘッダーにする。
+        .xlsx ではふつうは1行目だけを読み、1行目が空のときだけシート全体を見てデータのある列に Unnamed: n の名前を付ける
+        （1行目に列名があるときは、その右のデータだけの列は含めない）。
+        """
+        def load():
+            if self.is_streaming:
+                try:
+                    return self._streamed_columns(sheet_name)
+                except AttributeError as e:
+                    # openpyxl の内部（_get_source など）が変わったときは、pandas でシート全体を読む
+                    print(f"Streaming xlsx reader unavailable: {e}")
+            return self.frame(sheet_name).columns.tolist()
+        return self.cache.get_or_load(('columns', self.digest, sheet_name), load)
+
+    def _streamed_columns(self, sheet_name):
+        workbook = self._workbook()
+        header = []
+        rows = _xlsx_sheet_rows(workbook, sheet_name)
+        try:
+            for row_number, cells, _ in rows:
+                if row_number == 1:
+                    header = [""] * (cells[-1]['column'] if cells else 0)
+                    for cell in cells:
+                        header[cell['column'] - 1] = _xlsx_cell_value(cell['value'], cell['data_type'])
+                break
+        finally:
+            rows.close()
+        while header and header[-1] == "":
+            header.pop()
+        if not header:
+            # 空欄でない最も右のセルまでを列にする（pandas が各行の末尾の空欄を落としてから列数をそろえるのと同じ）
+            width = 0
+            for _, cells, has_data in _xlsx_sheet_rows(workbook, sheet_name):
+                if has_data:
+                    width = max(width, max(cell['column'] for cell in cells
+                                           if _xlsx_cell_value(cell['value'], cell['data_type']) != ""))
+            if not width:
+                return []
+            header = [""] * width
+        return _parse_rows([header]).columns.tolist()
+
+    def _streamed_frame(self, sheet_name, col_map):
+        """
+        割り当てられた列だけを1行ずつ取り出した DataFrame を作る。
+        途中の空行は残して末尾の空行だけを落とす規則も pandas にそろえ、全列を読んだ DataFrame から列を選んだものと同じになる。
+        割り当てられていない（None）列とシートにない列は含めず、選ぶ列がなければ空の DataFrame を返す。
+        """
+        names = self.columns(sheet_name)
+        # col_map には sheet_name など列以外の設定も入っている
+        mapped = [col_map.get(key, ROSTER_OPTIONAL_COLUMN) for key in ROSTER_COLUMN_ORDER]
+        selected = list(dict.fromkeys(c for c in mapped if c != ROSTER_OPTIONAL_COLUMN and c in names))
+        if not selected:
+            return pd.DataFrame()
+        try:
+            return self._read_selected_columns(sheet_name, names, selected)
+        except AttributeError as e:
+            print(f"Streaming xlsx reader unavailable: {e}")
+            return self.frame(sheet_name)[selected]
+
+    def _read_selected_columns(self, sheet_name, names, selected):
+        # 列番号（1始まり）→ DataFrame の列の位置
+        positions = {names.index(col) + 1: i for i, col in enumerate(selected)}
+        empty_row = [""] * len(selected)
+
+        rows = [selected]
+        last_row_with_data = 0
+        for row_number, cells, has_data in _xlsx_sheet_rows(self._workbook(), sheet_name, set(positions)):
+            if row_number < 2:
+                continue
+            # 行が抜けているところは空行として埋める
+            while len(rows) < row_number - 1:
+                rows.append(empty_row)
+            values = list(empty_row)
+            for cell in cells:
+                values[positions[cell['column']]] = _xlsx_cell_value(cell['value'], cell['data_type'])
+            rows.append(values)
+            if has_data:
+                last_row_with_data = len(rows) - 1
+        del rows[last_row_with_data + 1:]
+        return _parse_rows(rows)
+
+    def roster(self, sheet_name, col_map):
+        # 戻り値: (all_data, ParticipantIndex, issues)
+        def load():
+            if self.is_streaming:
+                df = self._streamed_frame(sheet_name, col_map)
+            else:
+                df = self.frame(sheet_name)
+            all_data, issues = normalize_roster_frame(df, col_map)
+            return all_data, ParticipantIndex(all_data), issues
+        key = ('roster', self.digest, sheet_name, tuple(sorted(col_map.items())))
+        return self.cache.get_or_load(key, load)
+
+# 列の割り当てで、保存済みの設定がないときに探す列名（UIの初期選択と同じ規則）
+ROSTER_COLUMN_HINTS = {
+    'col_no': ["出場番号", "No", "No."],
+    'col_name': ["氏名", "名前"],
+    'col_song': ["演奏曲目", "曲目"],
+}
+ROSTER_OPTIONAL_COLUMN_HINTS = {
+    'col_kana': "フリガナ",
+    'col_age': "年齢",
+    'col_tel': "電話番号",
+    'col_duration': "演奏時間",
+}
+ROSTER_COLUMN_ORDER = ['col_no', 'col_name', 'col_kana', 'col_song', 'col_age', 'col_tel', 'col_duration']
+
+def default_column_map(saved_config, cols):
+    """
+    保存済みの excel_config と名簿の列名から、各項目に割り当てる列名を決める。
+    必須の列は見つからなければ先頭の列（列がなければ None）、任意の列は ROSTER_OPTIONAL_COLUMN になる。
+    """
+    saved_config = saved_config or {}
+    col_map = {}
+    for key, hints in ROSTER_COLUMN_HINTS.items():
+        value = cols[0] if cols else None
+        if key in saved_config and saved_config[key] in cols:
+            value = saved_config[key]
+        else:
+            for h in hints:
+                if h in cols:
+                    value = h
+                    break
+        col_map[key] = value
+    for key, hint in ROSTER_OPTIONAL_COLUMN_HINTS.items():
+        value = ROSTER_OPTIONAL_COLUMN
+        if key in saved_config:
+            if saved_config[key] in cols:
+                value = saved_config[key]
+        elif hint in cols:
+            value = hint
+        col_map[key] = value
+    # 設定データ.json に保存される順番（UIと同じ）にそろえる
+    return {key: col_map[key] for key in ROSTER_COLUMN_ORDER}
+
+def resolve_excel_config(source, saved_config):
+    """保存済みの excel_config を名簿ファイルに当てはめ、シート名と全項目の列名を埋めた設定を返す。"""
+    saved_config = saved_config or {}
+    sheet_names = source.sheet_names()
+    sheet_name = saved_config.get('sheet_name')
+    if sheet_name not in sheet_names:
+        sheet_name = sheet_names[0]
+    cols = source.columns(sheet_name)
+    return {'sheet_name': sheet_name, **default_column_map(saved_config, cols)}
+
+# ---------------------------------------------------------
+# 6. 設定データとコンテスト単位の生成
+# ---------------------------------------------------------
+
+DEFAULT_CONTEST_NAME = "第10回BIPCA 東京予選④"
+DEFAULT_CONTEST_DETAILS = {
+    'date': '', 'hall': '', 'open': '10:00', 'reception': '10:45-15:30',
+    'start': '11:00', 'end': '14:00', 'result': '', 'method': '公式サイト上で掲載'
+}
+# 設定データ.json に保存される順番（UIの入力欄の並び）
+CONTEST_DETAIL_ORDER = ['date', 'hall', 'open', 'start', 'end', 'reception', 'result', 'method']
+DEFAULT_GROUP = {'member_input': '', 'time_str': '13:00-14:10'}
+DEFAULT_JUDGES = ["審査員A"]
+RESULT_METHOD_OPTIONS = ["公式サイト上で掲載", "会場ロビーもしくはホワイエで掲示", "表彰式にて発表", "その他"]
+CONFIG_ARCNAME = "設定データ.json"
+
+# 設定データ.json の1件分。judges は空欄を除いたもの
+ContestSettings = namedtuple('ContestSettings', ['contest_name', 'groups', 'judges', 'contest_details', 'excel_config'])
+
+def contest_settings_from_json(json_data):
+    """
+    設定データ.json の内容を、UIで読み込んでそのまま生成したときと同じ値にそろえて返す。
+    excel_config は保存されたままなので、名簿に当てはめるには resolve_excel_config を使う。
+    """
+    groups = [{'member_input': g.get('member_input', ''), 'time_str': g.get('time_str', '')}
+              for g in json_data.get('groups') or []] or [dict(DEFAULT_GROUP)]
+    judges = json_data.get('judges') or list(DEFAULT_JUDGES)
+    saved_details = json_data.get('contest_details') or {}
+    details = {key: saved_details.get(key, DEFAULT_CONTEST_DETAILS[key]) for key in CONTEST_DETAIL_ORDER}
+    if details['method'] not in RESULT_METHOD_OPTIONS:
+        details['method'] = RESULT_METHOD_OPTIONS[0]
+    return ContestSettings(
+        contest_name=json_data.get('contest_name', DEFAULT_CONTEST_NAME),
+        groups=groups,
+        judges=[j for j in judges if j.strip()],
+        contest_details=details,
+        excel_config=json_data.get('excel_config') or {},
+    )
+
+def format_contest_details(details):
+    return {
+        'contest_date': details['date'], 'contest_hall': details['hall'],
+        'contest_open': format_single_time_label(details['open']),
+        'contest_reception': format_time_label(details['reception']),
+        'contest_start': format_single_time_label(details['start']),
+        'contest_end': format_single_time_label(details['end']),
+        'contest_result': details['result'], 'contest_method': details['method']
+    }
+
+def contest_config_json(contest):
+    return json.dumps({
+        'groups': contest.groups, 'judges': contest.judges,
+        'contest_name': contest.contest_name, 'contest_details': contest.contest_details,
+        'excel_config': contest.excel_config
+    }, ensure_ascii=False, indent=2)
+
+def find_duplicate_assignments(groups, participant_index):
+    """複数のグループに割り当てられた出場番号を返す（生成もする場合は build_assignment_plan の結果を使い回す）"""
+    return list(build_assignment_plan(groups, participant_index).duplicates)
+
+def list_template_files(template_dir=TEMPLATE_DIR):
+    if not os.path.exists(template_dir):
+        return []
+    return [f for f in os.listdir(template_dir) if f.endswith(".docx") and not f.startswith("~$")]
+
+def default_template_files(template_files):
+    """ファイル名から各ドキュメントのテンプレートを選ぶ。該当がなければ先頭のファイルになる。"""
+    idx = {'score': 0, 'reception': 0, 'web': 0, 'judges_list': 0}
+    for i, f in enumerate(template_files):
+        if "採点表" in f: idx['score'] = i
+        if "受付表" in f: idx['reception'] = i
+        if "WEB" in f or "プログラム" in f: idx['web'] = i
+        if "審査員" in f and "リスト" not in f: idx['judges_list'] = i
+    return {kind: template_files[i] for kind, i in idx.items()} if template_files else {}
+
+def write_contest_archive(zf, contest, participant_index, templates, template_dir=TEMPLATE_DIR, max_workers=None,
+                          metrics=None, sheet_format=DEFAULT_SHEET_FORMAT):
+    """
+    1コンテスト分のドキュメント・PDF・設定データ.json を zf に書き込む。
+    templates は 'score' / 'reception' / 'web' / 'judges_list' からテンプレート（パスかファイル）への辞書。
+    sheet_format（SHEET_FORMAT_OPTIONS のキー）で採点表・受付表をWord・PDFのどちらで（または両方）書き込むかを選ぶ。
+    participant_index には検証で作った AssignmentPlan も渡せる（グループを解決し直さない）。
+    ドキュメントごとに RenderOutput を返すので、呼び出し側でエラーを表示する。
+    metrics（RunMetrics）を渡すと、ドキュメントごとの生成とZIP書き込みを記録し、最後に metrics.json を書き込む。
+    """
+    if metrics is None:
+        metrics = NULL_METRICS
+    base_context = {'contest_name': contest.contest_name, **format_contest_details(contest.contest_details)}
+    if isinstance(participant_index, AssignmentPlan):
+        plan = participant_index
+    else:
+        plan = build_assignment_plan(contest.groups, participant_index)
+
+    # 各ドキュメントはプロセスプールで並列に生成し、できたものから書き込む
+    render_tasks = build_render_tasks(
+        plan, None, contest.judges, base_context,
+        score_template=templates.get('score'), reception_template=templates.get('reception'),
+        web_template=templates.get('web'), judges_list_template=templates.get('judges_list'),
+        sheet_format=sheet_format,
+    )
+    zip_seconds = 0.0
+    for output in write_render_outputs(zf, render_tasks, max_workers, get_document_cache()):
+        if output.metrics is not None:
+            zip_seconds += output.metrics.pop('zip_seconds', 0.0)
+            metrics.add('render', output.metrics.pop('seconds'), document=output.arcname, **output.metrics)
+        yield output
+
+    started = time.perf_counter()
+    # 同梱ファイルは読み込みと圧縮するかどうかの判定を済ませたものをそのまま書き込む
+    for asset in get_static_asset_cache().assets(template_dir):
+        write_zip_member(zf, asset.arcname, asset.data, asset.compression)
+
+    write_zip_member(zf, CONFIG_ARCNAME, contest_config_json(contest))
+
+    if metrics.enabled:
+        infos = zf.infolist()
+        metrics.add('zip_write', zip_seconds + time.perf_counter() - started, items=len(infos),
+                    bytes=sum(info.compress_size for info in infos))
+        write_zip_member(zf, METRICS_ARCNAME, metrics.to_json())
+
+# error が None でなければZIPは書き出していない。warnings は名簿の確認事項とドキュメントごとの生成エラー。
+# elapsed はそのコンテストの生成にかかった秒数
+ContestResult = namedtuple('ContestResult', ['contest_name', 'output_path', 'warnings', 'error', 'elapsed'])
+# 名簿の解析と検証を済ませた1コンテスト分。プロセス間では名簿全体ではなく割り当て（AssignmentPlan）を受け渡す
+ContestJob = namedtuple('ContestJob', ['contest', 'plan', 'templates', 'template_dir', 'output_path', 'warnings', 'metrics',
+                                       'sheet_format'])
+
+TEMPLATE_KIND_LABELS = {'score': "採点表", 'reception': "受付表", 'web': "WEBプログラム", 'judges_list': "審査員リスト"}
+
+def template_issue_lines(templates):
+    """選ばれたテンプレートを読み込んで前処理し、差し込めないプレースホルダを文にして返す"""
+    lines = []
+    for kind, template in templates.items():
+        if not template:
+            continue
+        label = TEMPLATE_KIND_LABELS.get(kind, kind)
+        try:
+            report = template_report(template)
+        except Exception as e:
+            lines.append(f"{label}テンプレートを読み込めません: {e}")
+            continue
+        lines.extend(f"{label}テンプレート {line}" for line in format_template_issues(report))
+    return lines
+
+def select_template_paths(template_dir=TEMPLATE_DIR):
+    files = list_template_files(template_dir)
+    return {kind: os.path.join(template_dir, f) for kind, f in default_template_files(files).items()}
+
+def prepare_contest(roster_source, contest, output_path, template_dir=TEMPLATE_DIR, sheet_format=DEFAULT_SHEET_FORMAT):
+    """
+    名簿を当てはめて検証し、ContestJob を返す。生成できない場合はエラーの ContestResult を返す。
+    名簿の解析結果は roster_source の RosterCache に残るので、同じシートを使うコンテストでは使い回される。
+    """
+    started = time.perf_counter()
+    metrics = new_run_metrics(contest_name=contest.contest_name)
+    with metrics.stage('roster_load') as record:
+        excel_config = resolve_excel_config(roster_source, contest.excel_config)
+        contest = contest._replace(excel_config=excel_config)
+        all_data, participant_index, issues = roster_source.roster(excel_config['sheet_name'], excel_config)
+        record.update(items=len(all_data), sheet=excel_config['sheet_name'])
+    warnings = format_roster_issues(issues)
+
+    with metrics.stage('validation', items=len(contest.groups)) as record:
+        plan = build_assignment_plan(contest.groups, participant_index)
+        record.update(duplicates=len(plan.duplicates), unassigned=len(plan.unassigned))
+    if plan.duplicates:
+        return ContestResult(contest.contest_name, None, warnings, f"出場番号重複: {', '.join(plan.duplicates)}",
+                             time.perf_counter() - started)
+    warnings.extend(format_plan_issues(plan))
+
+    templates = select_template_paths(template_dir)
+    if not templates.get('score'):
+        return ContestResult(contest.contest_name, None, warnings, "採点表テンプレートが見つかりません。",
+                             time.perf_counter() - started)
+    warnings.extend(template_issue_lines(templates))
+
+    return ContestJob(contest, plan, templates, template_dir, output_path, warnings, metrics, sheet_format)
+
+def run_contest_job(job, max_workers=None):
+    """ContestJob のZIPを書き出す。一括生成ではプロセスプールのワーカーから max_workers=1 で呼ばれる。"""
+    started = time.perf_counter()
+    warnings = list(job.warnings)
+    with zipfile.ZipFile(job.output_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        outputs = write_contest_archive(zf, job.contest, job.plan, job.templates,
+                                        job.template_dir, max_workers, job.metrics, job.sheet_format)
+        for output in outputs:
+            if output.error:
+                judge_label = f" ({output.judge})" if output.judge else ""
+                warnings.append(f"{output.label}生成エラー{judge_label}: {output.error}")
+    return ContestResult(job.contest.contest_name, job.output_path, warnings, None, time.perf_counter() - started)
+
+def generate_contest_archive(roster_source, contest, output_path, template_dir=TEMPLATE_DIR, max_workers=None,
+                             sheet_format=DEFAULT_SHEET_FORMAT):
+    """
+    名簿ファイルと設定データから、UIの「ファイル生成を実行」と同じ内容のZIPを output_path に書き出す。
+    """
+    started = time.perf_counter()
+    job = prepare_contest(roster_source, contest, output_path, template_dir, sheet_format)
+    if isinstance(job, ContestResult):
+        return job
+    result = run_contest_job(job, max_workers)
+    return result._replace(elapsed=time.perf_counter() - started)
+
+def _run_batch_contest_job(job):
+    return run_contest_job(job, max_workers=1)
+
+def generate_contest_batch(roster_source, contests, template_dir=TEMPLATE_DIR, max_workers=None,
+                           sheet_format=DEFAULT_SHEET_FORMAT):
+    """
+    複数のコンテストを一括で生成し、終わったものから ContestResult を返す。
+    contests は (設定, 出力先パス) の並び。名簿のブックとシートは親プロセスで1回だけ解析し、
+    コンテスト単位でプロセスプールに振り分ける（テンプレートは各ワーカーのキャッシュで使い回される）。
+    """
+    if max_workers is None:
+        max_workers = default_render_workers()
+
+    jobs = []
+    for contest, output_path in contests:
+        started = time.perf_counter()
+        try:
+            job = prepare_contest(roster_source, contest, output_path, template_dir, sheet_format)
+        except Exception as e:
+            job = ContestResult(contest.contest_name, None, [], str(e), time.perf_counter() - started)
+        if isinstance(job, ContestResult):
+            yield job
+        else:
+            jobs.append((job, time.perf_counter() - started))
+
+    if not use_render_pool(max_workers, len(jobs), sum(plan_rows(job.plan) for job, _ in jobs)):
+        for job, prepare_elapsed in jobs:
+            result = run_contest_job(job, max_workers)
+            yield result._replace(elapsed=result.elapsed + prepare_elapsed)
+        return
+
+    pool = get_render_pool(max_workers)
+    futures = {pool.submit(_run_batch_contest_job, job): (job, prepare_elapsed) for job, prepare_elapsed in jobs}
+    for future in as_completed(futures):
+        job, prepare_elapsed = futures[future]
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            _discard_render_pool(pool)
+            result = ContestResult(job.contest.contest_name, None, job.warnings, f"ワーカープロセスが異常終了しました: {e}", 0.0)
+        except Exception as e:
+            result = ContestResult(job.contest.contest_name, None, job.warnings, str(e), 0.0)
+        yield result._replace(elapsed=result.elapsed + prepare_elapsed)
+
+# ---------------------------------------------------------
+# 7. 計測
+# ---------------------------------------------------------
+
+# "0" にすると計測しない（metrics.json もログも書かない）
+METRICS_ENV = "BIPCA_METRICS"
+# 生成ごとの計測結果を1行ずつ追記するJSONLファイル
+METRICS_LOG_ENV = "BIPCA_METRICS_LOG"
+DEFAULT_METRICS_LOG = "generation_metrics.jsonl"
+METRICS_ARCNAME = "metrics.json"
+
+def metrics_enabled():
+    return os.environ.get(METRICS_ENV, "1") != "0"
+
+class RunMetrics:
+    """
+    生成1回分の段階ごとの計測値。段階は 'stage' と 'seconds' に件数（items）・バイト数（bytes）などを加えた辞書で持つ。
+    プロセス間で受け渡せるよう、中身は辞書とリストだけにしている。
+    """
+    enabled = True
+
+    def __init__(self, **meta):
+        self.run_id = uuid.uuid4().hex
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.meta = meta
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **fields):
+        record = {'stage': name, **fields}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - started
+            self.stages.append(record)
+
+    def add(self, name, seconds, **fields):
+        record = {'stage': name, 'seconds': seconds, **fields}
+        self.stages.append(record)
+        return record
+
+    def to_dict(self, stages=None):
+        return {'run_id': self.run_id, 'started_at': self.started_at, **self.meta,
+                'stages': self.stages if stages is None else stages}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+
+    def append_log(self, path=None, stages=None):
+        """JSONLのログに1行追記する。stages を渡すとその段階だけを同じ run_id で書く（後から行う送信など）"""
+        path = path or os.environ.get(METRICS_LOG_ENV, DEFAULT_METRICS_LOG)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.to_dict(stages), ensure_ascii=False) + "\n")
+
+class _NullStage:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullMetrics:
+    """計測しないときに RunMetrics の代わりに使う。何も記録しない。"""
+    enabled = False
+    stages = ()
+    _null_stage = _NullStage()
+
+    def stage(self, name, **fields):
+        return self._null_stage
+
+    def add(self, name, seconds, **fields):
+        return {}
+
+    def append_log(self, path=None, stages=None):
+        pass
+
+NULL_METRICS = NullMetrics()
+
+def new_run_metrics(**meta):
+    return RunMetrics(**meta) if metrics_enabled() else NULL_METRICS
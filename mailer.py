@@ -0,0 +1,206 @@
+"""
+生成したZIPを運営宛てに送るメール送信キュー。
+ダウンロードボタンの処理を待たせないよう、送信はバックグラウンドのスレッドで行う。
+"""
+import queue
+import smtplib
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from email.mime.multipart import MIMEMultipart
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.header import Header
+
+MAIL_QUEUE_MAX_JOBS = 32
+MAIL_MAX_ATTEMPTS = 4
+MAIL_RETRY_BASE_SECONDS = 2.0
+MAIL_SMTP_TIMEOUT = 30
+# この秒数だけ送信がなければSMTP接続を閉じる
+MAIL_IDLE_DISCONNECT_SECONDS = 60
+MAIL_JOB_HISTORY = 200
+
+# 再送しても結果が変わらないエラー
+NON_RETRYABLE_ERRORS = (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)
+
+MailSettings = namedtuple('MailSettings', ['server', 'port', 'sender_email', 'password', 'use_ssl'])
+
+STATUS_LABELS = {
+    'queued': "送信待ち",
+    'sending': "送信中",
+    'retrying': "再送待ち",
+    'sent': "送信済み",
+    'failed': "送信失敗",
+}
+
+class MailJob:
+    """
+    送信1件分。archive は SpooledArchive のように namelist() と base64_lines() を持つ生成済みZIPで、
+    添付ファイルは送信時にそこから読み出す。
+    """
+    def __init__(self, archive, contest_name, user_email, timestamp):
+        self.job_id = uuid.uuid4().hex
+        self.archive = archive
+        self.contest_name = contest_name
+        self.user_email = user_email
+        self.timestamp = timestamp
+        self.status = 'queued'
+        self.attempts = 0
+        self.error = None
+
+    @property
+    def status_label(self):
+        label = STATUS_LABELS.get(self.status, self.status)
+        if self.error and self.status in ('retrying', 'failed'):
+            label += f"（{self.error}）"
+        return label
+
+def build_message(sender_email, job):
+    file_list_str = ""
+    try:
+        for name in job.archive.namelist():
+            file_list_str += f"・{name}\n"
+    except Exception as e:
+        file_list_str = f"（ファイル一覧取得エラー: {e}）"
+
+    subject = f"採点表等を作成しました：{job.contest_name}"
+    body = f"""{job.user_email}が以下のファイルを生成しました。
+
+{file_list_str}
+生成日時：{job.timestamp}"""
+
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = sender_email
+    msg['Subject'] = Header(subject, 'utf-8')
+    msg.attach(MIMEText(body, 'plain'))
+
+    part = MIMEBase('application', 'octet-stream')
+    part.set_payload(job.archive.base64_lines())
+    part['Content-Transfer-Encoding'] = 'base64'
+
+    filename = f"{job.contest_name}.zip"
+    encoded_filename = Header(filename, 'utf-8').encode()
+    part.add_header('Content-Disposition', 'attachment', filename=encoded_filename)
+
+    msg.attach(part)
+    return msg
+
+class MailQueue:
+    """
+    上限付きのキューと送信スレッド1本。SMTP接続は使い回し、失敗したら待ち時間を倍にしながら再送する。
+    """
+    def __init__(self, settings, maxsize=MAIL_QUEUE_MAX_JOBS, max_attempts=MAIL_MAX_ATTEMPTS,
+                 retry_base_seconds=MAIL_RETRY_BASE_SECONDS, idle_disconnect_seconds=MAIL_IDLE_DISCONNECT_SECONDS):
+        self.settings = settings
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.idle_disconnect_seconds = idle_disconnect_seconds
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._smtp = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mail-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        with self._jobs_lock:
+            self._jobs[job.job_id] = job
+            while len(self._jobs) > MAIL_JOB_HISTORY:
+                self._jobs.popitem(last=False)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            job.status = 'failed'
+            job.error = "送信待ちが多すぎます"
+            return False
+        return True
+
+    def get(self, job_id):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def pending_count(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=None):
+        self._stopped.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    # --- 送信スレッド ---
+
+    def _connect(self):
+        s = self.settings
+        if s.use_ssl:
+            smtp = smtplib.SMTP_SSL(s.server, s.port, timeout=MAIL_SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(s.server, s.port, timeout=MAIL_SMTP_TIMEOUT)
+        if s.password:
+            smtp.login(s.sender_email, s.password)
+        return smtp
+
+    def _connection(self):
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._disconnect()
+        self._smtp = self._connect()
+        return self._smtp
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            pass
+        self._smtp = None
+
+    def _deliver(self, job):
+        msg = build_message(self.settings.sender_email, job)
+        while True:
+            job.attempts += 1
+            job.status = 'sending'
+            try:
+                self._connection().send_message(msg)
+                job.status = 'sent'
+                job.error = None
+                return
+            except Exception as e:
+                self._disconnect()
+                job.error = str(e)
+                print(f"Failed to send email (attempt {job.attempts}): {e}")
+                if isinstance(e, NON_RETRYABLE_ERRORS) or job.attempts >= self.max_attempts:
+                    job.status = 'failed'
+                    return
+                job.status = 'retrying'
+                if self._stopped.wait(self.retry_base_seconds * (2 ** (job.attempts - 1))):
+                    job.status = 'failed'
+                    return
+
+    def _run(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=self.idle_disconnect_seconds)
+            except queue.Empty:
+                self._disconnect()
+                continue
+            if job is None:
+                break
+            try:
+                self._deliver(job)
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e)
+                print(f"Failed to send email: {e}")
+            finally:
+                # 送信が終わったら生成済みZIPへの参照を手放す
+                job.archive = None
+        self._disconnect()
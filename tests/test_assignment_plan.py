@@ -0,0 +1,46 @@
+"""割り当て（build_assignment_plan・ParticipantIndex）のテスト。"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from engine import (AssignmentPlan, ParticipantIndex, as_assignment_plan, build_assignment_plan, estimate_group,
+                    format_plan_issues)
+
+ROSTER = [{'no': no, 'name': f"出場者{no}", 'duration_sec': 60 * i} for i, no in
+          enumerate(["A01", "A02", "A03", "B01", "B02", "C01"], 1)]
+
+def test_ranges_with_prefixes():
+    index = ParticipantIndex(ROSTER)
+    assert [m['no'] for m in index.resolve("A02-B01、C01")] == ["A02", "A03", "B01", "C01"]
+    # 逆順の範囲・全角の読点・名簿にない番号
+    assert [m['no'] for m in index.resolve("B02-A03, X99, A99-B02")] == ["A03", "B01", "B02"]
+    assert index.total_duration("A02-B01") == (2 + 3 + 4) * 60
+
+def test_duplicates_and_unassigned():
+    groups = [{'member_input': "A01-A03", 'time_str': "10:00-10:10"},
+              {'member_input': "A03, B01", 'time_str': ""},
+              {'member_input': "", 'time_str': "11:00"}]
+    plan = build_assignment_plan(groups, ROSTER)
+    assert [[m['no'] for m in g.members] for g in plan.groups] == [["A01", "A02", "A03"], ["A03", "B01"], []]
+    assert plan.duplicates == ("A03",)
+    assert plan.unassigned == ("B02", "C01")
+    assert format_plan_issues(plan) == ["どのグループにも入っていない出場者: B02, C01"]
+    assert [g.total_sec for g in plan.groups] == [360, 420, 0]
+
+def test_plan_keeps_time_slots():
+    groups = [{'member_input': "A01-A02", 'time_str': "10:00-10:05"}, {'member_input': "A03", 'time_str': None}]
+    plan = build_assignment_plan(groups, ParticipantIndex(ROSTER))
+    assert [(g.member_input, g.time_str) for g in plan.groups] == [("A01-A02", "10:00-10:05"), ("A03", "")]
+    assert as_assignment_plan(plan, None) is plan
+    assert isinstance(as_assignment_plan(groups, ROSTER), AssignmentPlan)
+    # 演奏時間の合計（3分）から見た終了見込みと、時間欄の終了時刻
+    assert tuple(estimate_group(ROSTER, groups[0])) == (180, "10:00", "10:03", "10:05")
+    assert tuple(estimate_group(ROSTER, groups[1])) == (180, None, None, None)
+
+def test_many_unassigned_are_truncated():
+    roster = [{'no': f"A{i:03d}", 'duration_sec': 0} for i in range(25)]
+    plan = build_assignment_plan([], roster)
+    assert plan.unassigned == tuple(item['no'] for item in roster)
+    assert format_plan_issues(plan)[0].endswith("A019 ほか5件")
@@ -0,0 +1,63 @@
+"""生成済みドキュメントのキャッシュ（DocumentCache・iter_cached_render_outputs）のテスト。"""
+import io
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import engine
+from engine import (DocumentCache, ParticipantIndex, build_assignment_plan, build_render_tasks,
+                    iter_cached_render_outputs, select_template_paths)
+
+def make_tasks(judges):
+    all_data = [{'no': f"A{i:03d}", 'name': f"出場者{i}", 'kana': "", 'song': "曲", 'age': "", 'tel': "",
+                 'duration_sec': 180} for i in range(1, 4)]
+    plan = build_assignment_plan([{'member_input': "A001-A003", 'time_str': "10:00-10:10"}], ParticipantIndex(all_data))
+    templates = select_template_paths(os.path.join(ROOT, engine.TEMPLATE_DIR))
+    return build_render_tasks(plan, None, judges, {'contest_name': "テスト予選"},
+                              score_template=templates['score'], reception_template=templates['reception'],
+                              sheet_format='docx')
+
+def test_get_put_and_expiry(tmp_path):
+    cache = DocumentCache(str(tmp_path / "docs"), max_bytes=1 << 20, ttl_seconds=3600)
+    assert cache.get("k1", ".docx") is None
+    cache.put("k1", ".docx", io.BytesIO(b"docx"))
+    assert cache.get("k1", ".docx").getvalue() == b"docx"
+    assert cache.get("k1", ".pdf") is None
+    with pytest.raises(ValueError):
+        cache.get("k1", ".txt")
+    assert oct(os.stat(cache.directory).st_mode & 0o777) == oct(0o700)
+
+    old = time.time() - 7200
+    os.utime(cache._path("k1", ".docx"), (old, old))
+    assert cache.get("k1", ".docx") is None
+    assert cache.evict() == 1
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = DocumentCache(str(tmp_path), max_bytes=250, ttl_seconds=3600)
+    now = time.time()
+    for i, name in enumerate(["a", "b"]):
+        cache.put(name, ".pdf", io.BytesIO(b"x" * 100))
+        os.utime(cache._path(name, ".pdf"), (now - 100 + i, now - 100 + i))
+    # a を読むと最後に使った時刻が進み、次に追い出されるのは b になる
+    assert cache.get("a", ".pdf") is not None
+    cache.put("c", ".pdf", io.BytesIO(b"x" * 100))
+    assert cache.get("b", ".pdf") is None
+    assert cache.get("a", ".pdf") is not None and cache.get("c", ".pdf") is not None
+
+def test_unchanged_documents_come_from_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv(engine.RENDER_POOL_MIN_ROWS_ENV, "1000000")
+    cache = DocumentCache(str(tmp_path), max_bytes=1 << 30, ttl_seconds=3600)
+    first = {o.arcname: o for o in iter_cached_render_outputs(make_tasks(["審査員A", "審査員B"]), cache)}
+    assert all(o.error is None and not o.metrics.get('cached') for o in first.values())
+
+    second = {o.arcname: o for o in iter_cached_render_outputs(make_tasks(["審査員A", "審査員B", "審査員C"]), cache)}
+    rendered = sorted(name for name, o in second.items() if not o.metrics.get('cached'))
+    # 増えた審査員Cの採点表だけを作り、受付表と審査員A・Bの採点表はキャッシュから返す
+    assert rendered == [engine.render_arcname('score', "審査員C")]
+    assert set(second) == set(first) | set(rendered)
+    assert all(second[name].data.getvalue() == output.data.getvalue() for name, output in first.items())
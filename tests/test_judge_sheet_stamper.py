@@ -0,0 +1,48 @@
+"""採点表の審査員名の差し込み（JudgeSheetStamper）のテスト。"""
+import os
+import re
+import sys
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import engine
+from engine import JudgeSheetStamper, ParticipantIndex, build_assignment_plan, select_template_paths
+
+def make_stamper():
+    all_data = [{'no': f"A{i:03d}", 'name': f"出場者{i}", 'kana': "", 'song': "曲", 'age': "", 'tel': "",
+                 'duration_sec': 180} for i in range(1, 4)]
+    groups = [{'member_input': "A001-A003", 'time_str': "10:00-10:30"}]
+    plan = build_assignment_plan(groups, ParticipantIndex(all_data))
+    template = select_template_paths(os.path.join(ROOT, engine.TEMPLATE_DIR))['score']
+    return JudgeSheetStamper(template, plan, None, {'contest_name': "テスト予選"})
+
+def document_text(docx_io):
+    with zipfile.ZipFile(docx_io) as z:
+        return "".join(z.read(n).decode('utf-8') for n in z.namelist() if n.endswith('.xml'))
+
+def test_can_stamp_latin_names():
+    for name in ["Adam Smith", "Jane", "Bob", "山田 花子", "Jean-Luc_Dumont"]:
+        assert JudgeSheetStamper.can_stamp(name), name
+
+def test_cannot_stamp_delimiters_or_control_characters():
+    for name in ["a\tb", "a\nb", "x\ue000y", "x\ue001y", " 山田 ", "山田 ", "\u3000山田"]:
+        assert not JudgeSheetStamper.can_stamp(name), name
+
+def test_latin_name_is_stamped_without_rendering(monkeypatch):
+    stamper = make_stamper()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("stamped names must not fall back to a full render")
+    monkeypatch.setattr(engine, 'generate_word_from_template', fail)
+
+    text = document_text(stamper.render("Adam Smith"))
+    assert "Adam Smith" in text
+    assert engine.JUDGE_NAME_SENTINEL not in text
+
+def test_name_with_surrounding_spaces_keeps_them():
+    stamper = make_stamper()
+    text = document_text(stamper.render(" 山田 "))
+    # 通常の生成に回るので、前後の空白が xml:space="preserve" 付きで残る
+    assert re.search(r'<w:t xml:space="preserve"> 山田 ', text)
@@ -0,0 +1,193 @@
+"""メール送信キュー（MailQueue）のテスト。同じプロセスで動かす小さなSMTPサーバーに送る。"""
+import base64
+import os
+import socketserver
+import sys
+import threading
+import time
+from email import message_from_bytes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mailer import MailJob, MailQueue, MailSettings
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    SMTPの最低限のコマンドだけに答えるサーバー。
+    data_replies に返答を入れておくと、DATAの結果として先頭から順に返す（空なら 250）。
+    auth_reply は AUTH への返答、hold をセットするまでは DATA の結果を返さない。
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.messages = []
+        self.data_replies = []
+        self.auth_reply = b"235 OK"
+        self.hold = threading.Event()
+        self.hold.set()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply(b"220 stub")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b" ", 1)[0].upper()
+            if command == b"EHLO":
+                self.reply(b"250-stub")
+                self.reply(b"250 AUTH PLAIN")
+            elif command == b"AUTH":
+                self.reply(server.auth_reply)
+            elif command == b"DATA":
+                self.reply(b"354 go ahead")
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if data_line in (b".\r\n", b""):
+                        break
+                    lines.append(data_line)
+                server.hold.wait(10)
+                reply = server.data_replies.pop(0) if server.data_replies else b"250 OK"
+                if reply.startswith(b"250"):
+                    server.messages.append(b"".join(lines))
+                self.reply(reply)
+            elif command == b"QUIT":
+                self.reply(b"221 bye")
+                return
+            else:
+                # MAIL / RCPT / NOOP / RSET
+                self.reply(b"250 OK")
+
+class FakeArchive:
+    def namelist(self):
+        return ["採点表_審査員A.docx"]
+
+    def base64_lines(self):
+        return base64.encodebytes(b"PK zip")
+
+class RecordingEvent(threading.Event):
+    # 再送までの待ち時間を記録し、実際には待たない
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, timeout=None):
+        if timeout is not None:
+            self.waits.append(timeout)
+            timeout = 0
+        return super().wait(timeout)
+
+def make_queue(server, password="", **kwargs):
+    mail_queue = MailQueue(MailSettings("127.0.0.1", server.port, "office@example.com", password, False), **kwargs)
+    mail_queue._stopped = RecordingEvent()
+    return mail_queue
+
+def make_job():
+    return MailJob(FakeArchive(), "テスト予選", "user@example.com", "2026-01-01 10:00")
+
+def wait_for(job, statuses, timeout=10):
+    deadline = time.monotonic() + timeout
+    while job.status not in statuses:
+        assert time.monotonic() < deadline, job.status
+        time.sleep(0.01)
+
+def test_delivers_message():
+    server = StubSMTPServer()
+    mail_queue = make_queue(server)
+    try:
+        job = make_job()
+        assert mail_queue.submit(job)
+        wait_for(job, ('sent', 'failed'))
+        assert job.status == 'sent' and job.attempts == 1
+        message = message_from_bytes(server.messages[0])
+        attachment = message.get_payload()[1]
+        assert base64.b64decode(attachment.get_payload()) == b"PK zip"
+        assert "採点表_審査員A.docx" in message.get_payload()[0].get_payload(decode=True).decode('utf-8')
+    finally:
+        mail_queue.close(5)
+        server.stop()
+
+def test_retries_temporary_errors_with_backoff():
+    server = StubSMTPServer()
+    server.data_replies = [b"451 try again", b"451 try again"]
+    mail_queue = make_queue(server, retry_base_seconds=0.5)
+    try:
+        job = make_job()
+        mail_queue.submit(job)
+        wait_for(job, ('sent', 'failed'))
+        assert job.status == 'sent' and job.attempts == 3
+        assert mail_queue._stopped.waits == [0.5, 1.0]
+        assert len(server.messages) == 1
+    finally:
+        mail_queue.close(5)
+        server.stop()
+
+def test_gives_up_after_max_attempts():
+    server = StubSMTPServer()
+    server.data_replies = [b"451 try again"] * 3
+    mail_queue = make_queue(server, max_attempts=3, retry_base_seconds=0.5)
+    try:
+        job = make_job()
+        mail_queue.submit(job)
+        wait_for(job, ('sent', 'failed'))
+        assert job.status == 'failed' and job.attempts == 3
+        assert mail_queue._stopped.waits == [0.5, 1.0]
+    finally:
+        mail_queue.close(5)
+        server.stop()
+
+def test_auth_failure_is_not_retried():
+    server = StubSMTPServer()
+    server.auth_reply = b"535 authentication failed"
+    mail_queue = make_queue(server, password="wrong")
+    try:
+        job = make_job()
+        mail_queue.submit(job)
+        wait_for(job, ('sent', 'failed'))
+        assert job.status == 'failed' and job.attempts == 1
+        assert mail_queue._stopped.waits == []
+        assert server.messages == []
+    finally:
+        mail_queue.close(5)
+        server.stop()
+
+def test_full_queue_rejects_job():
+    server = StubSMTPServer()
+    server.hold.clear()
+    mail_queue = make_queue(server, maxsize=1)
+    try:
+        sending = make_job()
+        mail_queue.submit(sending)
+        wait_for(sending, ('sending',))
+        waiting = make_job()
+        assert mail_queue.submit(waiting)
+        rejected = make_job()
+        assert not mail_queue.submit(rejected)
+        assert rejected.status == 'failed' and rejected.error == "送信待ちが多すぎます"
+        assert mail_queue.get(rejected.job_id) is rejected
+
+        server.hold.set()
+        wait_for(waiting, ('sent', 'failed'))
+        assert sending.status == 'sent' and waiting.status == 'sent'
+    finally:
+        server.hold.set()
+        mail_queue.close(5)
+        server.stop()
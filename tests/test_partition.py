@@ -0,0 +1,71 @@
+"""グループの自動分割（linear_partition・partition_groups）のテスト。"""
+import itertools
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from engine import DEFAULT_ENTRY_SECONDS, ParticipantIndex, build_assignment_plan, linear_partition, partition_groups
+
+def make_roster(durations, prefix="A"):
+    return [{'no': f"{prefix}{i:03d}", 'name': f"出場者{i}", 'duration_sec': d} for i, d in enumerate(durations, 1)]
+
+def block_sums(durations, ends):
+    starts = [0] + ends[:-1]
+    return [sum(durations[s:e]) for s, e in zip(starts, ends)]
+
+def brute_force_max(durations, k):
+    # 区間の境界の選び方をすべて試したときの、区間の合計の最大の最小値
+    n = len(durations)
+    return min(max(block_sums(durations, list(cut) + [n]))
+               for cut in itertools.combinations(range(1, n), k - 1))
+
+def test_linear_partition_matches_brute_force():
+    rng = random.Random(20)
+    for _ in range(300):
+        n = rng.randint(1, 8)
+        durations = [rng.randint(1, 20) for _ in range(n)]
+        k = rng.randint(1, n)
+        ends = linear_partition(durations, k)
+        assert len(ends) == k and ends[-1] == n
+        assert all(a < b for a, b in zip(ends, ends[1:]))
+        assert max(block_sums(durations, ends)) == brute_force_max(durations, k)
+
+def test_linear_partition_edge_cases():
+    assert linear_partition([], 3) == []
+    assert linear_partition([5, 5], 4) == [1, 2]
+    assert linear_partition([5, 5, 5], 0) == [3]
+    # 最適の範囲で境界を均等な位置に置く
+    assert linear_partition([1] * 9, 3) == [3, 6, 9]
+
+def test_partition_groups_places_gaps_and_long_breaks():
+    roster = make_roster([600] * 6)
+    groups = partition_groups(ParticipantIndex(roster), 1200, start_time="10:00", gap_sec=300,
+                              long_break_sec=1800, long_break_every=2)
+    assert groups == [
+        {'member_input': "A001-A002", 'time_str': "10:00-10:20"},
+        {'member_input': "A003-A004", 'time_str': "10:25-10:45"},
+        {'member_input': "A005-A006", 'time_str': "11:15-11:35"},
+    ]
+
+def test_partition_groups_uses_fewest_groups_within_target():
+    roster = make_roster([240, 0, 300, 180, 420, 60, 300], prefix="B")
+    groups = partition_groups(roster, 900)
+    plan = build_assignment_plan(groups, ParticipantIndex(roster))
+    assert plan.duplicates == () and plan.unassigned == ()
+    assert all(g['time_str'] == "" for g in groups)
+    # 演奏時間が空欄の出場者は DEFAULT_ENTRY_SECONDS として数える
+    durations = [240, DEFAULT_ENTRY_SECONDS, 300, 180, 420, 60, 300]
+    sums = [sum(m['duration_sec'] or DEFAULT_ENTRY_SECONDS for m in g.members) for g in plan.groups]
+    assert max(sums) <= 900
+    assert brute_force_max(durations, len(groups) - 1) > 900
+    assert max(sums) == brute_force_max(durations, len(groups))
+
+def test_partition_groups_single_entry_and_oversized_entry():
+    roster = make_roster([1800, 300, 300])
+    groups = partition_groups(roster, 600, start_time="9:00")
+    # 目安より長い出場者は1人だけのグループにする
+    assert groups == [{'member_input': "A001", 'time_str': "09:00-09:30"},
+                      {'member_input': "A002-A003", 'time_str': "09:30-09:40"}]
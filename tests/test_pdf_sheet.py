@@ -0,0 +1,55 @@
+"""採点表・受付表のPDF（PdfSheetLayout）のテスト。"""
+import os
+import re
+import sys
+
+from reportlab.pdfbase import pdfmetrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from engine import (PDF_FONT, PDF_FONT_SIZE, PdfSheetLayout, build_assignment_plan, generate_pdf_sheet,
+                    register_pdf_font, _wrap_pdf_text)
+
+CONTEXT = {'contest_name': "テスト予選"}
+
+def make_plan(count, per_group=10):
+    all_data = [{'no': f"A{i:03d}", 'name': f"出場者{i}", 'kana': "シュツジョウシャ", 'song': "ソナタ 第1楽章",
+                 'age': "10", 'tel': "000-0000-0000", 'duration_sec': 180} for i in range(1, count + 1)]
+    groups = [{'member_input': f"A{s:03d}-A{min(s + per_group - 1, count):03d}", 'time_str': "10:00-10:30"}
+              for s in range(1, count + 1, per_group)]
+    return build_assignment_plan(groups, all_data)
+
+def page_count(data):
+    return len(re.findall(rb"/Type /Page\b", data))
+
+def test_pdf_pages_and_determinism():
+    plan = make_plan(120)
+    layout = PdfSheetLayout('score', plan, None, CONTEXT)
+    first = layout.render("審査員A").getvalue()
+    assert first.startswith(b"%PDF-") and first.rstrip().endswith(b"%%EOF")
+    assert page_count(first) == len(layout.page_contents) > 1
+    # 作成日時などを入れないので、同じ入力からは同じバイト列になる
+    assert generate_pdf_sheet('score', plan, None, CONTEXT, "審査員A").getvalue() == first
+    second = layout.render("審査員B").getvalue()
+    assert second != first and page_count(second) == page_count(first)
+    assert layout.title("審査員B") == "テスト予選：審査員B先生"
+
+def test_reception_sheet_with_no_members():
+    layout = PdfSheetLayout('reception', build_assignment_plan([], []), None, CONTEXT)
+    assert layout.title() == "テスト予選：受付表"
+    assert page_count(layout.render().getvalue()) == 1
+
+def test_time_row_is_never_left_at_page_bottom():
+    rows = [(["10:00"], 10, True), (["A001"], 10, False), (["A002"], 10, False),
+            (["11:00"], 10, True), (["A003"], 10, False)]
+    pages = PdfSheetLayout._paginate(iter(rows), 40)
+    assert [[cells[0] for cells, _, _ in page] for page in pages] == [["10:00", "A001", "A002"], ["11:00", "A003"]]
+
+def test_long_text_wraps_within_width():
+    register_pdf_font()
+    width = 60
+    lines = _wrap_pdf_text("とても長い曲目の名前が入ります 作品番号123", width)
+    assert len(lines) > 1 and "".join(lines).replace(" ", "") == "とても長い曲目の名前が入ります作品番号123"
+    assert all(pdfmetrics.stringWidth(line, PDF_FONT, PDF_FONT_SIZE) <= width for line in lines)
+    assert _wrap_pdf_text("", width) == [""]
@@ -0,0 +1,67 @@
+"""並列生成（プロセスプールを使うかの判断と、審査員ごとの帳票の振り分け）のテスト。"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import engine
+from engine import (JudgeSheetStamper, ParticipantIndex, build_assignment_plan, build_render_tasks,
+                    iter_render_outputs, render_pool_min_rows, select_template_paths, split_judge_tasks)
+
+JUDGES = ["審査員A", "審査員B", "審査員C", "審査員D", "審査員E"]
+
+def make_tasks(judges=JUDGES, sheet_format='both'):
+    all_data = [{'no': f"A{i:03d}", 'name': f"出場者{i}", 'kana': "", 'song': "曲", 'age': "", 'tel': "",
+                 'duration_sec': 180} for i in range(1, 7)]
+    groups = [{'member_input': "A001-A006", 'time_str': "10:00-10:30"}]
+    plan = build_assignment_plan(groups, ParticipantIndex(all_data))
+    templates = select_template_paths(os.path.join(ROOT, engine.TEMPLATE_DIR))
+    return build_render_tasks(plan, None, judges, {'contest_name': "テスト予選"},
+                              score_template=templates['score'], reception_template=templates['reception'],
+                              sheet_format=sheet_format)
+
+def test_min_rows_scales_with_cores(monkeypatch):
+    monkeypatch.delenv(engine.RENDER_POOL_MIN_ROWS_ENV, raising=False)
+    monkeypatch.setattr(engine, 'available_cpus', lambda: 1)
+    assert render_pool_min_rows(4) is None
+    monkeypatch.setattr(engine, 'available_cpus', lambda: 8)
+    assert render_pool_min_rows(1) is None
+    assert render_pool_min_rows(2) > render_pool_min_rows(4) > render_pool_min_rows(8)
+    monkeypatch.setenv(engine.RENDER_POOL_MIN_ROWS_ENV, "0")
+    assert render_pool_min_rows(2) == 0
+
+def test_pdf_score_sheets_are_split_evenly():
+    task = next(t for t in make_tasks() if t.kind == 'score_pdf')
+    split = split_judge_tasks([task], 2)
+    assert [t.judges for t in split] == [JUDGES[:3], JUDGES[3:]]
+    assert split_judge_tasks([task], 1) == [task]
+
+def test_stamped_score_sheets_stay_together():
+    judges = ["審査員A", " 山田 ", "審査員B", "a\tb"]
+    task = next(t for t in make_tasks(judges, 'docx') if t.kind == 'score')
+    split = split_judge_tasks([task], 3)
+    assert [t.judges for t in split] == [["審査員A", "審査員B"], [" 山田 "], ["a\tb"]]
+
+def test_unstampable_judges_skip_the_stamped_base(monkeypatch):
+    task = next(t for t in make_tasks([" 山田 "], 'docx') if t.kind == 'score')
+    calls = []
+    original = engine.generate_word_from_template
+    def counting(*args, **kwargs):
+        calls.append(args[3]['judge_name'])
+        return original(*args, **kwargs)
+    monkeypatch.setattr(engine, 'generate_word_from_template', counting)
+    JudgeSheetStamper(task.template, task.plan, None, task.context, [" 山田 "]).render(" 山田 ")
+    assert calls == [" 山田 "]
+
+def test_pool_gives_the_same_documents(monkeypatch):
+    monkeypatch.setenv(engine.RENDER_POOL_MIN_ROWS_ENV, "0")
+    tasks = make_tasks()
+    serial = {o.arcname for o in iter_render_outputs(tasks, max_workers=1) if o.error is None}
+    pooled = [o for o in iter_render_outputs(tasks, max_workers=2)]
+    try:
+        assert all(o.error is None for o in pooled)
+        assert {o.arcname for o in pooled} == serial
+        assert len(serial) == 2 * len(JUDGES) + 2
+    finally:
+        engine._discard_render_pool(engine.get_render_pool(2))
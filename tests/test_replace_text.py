@@ -0,0 +1,42 @@
+"""段落内のプレースホルダの置換（replace_text_smart）のテスト。"""
+import os
+import sys
+
+from docx import Document
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from engine import XML_SPACE, replace_text_smart
+
+def make_paragraph(*texts):
+    paragraph = Document().add_paragraph()
+    for i, text in enumerate(texts):
+        paragraph.add_run(text).bold = i % 2 == 1
+    return paragraph
+
+def test_placeholder_split_across_runs_keeps_formatting():
+    paragraph = make_paragraph("大会: {{con", "test_name}}", " 審査員: ", "{{judge_name}}")
+    replace_text_smart(paragraph, {'{{contest_name}}': "春の予選", '{{judge_name}}': "山田"})
+    assert paragraph.text == "大会: 春の予選 審査員: 山田"
+    assert [r.text for r in paragraph.runs] == ["大会: 春の予選", "", " 審査員: ", "山田"]
+    assert [r.bold for r in paragraph.runs] == [False, True, False, True]
+
+def test_longest_key_wins_and_values_are_single_pass():
+    paragraph = make_paragraph("{{name}} / {{name_kana}}")
+    # 置換後の文字列に含まれるプレースホルダはもう一度置換しない
+    replace_text_smart(paragraph, {'{{name}}': "{{name_kana}}", '{{name_kana}}': "ヤマダ"})
+    assert paragraph.text == "{{name_kana}} / ヤマダ"
+
+def test_placeholder_does_not_match_across_a_tab():
+    paragraph = make_paragraph("{{no", "\t", "}}")
+    replace_text_smart(paragraph, {'{{no}}': "A001"})
+    assert paragraph.text == "{{no\t}}"
+
+def test_surrounding_whitespace_is_preserved():
+    paragraph = make_paragraph("{{no}}")
+    replace_text_smart(paragraph, {'{{no}}': " A001 "})
+    t = paragraph.runs[0]._r.t_lst[0]
+    assert t.text == " A001 " and t.get(XML_SPACE) == 'preserve'
+    replace_text_smart(paragraph, {' A001 ': "A002"})
+    assert paragraph.runs[0]._r.t_lst[0].get(XML_SPACE) is None
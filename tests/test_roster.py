@@ -0,0 +1,118 @@
+"""名簿の読み込み（normalize_roster_frame・RosterSource）のテスト。"""
+import io
+import os
+import sys
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+from openpyxl.styles import Font
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import engine
+from engine import ROSTER_OPTIONAL_COLUMN, RosterCache, RosterSource, normalize_roster_frame
+
+COL_MAP = {'col_no': "出場番号", 'col_name': "氏名", 'col_kana': ROSTER_OPTIONAL_COLUMN, 'col_song': "演奏曲目",
+           'col_age': ROSTER_OPTIONAL_COLUMN, 'col_tel': ROSTER_OPTIONAL_COLUMN, 'col_duration': "演奏時間"}
+
+def test_normalize_roster_frame():
+    df = pd.DataFrame({"出場番号": ["A001", "A002", "A001"], "氏名": ["山田", None, "佐藤"],
+                       "演奏曲目": ["曲1", "曲2", "曲3"], "演奏時間": ["3分30秒", "不明", None]})
+    all_data, issues = normalize_roster_frame(df, COL_MAP)
+    assert [p['no'] for p in all_data] == ["A001", "A002", "A001"]
+    assert all_data[0]['duration_sec'] == 210
+    assert all_data[0]['kana'] == ""
+    assert issues == {'duplicate_nos': ["A001"], 'empty_name_rows': [3], 'bad_duration_rows': ["3 (不明)"]}
+
+def test_blank_sheet_gives_empty_roster():
+    # 空のシートでは列の候補がなく、必須の列は None になる
+    col_map = {**COL_MAP, 'col_no': None, 'col_name': None, 'col_song': None, 'col_duration': ROSTER_OPTIONAL_COLUMN}
+    all_data, issues = normalize_roster_frame(pd.DataFrame(), col_map)
+    assert all_data == []
+    assert issues == {'duplicate_nos': [], 'empty_name_rows': [], 'bad_duration_rows': []}
+
+def test_missing_optional_column_is_treated_as_unmapped():
+    df = pd.DataFrame({"出場番号": ["A001"], "氏名": ["山田"], "演奏曲目": ["曲1"]})
+    all_data, _ = normalize_roster_frame(df, {**COL_MAP, 'col_kana': "フリガナ"})
+    assert all_data[0]['kana'] == ""
+    assert all_data[0]['duration_sec'] == 0
+
+def test_roster_cache_reuses_and_evicts():
+    cache = RosterCache(max_entries=2)
+    loads = []
+    def loader(value):
+        return lambda: loads.append(value) or value
+    assert cache.get_or_load(('frame', "d1", "S1"), loader(1)) == 1
+    assert cache.get_or_load(('frame', "d1", "S1"), loader(99)) == 1
+    cache.get_or_load(('frame', "d2", "S1"), loader(2))
+    # d1 を使ったので、3つ目を入れると一番古い d2 が追い出される
+    cache.get_or_load(('frame', "d1", "S1"), loader(99))
+    cache.get_or_load(('frame', "d3", "S1"), loader(3))
+    assert cache.get_or_load(('frame', "d1", "S1"), loader(99)) == 1
+    assert cache.get_or_load(('frame', "d2", "S1"), loader(4)) == 4
+    assert loads == [1, 2, 3, 4]
+
+def test_roster_source_is_parsed_once_per_digest():
+    data = "出場番号,氏名,演奏曲目,演奏時間\nA001,山田,曲1,3分\n".encode('utf-8')
+    cache = RosterCache()
+    first = RosterSource(data, "roster.csv", cache=cache).roster("CSV", COL_MAP)
+    again = RosterSource(data, "roster.csv", cache=cache).roster("CSV", COL_MAP)
+    assert again is first
+    assert first[0][0]['duration_sec'] == 180
+    cache.invalidate(RosterSource(data, "roster.csv").digest)
+    assert RosterSource(data, "roster.csv", cache=cache).roster("CSV", COL_MAP) is not first
+
+def make_workbook():
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "名簿"
+    ws.append(["出場番号", "氏名", "演奏曲目", "演奏時間", "氏名"])
+    ws.append(["A001", "山田", "曲1", "3分", "x"])
+    ws.append([])
+    ws.append([2, None, "曲2", 150.5, None])
+    ws['C6'].font = Font(bold=True)
+    # 1行目が空のシート（書式だけのセルを含む）と、データが途中の行から始まるシート
+    ws = wb.create_sheet("1行目が空")
+    ws['A1'].font = Font(bold=True)
+    ws['A2'], ws['B2'], ws['A3'], ws['B3'] = "出場番号", "氏名", "A001", "山田"
+    ws = wb.create_sheet("途中から")
+    ws['B3'], ws['C3'], ws['B5'], ws['C5'], ws['D7'] = "出場番号", "氏名", "A001", "山田", "x"
+    wb.create_sheet("空")
+    wb.create_sheet("書式だけ")['C5'].font = Font(bold=True)
+    f = io.BytesIO()
+    wb.save(f)
+    return f.getvalue()
+
+XLSX_SHEETS = ["名簿", "1行目が空", "途中から", "空", "書式だけ"]
+
+@pytest.fixture(params=[False, True], ids=["streaming", "fallback"])
+def xlsx_source(request, monkeypatch):
+    if request.param:
+        # openpyxl の内部が変わったときは pandas で読む
+        def unavailable(*args, **kwargs):
+            raise AttributeError("_get_source")
+        monkeypatch.setattr(engine, '_xlsx_sheet_rows', unavailable)
+    return RosterSource(make_workbook(), "roster.xlsx")
+
+@pytest.mark.parametrize("sheet_name", XLSX_SHEETS)
+def test_xlsx_reader_matches_read_excel(xlsx_source, sheet_name):
+    expected = pd.read_excel(io.BytesIO(xlsx_source.data), sheet_name=sheet_name)
+    columns = xlsx_source.columns(sheet_name)
+    assert columns == expected.columns.tolist()
+    for selected in (columns, columns[::-2]):
+        col_map = dict(zip(engine.ROSTER_COLUMN_ORDER, selected))
+        df = xlsx_source._streamed_frame(sheet_name, col_map)
+        if selected:
+            pd.testing.assert_frame_equal(df, expected[selected])
+        else:
+            assert df.empty
+
+def test_blank_xlsx_sheet_gives_empty_roster(xlsx_source):
+    col_map = {key: None for key in engine.ROSTER_COLUMN_ORDER}
+    all_data, _, issues = xlsx_source.roster("空", col_map)
+    assert all_data == [] and issues['duplicate_nos'] == []
+    all_data, _, _ = xlsx_source.roster("1行目が空", {**COL_MAP, 'col_no': "Unnamed: 0", 'col_name': "Unnamed: 1",
+                                                    'col_song': "Unnamed: 1", 'col_duration': "演奏時間"})
+    assert [p['no'] for p in all_data] == ["出場番号", "A001"]